@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import io
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional
+
+import numpy as np
+
+from db import iter_cohort_users, iter_cohort_webview_days
+from recurrence import TZ
+
+
+# Сколько недельных когорт (и недель жизни) в отчёте
+COHORT_WEEKS = 12
+# Сколько недель показывать в текстовой таблице (полная матрица — в CSV)
+TABLE_WEEKS = 8
+
+_EPOCH = date(1970, 1, 1)
+
+# Отчёт считается один раз в сутки (по местной дате); одновременные запросы ждут один расчёт
+_report_lock = asyncio.Lock()
+_cached: Optional[tuple[date, int, "CohortReport"]] = None
+
+
+def _week_of(days: np.ndarray) -> np.ndarray:
+    """Номер недели (с понедельника) для номера дня от 1970-01-01 — это четверг, отсюда сдвиг на 3."""
+
+    return (days + 3) // 7
+
+
+def _week_start(week: int) -> date:
+    return _EPOCH + timedelta(days=int(week) * 7 - 3)
+
+
+def _to_array(chunks: Iterable[list[tuple]], columns: int) -> np.ndarray:
+    parts = [np.asarray(chunk, dtype=np.int64).reshape(-1, columns) for chunk in chunks]
+    if not parts:
+        return np.empty((0, columns), dtype=np.int64)
+    return np.concatenate(parts)
+
+
+@dataclass
+class CohortReport:
+    """Недельные когорты по first_seen: размер, активные в неделю N жизни и доля открывших WebView.
+
+    active[c, n] — сколько пользователей когорты c были активны в n-ю неделю после прихода
+    (-1 — неделя ещё не наступила). Активность — открытие WebView или последний визит (last_seen).
+    """
+
+    generated_at: datetime
+    first_week: int
+    sizes: np.ndarray
+    active: np.ndarray
+    converted: np.ndarray
+
+    @property
+    def weeks(self) -> int:
+        return len(self.sizes)
+
+    def week_start(self, cohort: int) -> date:
+        return _week_start(self.first_week + cohort)
+
+    def retention(self) -> np.ndarray:
+        """Доли активных (NaN — неделя не наступила или когорта пуста)."""
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = self.active / self.sizes[:, None]
+        rates[self.active < 0] = np.nan
+        rates[self.sizes == 0] = np.nan
+        return rates
+
+    def conversion(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.sizes > 0, self.converted / np.maximum(self.sizes, 1), np.nan)
+
+    def to_csv(self) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(
+            ["cohort_week", "users", "webview_users", "webview_rate"]
+            + [f"week_{n}" for n in range(self.weeks)]
+            + [f"week_{n}_rate" for n in range(self.weeks)]
+        )
+        rates = self.retention()
+        conversion = self.conversion()
+        for c in range(self.weeks):
+            active = ["" if value < 0 else int(value) for value in self.active[c]]
+            shares = ["" if np.isnan(value) else f"{value:.4f}" for value in rates[c]]
+            webview_rate = "" if np.isnan(conversion[c]) else f"{conversion[c]:.4f}"
+            writer.writerow(
+                [self.week_start(c).isoformat(), int(self.sizes[c]), int(self.converted[c]), webview_rate]
+                + active
+                + shares
+            )
+        return buffer.getvalue()
+
+    def to_table(self, max_weeks: int = TABLE_WEEKS) -> str:
+        shown = min(max_weeks, self.weeks)
+        rates = self.retention()
+        conversion = self.conversion()
+        header = "Неделя   Польз.  WebV  " + " ".join(f"Н{n:<3}" for n in range(1, shown))
+        lines = [header]
+        for c in range(self.weeks):
+            cells = []
+            for n in range(1, shown):
+                value = rates[c, n]
+                cells.append("  — " if np.isnan(value) else f"{value * 100:3.0f}%")
+            webview = "  —" if np.isnan(conversion[c]) else f"{conversion[c] * 100:3.0f}%"
+            lines.append(
+                f"{self.week_start(c).strftime('%d.%m.%y')} {int(self.sizes[c]):7d} {webview:>5} " + " ".join(cells)
+            )
+        return "\n".join(lines)
+
+
+def build_cohort_report(weeks: int = COHORT_WEEKS, now: Optional[datetime] = None) -> CohortReport:
+    """Считает матрицу удержания по снимку аналитики векторными операциями NumPy."""
+
+    now = (now or datetime.now(TZ)).astimezone(TZ)
+    offset_minutes = int(now.utcoffset().total_seconds() // 60)
+    today = (now.date() - _EPOCH).days
+    current_week = int(_week_of(np.int64(today)))
+    first_week = current_week - weeks + 1
+
+    # Начало первой когорты в UTC (first_seen и created_at хранятся в UTC)
+    since_local = datetime.combine(_week_start(first_week), datetime.min.time())
+    since_iso = (since_local - timedelta(minutes=offset_minutes)).isoformat()
+
+    users = _to_array(iter_cohort_users(since_iso, offset_minutes), 3)
+    events = _to_array(iter_cohort_webview_days(since_iso, offset_minutes), 2)
+
+    user_ids = users[:, 0]
+    user_week = _week_of(users[:, 1])
+    cohort = (user_week - first_week).astype(np.int64)
+    sizes = np.bincount(cohort, minlength=weeks)[:weeks]
+
+    # Пользователь каждого события: user_ids отсортированы, поэтому searchsorted вместо словаря
+    positions = np.searchsorted(user_ids, events[:, 0])
+    if len(user_ids):
+        positions = np.minimum(positions, len(user_ids) - 1)
+        known = user_ids[positions] == events[:, 0]
+    else:
+        known = np.zeros(len(events), dtype=bool)
+    event_users = positions[known]
+    event_offsets = _week_of(events[known, 1]) - user_week[event_users]
+
+    # Активность: недели открытий WebView и неделя последнего визита
+    all_users = np.concatenate([event_users, np.arange(len(user_ids))])
+    all_offsets = np.concatenate([event_offsets, _week_of(users[:, 2]) - user_week])
+    in_range = (all_offsets >= 0) & (all_offsets < weeks)
+    # Пара «пользователь × неделя» учитывается один раз
+    keys = np.unique(all_users[in_range] * weeks + all_offsets[in_range])
+    cells = cohort[keys // weeks] * weeks + keys % weeks
+    active = np.bincount(cells, minlength=weeks * weeks)[: weeks * weeks].reshape(weeks, weeks)
+    # Неделя прихода — активность по определению
+    active[:, 0] = sizes
+
+    # Недели, которые для когорты ещё не наступили
+    offsets = np.arange(weeks)
+    active[(np.arange(weeks)[:, None] + offsets[None, :]) >= weeks] = -1
+
+    converted_users = np.unique(event_users)
+    converted = np.bincount(cohort[converted_users], minlength=weeks)[:weeks]
+
+    return CohortReport(
+        generated_at=now,
+        first_week=first_week,
+        sizes=sizes,
+        active=active,
+        converted=converted,
+    )
+
+
+async def get_cohort_report(weeks: int = COHORT_WEEKS) -> CohortReport:
+    """Отчёт по когортам из кэша на текущие сутки; при первом запросе за день считается в отдельном потоке."""
+
+    global _cached
+    async with _report_lock:
+        today = datetime.now(TZ).date()
+        if _cached is not None and _cached[0] == today and _cached[1] == weeks:
+            return _cached[2]
+        report = await asyncio.to_thread(build_cohort_report, weeks)
+        _cached = (today, weeks, report)
+        return report
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -13,11 +14,109 @@ SITE_URL = os.getenv("SITE_URL", "https://1xbet.tj")
 ADMIN_IDS_RAW = os.getenv("ADMIN_IDS", "")
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+# Отдельный файл БД для часто пополняемых таблиц событий (webview_events, channel_posts):
+# всплески событий после рассылки не конкурируют за блокировку записи с users и mailings
+EVENTS_DB_PATH = os.getenv("EVENTS_DB_PATH", os.path.splitext(DB_PATH)[0] + ".events.db")
+# Автоматический checkpoint WAL файла событий (в страницах): реже, чем у основной БД, чтобы не тормозить всплески
+EVENTS_WAL_AUTOCHECKPOINT = int(os.getenv("EVENTS_WAL_AUTOCHECKPOINT", "10000"))
+# Как часто фоновая задача переносит WAL обеих БД в основные файлы
+DB_CHECKPOINT_SECONDS = int(os.getenv("DB_CHECKPOINT_SECONDS", "60"))
+# Сколько дней хранятся итоги доставки рассылок по получателям (0 — не удалять)
+MAILING_DELIVERIES_RETENTION_DAYS = int(os.getenv("MAILING_DELIVERIES_RETENTION_DAYS", "30"))
+# Как часто фоновая задача удаляет устаревшие итоги доставки, секунды
+MAILING_DELIVERIES_PURGE_SECONDS = int(os.getenv("MAILING_DELIVERIES_PURGE_SECONDS", "3600"))
+
+# Снимок БД только для чтения под тяжёлые аналитические запросы админки (статистика, отчёты);
+# обновляется фоновой задачей через backup API небольшими порциями страниц
+ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", os.path.splitext(DB_PATH)[0] + ".analytics.db")
+ANALYTICS_EVENTS_DB_PATH = os.path.splitext(ANALYTICS_DB_PATH)[0] + ".events.db"
+ANALYTICS_SNAPSHOT_SECONDS = int(os.getenv("ANALYTICS_SNAPSHOT_SECONDS", "300"))
+ANALYTICS_BACKUP_PAGES = int(os.getenv("ANALYTICS_BACKUP_PAGES", "256"))
+
+# Порядок доставки рассылок: "user_id" (как раньше) или "engagement" (сначала самые активные)
+MAILING_ORDER = os.getenv("MAILING_ORDER", "user_id")
+ENGAGEMENT_REFRESH_SECONDS = int(os.getenv("ENGAGEMENT_REFRESH_SECONDS", "3600"))
+
+# Начальная скорость рассылки (сообщений в секунду); меняется админом на лету
+MAILING_RATE_PER_SECOND = float(os.getenv("MAILING_RATE_PER_SECOND", "15"))
+# Сколько секунд после завершения рассылки повторный запуск того же поста с тем же типом считается дублем
+MAILING_DUPLICATE_WINDOW_SECONDS = int(os.getenv("MAILING_DUPLICATE_WINDOW_SECONDS", "60"))
+
+# Базовый URL Bot API (например, локальный Bot API server или тестовая заглушка); пусто — api.telegram.org
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")
+
+# Отдельный HTTP-пул для рассылок, чтобы массовая отправка не конкурировала с getUpdates и ответами
+DELIVERY_POOL_SIZE = int(os.getenv("DELIVERY_POOL_SIZE", "32"))
+DELIVERY_KEEPALIVE_SECONDS = float(os.getenv("DELIVERY_KEEPALIVE_SECONDS", "30"))
+DELIVERY_DNS_TTL_SECONDS = int(os.getenv("DELIVERY_DNS_TTL_SECONDS", "600"))
+DELIVERY_TIMEOUT_SECONDS = float(os.getenv("DELIVERY_TIMEOUT_SECONDS", "15"))
+# Сколько отправок одной рассылки может быть «в полёте» одновременно
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "8"))
+# После скольких постоянных ошибок доставки подряд («chat not found», «user is deactivated», ...)
+# пользователь исключается из рассылок; /start возвращает его обратно
+DELIVERY_MAX_FAILURES = int(os.getenv("DELIVERY_MAX_FAILURES", "3"))
+
+# Растягивание больших рассылок по времени с учётом часов активности пользователей:
+# окно в часах (0 — выключено), длина интервала плана в минутах и минимальное число получателей
+MAILING_SPREAD_HOURS = int(os.getenv("MAILING_SPREAD_HOURS", "0"))
+MAILING_SPREAD_BUCKET_MINUTES = int(os.getenv("MAILING_SPREAD_BUCKET_MINUTES", "15"))
+MAILING_SPREAD_MIN_RECIPIENTS = int(os.getenv("MAILING_SPREAD_MIN_RECIPIENTS", "50000"))
+# Общий планировщик исходящих сообщений (лимиты Telegram): сообщений в секунду на бота (0 — без ограничения),
+# в секунду на личный чат, в минуту на группу/канал и допустимый всплеск сверх равномерного темпа
+OUTBOUND_GLOBAL_PER_SECOND = float(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", "30"))
+OUTBOUND_CHAT_PER_SECOND = float(os.getenv("OUTBOUND_CHAT_PER_SECOND", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_BURST = int(os.getenv("OUTBOUND_BURST", "3"))
+
+# За сколько минут до срабатывания запланированная рассылка готовится заранее: читается пост,
+# фиксируется список получателей, проверяется доступность (0 — подготовка в момент отправки, как раньше)
+MAILING_WARMUP_MINUTES = int(os.getenv("MAILING_WARMUP_MINUTES", "10"))
+
+# Как часто счётчики в памяти (кампании /start <payload>, клики по кнопкам рассылок) сбрасываются в БД
+COUNTERS_FLUSH_SECONDS = int(os.getenv("COUNTERS_FLUSH_SECONDS", "30"))
+# Добавлять ли к рассылкам отслеживаемую кнопку «Играть» по умолчанию (переключается на шаге подтверждения)
+MAILING_TRACK_CLICKS = os.getenv("MAILING_TRACK_CLICKS", "0") == "1"
+
+# Состояния FSM (диалоги админки) хранятся в БД: сколько записей держать в кэше процесса
+# и через сколько секунд без изменений состояние считается брошенным и удаляется
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_STATE_TTL_SECONDS = int(os.getenv("FSM_STATE_TTL_SECONDS", "86400"))
+
+# Очереди обработки апдейтов (UpdateLanesMiddleware): сколько апдейтов каждой очереди обрабатывается одновременно
+LANE_ADMIN_CONCURRENCY = int(os.getenv("LANE_ADMIN_CONCURRENCY", "4"))
+LANE_CHANNEL_CONCURRENCY = int(os.getenv("LANE_CHANNEL_CONCURRENCY", "2"))
+LANE_USER_CONCURRENCY = int(os.getenv("LANE_USER_CONCURRENCY", "32"))
+# Сколько апдейтов может ждать в одной очереди (сверх — отбрасываются) и с какой очереди
+# пользовательских апдейтов начинается облегчённая обработка (без обновления last_seen)
+LANE_QUEUE_LIMIT = int(os.getenv("LANE_QUEUE_LIMIT", "5000"))
+LANE_SHED_BACKLOG = int(os.getenv("LANE_SHED_BACKLOG", "200"))
+
+# Антифлуд (AntiFloodMiddleware): не больше ANTIFLOOD_LIMIT апдейтов от одного пользователя
+# за скользящее окно ANTIFLOOD_WINDOW_SECONDS (0 — выключено); админы не ограничиваются
+ANTIFLOOD_LIMIT = int(os.getenv("ANTIFLOOD_LIMIT", "20"))
+ANTIFLOOD_WINDOW_SECONDS = float(os.getenv("ANTIFLOOD_WINDOW_SECONDS", "10"))
+
+# Получение апдейтов: polling (getUpdates) или webhook (встроенный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный https-адрес вебхука для setWebhook, например https://bot.example.com/webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token (по умолчанию выводится из токена бота)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Число процессов-обработчиков апдейтов (1 — всё в одном процессе)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не задан. Укажите его в файле .env")
 
+if not WEBHOOK_SECRET:
+    # Одинаковый во всех процессах и между перезапусками; допустимые символы — [A-Za-z0-9_-]
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+
 
 def _parse_admin_ids(raw: str) -> List[int]:
     ids: List[int] = []
@@ -47,8 +146,14 @@ formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] %(name)s: %(message
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=2_000_000, backupCount=5, encoding="utf-8")
-file_handler.setFormatter(formatter)
+
+def create_file_handler(path: str) -> RotatingFileHandler:
+    handler = RotatingFileHandler(path, maxBytes=2_000_000, backupCount=5, encoding="utf-8")
+    handler.setFormatter(formatter)
+    return handler
+
+
+file_handler = create_file_handler(LOG_FILE)
 
 logger.handlers.clear()
 logger.addHandler(stream_handler)
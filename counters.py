@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import re
+from collections import Counter
+from typing import Optional
+
+from config import COUNTERS_FLUSH_SECONDS
+from db import flush_campaign_counters, flush_mailing_clicks
+from logger_utils import log_error
+
+
+# Payload deep-link по правилам Telegram: до 64 символов A-Z, a-z, 0-9, _ и -
+CAMPAIGN_PAYLOAD_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def parse_campaign_payload(args: Optional[str]) -> Optional[str]:
+    """Источник кампании из /start <payload>; None — payload нет или он некорректен."""
+
+    if not args:
+        return None
+    payload = args.strip()
+    if not CAMPAIGN_PAYLOAD_RE.match(payload):
+        return None
+    return payload
+
+
+class CampaignCounters:
+    """Счётчики кампаний в памяти процесса.
+
+    Обработчики только увеличивают счётчики (без обращения к БД), а фоновая задача раз в
+    COUNTERS_FLUSH_SECONDS записывает накопленное одной транзакцией — вирусная кампания
+    с тысячами /start в минуту не превращается в тысячи отдельных записей.
+    """
+
+    def __init__(self) -> None:
+        self.starts: Counter = Counter()
+        self.webview_user_ids: set[int] = set()
+
+    def record_start(self, source: str) -> None:
+        self.starts[source] += 1
+
+    def record_webview(self, user_id: int) -> None:
+        self.webview_user_ids.add(user_id)
+
+    @property
+    def pending(self) -> int:
+        return sum(self.starts.values()) + len(self.webview_user_ids)
+
+    def _take(self) -> tuple[Counter, set[int]]:
+        starts, self.starts = self.starts, Counter()
+        user_ids, self.webview_user_ids = self.webview_user_ids, set()
+        return starts, user_ids
+
+    def _restore(self, starts: Counter, user_ids: set[int]) -> None:
+        self.starts.update(starts)
+        self.webview_user_ids |= user_ids
+
+    def flush(self) -> None:
+        """Синхронная запись (при остановке бота)."""
+
+        starts, user_ids = self._take()
+        if not starts and not user_ids:
+            return
+        try:
+            flush_campaign_counters(dict(starts), user_ids)
+        except Exception:
+            self._restore(starts, user_ids)
+            raise
+
+    async def flush_async(self) -> None:
+        """Запись в отдельном потоке; накопленное забирается до await, новые события копятся дальше."""
+
+        starts, user_ids = self._take()
+        if not starts and not user_ids:
+            return
+        try:
+            await asyncio.to_thread(flush_campaign_counters, dict(starts), user_ids)
+        except Exception:
+            self._restore(starts, user_ids)
+            raise
+
+
+class MailingClickCounters:
+    """Клики по отслеживаемой кнопке рассылки (mclick_<mailing_id>) в памяти процесса.
+
+    Всплеск кликов сразу после рассылки копится в множестве пар (mailing_id, user_id) — повторные
+    клики схлопываются ещё до БД — и записывается той же фоновой задачей одной транзакцией.
+    """
+
+    def __init__(self) -> None:
+        self.clicks: set[tuple[int, int]] = set()
+
+    def record_click(self, mailing_id: int, user_id: int) -> None:
+        self.clicks.add((mailing_id, user_id))
+
+    @property
+    def pending(self) -> int:
+        return len(self.clicks)
+
+    def flush(self) -> None:
+        clicks, self.clicks = self.clicks, set()
+        if not clicks:
+            return
+        try:
+            flush_mailing_clicks(clicks)
+        except Exception:
+            self.clicks |= clicks
+            raise
+
+    async def flush_async(self) -> None:
+        clicks, self.clicks = self.clicks, set()
+        if not clicks:
+            return
+        try:
+            await asyncio.to_thread(flush_mailing_clicks, clicks)
+        except Exception:
+            self.clicks |= clicks
+            raise
+
+
+campaign_counters = CampaignCounters()
+mailing_clicks = MailingClickCounters()
+
+
+def flush_all_counters() -> None:
+    """Синхронно записывает все счётчики (при остановке бота)."""
+
+    campaign_counters.flush()
+    mailing_clicks.flush()
+
+
+async def counters_worker() -> None:
+    """Фоновая задача, периодически сбрасывающая счётчики из памяти в БД."""
+
+    while True:
+        await asyncio.sleep(COUNTERS_FLUSH_SECONDS)
+        for name, counters in (("кампаний", campaign_counters), ("кликов", mailing_clicks)):
+            pending = counters.pending
+            try:
+                await counters.flush_async()
+            except Exception as e:  # noqa: BLE001
+                log_error(
+                    user_id=None,
+                    context="counters_worker",
+                    message=f"Ошибка при записи счётчиков {name}",
+                    exc=e,
+                )
+            else:
+                if pending:
+                    logging.info("Счётчики %s записаны: событий=%s", name, pending)
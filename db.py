@@ -1,9 +1,22 @@
+import os
 import sqlite3
+import time
 from contextlib import closing
 from datetime import datetime, timedelta
-from typing import Iterable, Tuple
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from config import DB_PATH
+from config import (
+    ANALYTICS_DB_PATH,
+    ANALYTICS_EVENTS_DB_PATH,
+    DB_PATH,
+    EVENTS_DB_PATH,
+    EVENTS_WAL_AUTOCHECKPOINT,
+)
+
+
+# Таблицы, которые живут в отдельном файле событий (EVENTS_DB_PATH)
+EVENT_TABLES = ("webview_events", "channel_posts", "channel_post_content", "mailing_deliveries")
 
 
 def _get_conn() -> sqlite3.Connection:
@@ -12,8 +25,193 @@ def _get_conn() -> sqlite3.Connection:
     return conn
 
 
+def _get_events_conn() -> sqlite3.Connection:
+    """Соединение с БД событий. Потеря последних событий при сбое питания допустима — без fsync на каждый коммит."""
+
+    conn = sqlite3.connect(EVENTS_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {EVENTS_WAL_AUTOCHECKPOINT}")
+    return conn
+
+
+def _get_conn_with_events() -> sqlite3.Connection:
+    """Соединение с основной БД, к которой подключена БД событий как схема events (для отчётов и пересчётов)."""
+
+    conn = _get_conn()
+    conn.execute("ATTACH DATABASE ? AS events", (EVENTS_DB_PATH,))
+    return conn
+
+
+def _ro_uri(path: str) -> str:
+    return f"{Path(path).resolve().as_uri()}?mode=ro"
+
+
+def _get_snapshot_conn() -> sqlite3.Connection:
+    """Соединение только для чтения со снимком аналитики; пока снимка нет — с рабочей БД.
+
+    Таблицы событий доступны в схеме events (снимок событий или, если его нет, рабочая БД событий).
+    """
+
+    if not os.path.exists(ANALYTICS_DB_PATH):
+        return _get_conn_with_events()
+    conn = sqlite3.connect(_ro_uri(ANALYTICS_DB_PATH), uri=True)
+    conn.row_factory = sqlite3.Row
+    events_path = ANALYTICS_EVENTS_DB_PATH if os.path.exists(ANALYTICS_EVENTS_DB_PATH) else EVENTS_DB_PATH
+    conn.execute("ATTACH DATABASE ? AS events", (_ro_uri(events_path),))
+    return conn
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+def _backup_database(src_path: str, dst_path: str, pages: int, pause: float, max_restarts: int) -> None:
+    """Копирует БД через backup API порциями по pages страниц и атомарно подменяет dst_path."""
+
+    tmp_path = f"{dst_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    restarts = 0
+    last_remaining: Optional[int] = None
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts >= max_restarts:
+                raise _BackupRestarted()
+        last_remaining = remaining
+        time.sleep(pause)
+
+    with closing(sqlite3.connect(src_path, isolation_level=None)) as src, closing(sqlite3.connect(tmp_path)) as dst:
+        wal = src.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if wal:
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _BackupRestarted:
+            src.backup(dst)
+        finally:
+            if wal:
+                src.execute("COMMIT")
+        # Снимок открывается только на чтение — без WAL ему не нужны файлы -wal/-shm
+        dst.execute("PRAGMA journal_mode = DELETE")
+
+    os.replace(tmp_path, dst_path)
+
+
+def refresh_analytics_snapshot(pages: int = 256, pause: float = 0.005, max_restarts: int = 3) -> float:
+    """Обновляет снимок аналитики (основная БД и БД событий) через sqlite3 backup API; возвращает длительность.
+
+    Копирование идёт порциями по pages страниц с паузой между ними. В режиме WAL на время копирования
+    держится транзакция чтения: снимок согласован, а запись в рабочую БД не блокируется и не заставляет
+    копирование начинаться заново. Без WAL изменения рабочей БД перезапускают копирование; после
+    max_restarts перезапусков остаток копируется одним шагом.
+    Готовый файл подменяет старый снимок атомарно (os.replace) — читатели снимка не видят полузаписанный файл.
+    """
+
+    started = time.monotonic()
+    _backup_database(EVENTS_DB_PATH, ANALYTICS_EVENTS_DB_PATH, pages, pause, max_restarts)
+    _backup_database(DB_PATH, ANALYTICS_DB_PATH, pages, pause, max_restarts)
+    return time.monotonic() - started
+
+
+def get_analytics_snapshot_time() -> Optional[datetime]:
+    """Время последнего обновления снимка аналитики (локальное время сервера) или None."""
+
+    if not os.path.exists(ANALYTICS_DB_PATH):
+        return None
+    return datetime.fromtimestamp(os.path.getmtime(ANALYTICS_DB_PATH))
+
+
+def checkpoint_databases() -> dict[str, tuple[int, int]]:
+    """Переносит WAL основной БД и БД событий в их файлы (PASSIVE: не ждёт читателей и писателей).
+
+    Возвращает по каждой БД (страниц в WAL, перенесено страниц).
+    """
+
+    result: dict[str, tuple[int, int]] = {}
+    for name, connect in (("main", _get_conn), ("events", _get_events_conn)):
+        with closing(connect()) as conn:
+            _, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        result[name] = (int(wal_pages), int(checkpointed))
+    return result
+
+
+class DbSession:
+    """Единица работы на один апдейт Telegram.
+
+    Записи, сделанные обработчиком через session, не выполняются сразу, а копятся
+    и фиксируются в commit() — одной транзакцией на каждый файл БД (основная и события).
+    """
+
+    def __init__(self) -> None:
+        self._statements: List[Tuple[str, tuple]] = []
+        self._event_statements: List[Tuple[str, tuple]] = []
+
+    def add(self, sql: str, params: tuple, events: bool = False) -> None:
+        (self._event_statements if events else self._statements).append((sql, params))
+
+    @property
+    def pending(self) -> int:
+        return len(self._statements) + len(self._event_statements)
+
+    def commit(self) -> None:
+        for connect, attr in ((_get_conn, "_statements"), (_get_events_conn, "_event_statements")):
+            statements = getattr(self, attr)
+            if not statements:
+                continue
+            setattr(self, attr, [])
+            with closing(connect()) as conn, conn:  # type: ignore[call-arg]
+                for sql, params in statements:
+                    conn.execute(sql, params)
+
+    def rollback(self) -> None:
+        self._statements.clear()
+        self._event_statements.clear()
+
+
+def _write(session: Optional[DbSession], sql: str, params: tuple, events: bool = False) -> None:
+    """Выполняет запись сразу или откладывает её до коммита сессии апдейта.
+
+    events=True — запись в БД событий (EVENTS_DB_PATH).
+    """
+
+    if session is not None:
+        session.add(sql, params, events=events)
+        return
+    with closing(_get_events_conn() if events else _get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(sql, params)
+
+
+def _join_message_ids(message_ids: Sequence[int]) -> str:
+    return ",".join(str(int(mid)) for mid in message_ids)
+
+
+def parse_message_ids(raw: Optional[str], message_id: int) -> List[int]:
+    """Разбирает список message_id из БД; для старых записей без списка — [message_id]."""
+
+    if not raw:
+        return [int(message_id)]
+    return sorted({int(part) for part in raw.split(",") if part.strip()})
+
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    """Добавляет колонку в существующую таблицу, если её ещё нет (простая миграция)."""
+
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
 def init_db() -> None:
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        # WAL: читатели (снимок аналитики, отчёты) не блокируют запись и наоборот; режим хранится в файле БД
+        conn.execute("PRAGMA journal_mode = WAL")
+
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -26,6 +224,54 @@ def init_db() -> None:
             """
         )
 
+        # Предрасчитанный скор вовлечённости: по нему рассылка идёт от самых активных к менее активным
+        _ensure_column(conn, "users", "engagement_score", "REAL NOT NULL DEFAULT 0")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_engagement ON users (is_blocked, engagement_score DESC, user_id DESC)"
+        )
+
+        # Подряд идущие постоянные ошибки доставки («chat not found», «user is deactivated», ...) и класс
+        # последней ошибки; после DELIVERY_MAX_FAILURES пользователь исключается из рассылок (is_blocked = 1)
+        _ensure_column(conn, "users", "delivery_failures", "INTEGER NOT NULL DEFAULT 0")
+        _ensure_column(conn, "users", "last_error", "TEXT")
+        _ensure_column(conn, "users", "last_error_at", "TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_failing ON users (user_id) WHERE delivery_failures > 0"
+        )
+
+        # Атрибуция: источник первого касания (payload из /start <payload>) и флаг конверсии в WebView
+        _ensure_column(conn, "users", "source", "TEXT")
+        _ensure_column(conn, "users", "converted", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_source ON users (source) WHERE source IS NOT NULL")
+
+        # Час наибольшей активности пользователя (местное время, 0-23) — для распределения рассылок по времени
+        _ensure_column(conn, "users", "peak_hour", "INTEGER")
+
+        # Агрегированные счётчики кампаний; пишутся пачками из counters.py, а не на каждый /start
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS campaign_stats (
+                source TEXT PRIMARY KEY,
+                starts INTEGER NOT NULL DEFAULT 0,
+                conversions INTEGER NOT NULL DEFAULT 0,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL
+            )
+            """
+        )
+
+        # Непустые состояния FSM (см. fsm_storage.py); пустые не хранятся
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
+
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS mailings (
@@ -42,9 +288,50 @@ def init_db() -> None:
             """
         )
 
+        # Список message_id для альбомов (через запятую); message_id остаётся первым сообщением
+        _ensure_column(conn, "mailings", "message_ids", "TEXT")
+        # Содержимое поста, прочитанное один раз перед рассылкой (JSON: текст, entities, file_id, кнопки)
+        _ensure_column(conn, "mailings", "content_json", "TEXT")
+
+        # Метрики ранней доставки: за сколько секунд 50% / 90% недавно активных получили рассылку
+        _ensure_column(conn, "mailings", "delivery_order", "TEXT")
+        _ensure_column(conn, "mailings", "active_p50_seconds", "INTEGER")
+        _ensure_column(conn, "mailings", "active_p90_seconds", "INTEGER")
+
+        # Отслеживаемая кнопка «Играть» (callback mclick_<id>) и число уникальных кликов по ней
+        _ensure_column(conn, "mailings", "track_clicks", "INTEGER NOT NULL DEFAULT 0")
+        _ensure_column(conn, "mailings", "click_count", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mailing_clicks (
+                mailing_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                clicked_at TEXT NOT NULL,
+                PRIMARY KEY (mailing_id, user_id)
+            ) WITHOUT ROWID
+            """
+        )
+
         # Индексы для ускорения выборок по часто используемым полям
         conn.execute("CREATE INDEX IF NOT EXISTS idx_mailings_created_at ON mailings (created_at DESC)")
 
+        # План доставки растянутой по времени рассылки: получатель -> интервал (bucket) отправки
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS delivery_plan (
+                mailing_id INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (mailing_id, bucket, user_id)
+            ) WITHOUT ROWID
+            """
+        )
+        # Порядок отправки внутри интервала (для замороженного списка — порядок MAILING_ORDER)
+        _ensure_column(conn, "delivery_plan", "position", "INTEGER")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_delivery_plan_position ON delivery_plan (mailing_id, bucket, position)"
+        )
+
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS scheduled_mailings (
@@ -61,10 +348,37 @@ def init_db() -> None:
             """
         )
 
+        _ensure_column(conn, "scheduled_mailings", "message_ids", "TEXT")
+        # Повторяющиеся рассылки: правило (recurrence.py) и материализованное ближайшее срабатывание.
+        # Для разовых next_run_at совпадает с scheduled_at; планировщик смотрит только на next_run_at.
+        _ensure_column(conn, "scheduled_mailings", "recurrence", "TEXT")
+        _ensure_column(conn, "scheduled_mailings", "next_run_at", "TEXT")
+        _ensure_column(conn, "scheduled_mailings", "last_run_at", "TEXT")
+        _ensure_column(conn, "scheduled_mailings", "track_clicks", "INTEGER NOT NULL DEFAULT 0")
+        # Предварительная подготовка (warm-up): подготовленная запись mailings, срабатывание, для которого
+        # она сделана (сравнивается с next_run_at), и ошибка подготовки
+        _ensure_column(conn, "scheduled_mailings", "prepared_mailing_id", "INTEGER")
+        _ensure_column(conn, "scheduled_mailings", "prepared_for", "TEXT")
+        _ensure_column(conn, "scheduled_mailings", "warmup_error", "TEXT")
+        conn.execute("UPDATE scheduled_mailings SET next_run_at = scheduled_at WHERE next_run_at IS NULL")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_scheduled_mailings_status_next_run ON scheduled_mailings (status, next_run_at)"
+        )
+        # Каждое срабатывание запланированной рассылки — отдельная запись mailings со ссылкой на задачу
+        _ensure_column(conn, "mailings", "scheduled_id", "INTEGER")
+
         conn.execute(
             "CREATE INDEX IF NOT EXISTS idx_scheduled_mailings_status_time ON scheduled_mailings (status, scheduled_at)"
         )
 
+    _init_events_db()
+    _migrate_event_tables()
+
+
+def _init_events_db() -> None:
+    with closing(_get_events_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute("PRAGMA journal_mode = WAL")
+
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS webview_events (
@@ -75,6 +389,10 @@ def init_db() -> None:
             """
         )
 
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_webview_events_user_created ON webview_events (user_id, created_at)"
+        )
+
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS channel_posts (
@@ -91,38 +409,171 @@ def init_db() -> None:
             "CREATE INDEX IF NOT EXISTS idx_channel_posts_chat_created ON channel_posts (chat_id, created_at DESC)"
         )
 
+        # Альбом (media group) хранится одной строкой: message_ids копятся по мере прихода сообщений группы
+        _ensure_column(conn, "channel_posts", "media_group_id", "TEXT")
+        _ensure_column(conn, "channel_posts", "message_ids", "TEXT")
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_posts_media_group ON channel_posts (chat_id, media_group_id)"
+        )
+
+        # Содержимое сообщений канала для рассылки (mailing_content.extract_payload); payload NULL — тип
+        # сообщения не поддерживается кэшем. Обновляется при редактировании поста
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS channel_post_content (
+                chat_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                payload TEXT,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+            """
+        )
+
+        # Итог доставки рассылки каждому получателю (sent / blocked / unreachable / retry / failed) — для выгрузки;
+        # хранится MAILING_DELIVERIES_RETENTION_DAYS дней (purge_mailing_deliveries)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mailing_deliveries (
+                mailing_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                outcome TEXT NOT NULL,
+                error TEXT,
+                attempted_at TEXT NOT NULL,
+                PRIMARY KEY (mailing_id, user_id)
+            ) WITHOUT ROWID
+            """
+        )
+
+
+def _migrate_event_tables() -> None:
+    """Переносит таблицы событий из основной БД (старые установки) в файл событий.
+
+    Строки копируются вместе с id через INSERT OR IGNORE, поэтому прерванный перенос безопасно повторяется.
+    """
+
+    with closing(sqlite3.connect(DB_PATH, isolation_level=None)) as conn:
+        placeholders = ",".join("?" for _ in EVENT_TABLES)
+        tables = [
+            row[0]
+            for row in conn.execute(
+                f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})",
+                EVENT_TABLES,
+            )
+        ]
+        if not tables:
+            return
+
+        conn.execute("ATTACH DATABASE ? AS events", (EVENTS_DB_PATH,))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in tables:
+                columns = ", ".join(row[1] for row in conn.execute(f"PRAGMA main.table_info({table})"))
+                conn.execute(f"INSERT OR IGNORE INTO events.{table} ({columns}) SELECT {columns} FROM main.{table}")
+                conn.execute(f"DROP TABLE main.{table}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def upsert_user(
+    user_id: int,
+    is_admin: bool = False,
+    session: Optional[DbSession] = None,
+    source: Optional[str] = None,
+    touch: bool = True,
+    reactivate: bool = False,
+) -> None:
+    """Создаёт или обновляет пользователя. source записывается только новым (первое касание).
+
+    touch=False — при перегрузке (см. UpdateLanesMiddleware): новый пользователь всё равно создаётся,
+    а у существующего не обновляются last_seen и флаги — строка не переписывается.
+    reactivate=True — только из /start: пользователь снова получает рассылки (сбрасываются is_blocked
+    и счётчик ошибок доставки). Другие апдейты (кнопки, WebView, устаревшие callback) их не трогают,
+    иначе счётчик недоставляемого чата обнулялся бы и он никогда не исключался из рассылок.
+    """
 
-def upsert_user(user_id: int, is_admin: bool = False) -> None:
     now = datetime.utcnow().isoformat()
+    reactivation = ",\n            is_blocked = 0,\n            delivery_failures = 0" if reactivate else ""
+    conflict = (
+        f"""
+        DO UPDATE SET
+            last_seen = excluded.last_seen,
+            is_admin = MAX(is_admin, excluded.is_admin){reactivation}
+        """
+        if touch
+        else "DO NOTHING"
+    )
+    _write(
+        session,
+        f"""
+        INSERT INTO users (user_id, is_admin, first_seen, last_seen, is_blocked, engagement_score, source)
+        VALUES (?, ?, ?, ?, 0, 1.0, ?)
+        ON CONFLICT (user_id) {conflict}
+        """,
+        (user_id, int(is_admin), now, now, source),
+    )
+
+
+def mark_user_blocked(user_id: int, session: Optional[DbSession] = None) -> None:
+    _write(
+        session,
+        "UPDATE users SET is_blocked = 1, last_error = 'forbidden', last_error_at = ? WHERE user_id = ?",
+        (datetime.utcnow().isoformat(), user_id),
+    )
+
+
+def get_failing_user_ids() -> set[int]:
+    """Пользователи с ненулевым счётчиком ошибок доставки (обычно небольшое множество, по частичному индексу)."""
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        rows = conn.execute("SELECT user_id FROM users WHERE delivery_failures > 0").fetchall()
+    return {int(r["user_id"]) for r in rows}
+
+
+def record_delivery_failures(failures: list[tuple[int, str]], max_failures: int) -> int:
+    """Пачкой увеличивает счётчики постоянных ошибок доставки и записывает класс ошибки.
+
+    Пользователи, набравшие max_failures ошибок подряд, исключаются из рассылок (is_blocked = 1).
+    Возвращает, сколько пользователей исключено этой пачкой.
+    """
+
+    if not failures:
+        return 0
+
+    now = datetime.utcnow().isoformat()
+    user_ids = [uid for uid, _ in failures]
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
-        row = conn.execute(
-            "SELECT user_id FROM users WHERE user_id = ?",
-            (user_id,),
-        ).fetchone()
-        if row is None:
-            conn.execute(
-                """
-                INSERT INTO users (user_id, is_admin, first_seen, last_seen, is_blocked)
-                VALUES (?, ?, ?, ?, 0)
-                """,
-                (user_id, int(is_admin), now, now),
-            )
-        else:
-            conn.execute(
-                """
-                UPDATE users
-                SET last_seen = ?, is_admin = MAX(is_admin, ?)
-                WHERE user_id = ?
-                """,
-                (now, int(is_admin), user_id),
-            )
+        conn.executemany(
+            """
+            UPDATE users
+            SET delivery_failures = delivery_failures + 1,
+                last_error = ?,
+                last_error_at = ?,
+                is_blocked = CASE WHEN delivery_failures + 1 >= ? THEN 1 ELSE is_blocked END
+            WHERE user_id = ?
+            """,
+            [(error_class, now, max_failures, uid) for uid, error_class in failures],
+        )
+        placeholders = ",".join("?" * len(user_ids))
+        suppressed = conn.execute(
+            f"SELECT COUNT(*) FROM users WHERE user_id IN ({placeholders}) AND is_blocked = 1 AND delivery_failures >= ?",
+            (*user_ids, max_failures),
+        ).fetchone()[0]
+    return int(suppressed)
+
+
+def reset_delivery_failures(user_ids: list[int]) -> None:
+    """Сбрасывает счётчики ошибок после успешной доставки (считаются только ошибки подряд)."""
 
+    if not user_ids:
+        return
 
-def mark_user_blocked(user_id: int) -> None:
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
-        conn.execute(
-            "UPDATE users SET is_blocked = 1 WHERE user_id = ?",
-            (user_id,),
+        conn.executemany(
+            "UPDATE users SET delivery_failures = 0 WHERE user_id = ? AND delivery_failures > 0",
+            [(uid,) for uid in user_ids],
         )
 
 
@@ -139,6 +590,307 @@ def get_active_users(include_admins: bool = True):
     return [int(r["user_id"]) for r in rows]
 
 
+def count_active_users(include_admins: bool = True, since: Optional[str] = None) -> int:
+    """Количество получателей рассылки; с since — только заходившие в бота после этого момента."""
+
+    query = "SELECT COUNT(*) FROM users WHERE is_blocked = 0"
+    params: list = []
+    if not include_admins:
+        query += " AND is_admin = 0"
+    if since is not None:
+        query += " AND last_seen >= ?"
+        params.append(since)
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        return int(conn.execute(query, params).fetchone()[0])
+
+
+def iter_active_users(
+    include_admins: bool = True,
+    order: str = "user_id",
+    recent_since: Optional[str] = None,
+    page_size: int = 500,
+) -> Iterator[Tuple[int, bool]]:
+    """Постранично отдаёт получателей рассылки в виде (user_id, был ли активен после recent_since).
+
+    order="user_id" — по возрастанию user_id, order="engagement" — по убыванию engagement_score.
+    Используется keyset-пагинация по индексу: список не держится в памяти целиком и не сортируется,
+    а соединение не остаётся открытым между страницами (не мешает записям во время рассылки).
+    """
+
+    admin_filter = "" if include_admins else " AND is_admin = 0"
+    recent_expr = "last_seen >= ?" if recent_since is not None else "0"
+    recent_params: list = [recent_since] if recent_since is not None else []
+
+    if order == "engagement":
+        first_query = f"""
+            SELECT user_id, engagement_score, {recent_expr} AS recent
+            FROM users
+            WHERE is_blocked = 0{admin_filter}
+            ORDER BY engagement_score DESC, user_id DESC
+            LIMIT ?
+        """
+        next_query = f"""
+            SELECT user_id, engagement_score, {recent_expr} AS recent
+            FROM users
+            WHERE is_blocked = 0{admin_filter} AND (engagement_score, user_id) < (?, ?)
+            ORDER BY engagement_score DESC, user_id DESC
+            LIMIT ?
+        """
+    else:
+        first_query = f"""
+            SELECT user_id, {recent_expr} AS recent
+            FROM users
+            WHERE is_blocked = 0{admin_filter}
+            ORDER BY user_id ASC
+            LIMIT ?
+        """
+        next_query = f"""
+            SELECT user_id, {recent_expr} AS recent
+            FROM users
+            WHERE is_blocked = 0{admin_filter} AND user_id > ?
+            ORDER BY user_id ASC
+            LIMIT ?
+        """
+
+    cursor_key: Optional[list] = None
+    while True:
+        with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+            if cursor_key is None:
+                rows = conn.execute(first_query, [*recent_params, page_size]).fetchall()
+            else:
+                rows = conn.execute(next_query, [*recent_params, *cursor_key, page_size]).fetchall()
+
+        for row in rows:
+            yield int(row["user_id"]), bool(row["recent"])
+
+        if len(rows) < page_size:
+            return
+
+        last = rows[-1]
+        if order == "engagement":
+            cursor_key = [last["engagement_score"], last["user_id"]]
+        else:
+            cursor_key = [last["user_id"]]
+
+
+def refresh_engagement_scores() -> None:
+    """Пересчитывает engagement_score: свежесть last_seen + частота открытий WebView за 30 дней."""
+
+    now = datetime.utcnow()
+    month_ago = (now - timedelta(days=30)).isoformat()
+    with closing(_get_conn_with_events()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(
+            """
+            UPDATE users
+            SET engagement_score =
+                1.0 / (1.0 + MAX(0.0, julianday(?) - julianday(last_seen)))
+                + 0.1 * (
+                    SELECT COUNT(*)
+                    FROM events.webview_events w
+                    WHERE w.user_id = users.user_id AND w.created_at >= ?
+                )
+            """,
+            (now.isoformat(), month_ago),
+        )
+
+
+def refresh_peak_hours(utc_offset_minutes: int) -> None:
+    """Пересчитывает peak_hour: самый частый местный час по открытиям WebView за 30 дней и last_seen
+    (при равенстве — час самого свежего события).
+
+    Гистограмма «пользователь × час» строится одним запросом (GROUP BY + оконная функция),
+    без выборки событий в Python.
+    """
+
+    month_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    shift = f"{utc_offset_minutes:+d} minutes"
+    with closing(_get_conn_with_events()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(
+            """
+            UPDATE users
+            SET peak_hour = ranked.hour
+            FROM (
+                SELECT user_id, hour,
+                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY hits DESC, last_at DESC) AS rn
+                FROM (
+                    SELECT user_id, hour, COUNT(*) AS hits, MAX(at) AS last_at
+                    FROM (
+                        SELECT user_id, CAST(strftime('%H', created_at, ?) AS INTEGER) AS hour, created_at AS at
+                        FROM events.webview_events
+                        WHERE created_at >= ?
+                        UNION ALL
+                        SELECT user_id, CAST(strftime('%H', last_seen, ?) AS INTEGER) AS hour, last_seen AS at
+                        FROM users
+                    )
+                    GROUP BY user_id, hour
+                )
+            ) AS ranked
+            WHERE ranked.user_id = users.user_id AND ranked.rn = 1
+              AND users.peak_hour IS NOT ranked.hour
+            """,
+            (shift, month_ago, shift),
+        )
+
+
+def _purge_old_delivery_plans(conn: sqlite3.Connection) -> None:
+    """Удаляет планы доставки рассылок старше недели (оставшиеся после сбоя или перезапуска бота).
+
+    Планы завершённых рассылок удаляет delete_delivery_plan сразу по окончании отправки.
+    """
+
+    week_ago = (datetime.utcnow() - timedelta(days=7)).isoformat()
+    conn.execute(
+        "DELETE FROM delivery_plan WHERE mailing_id IN (SELECT id FROM mailings WHERE created_at < ?)",
+        (week_ago,),
+    )
+
+
+def build_delivery_plan(
+    mailing_id: int,
+    start_hour: int,
+    start_minute: int,
+    bucket_minutes: int,
+    buckets: int,
+    bucket_capacity: int,
+    include_admins: bool = True,
+) -> int:
+    """Строит план растянутой рассылки одним INSERT ... SELECT и возвращает число получателей.
+
+    Интервал 0 начинается в start_hour:start_minute (местное время), каждый длится bucket_minutes.
+    Пользователь попадает в интервалы своего peak_hour (внутри часа — по user_id), без peak_hour
+    или с часом вне окна — равномерно по user_id. Интервал вмещает не больше bucket_capacity
+    получателей: лишние по номеру в интервале сдвигаются в следующие (по кругу).
+    """
+
+    admin_filter = "" if include_admins else " AND is_admin = 0"
+    per_hour = max(1, 60 // bucket_minutes)
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        _purge_old_delivery_plans(conn)
+        conn.execute("DELETE FROM delivery_plan WHERE mailing_id = ?", (mailing_id,))
+        before = conn.total_changes
+        conn.execute(
+            f"""
+            WITH preferred AS (
+                SELECT user_id,
+                       CASE
+                           WHEN peak_hour IS NULL THEN -1
+                           ELSE MAX(0, ((peak_hour - :start_hour + 24) % 24) * 60 - :start_minute) / :bucket_minutes
+                                + user_id % :per_hour
+                       END AS bucket
+                FROM users
+                WHERE is_blocked = 0{admin_filter}
+            ),
+            normalized AS (
+                SELECT user_id,
+                       CASE WHEN bucket < 0 OR bucket >= :buckets THEN user_id % :buckets ELSE bucket END AS bucket
+                FROM preferred
+            ),
+            ranked AS (
+                SELECT user_id, bucket, ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY user_id) AS rn
+                FROM normalized
+            )
+            INSERT INTO delivery_plan (mailing_id, bucket, user_id, position)
+            SELECT :mailing_id, (bucket + (rn - 1) / :capacity) % :buckets, user_id, user_id
+            FROM ranked
+            """,
+            {
+                "mailing_id": mailing_id,
+                "start_hour": start_hour,
+                "start_minute": start_minute,
+                "bucket_minutes": bucket_minutes,
+                "per_hour": per_hour,
+                "buckets": buckets,
+                "capacity": max(1, bucket_capacity),
+            },
+        )
+        return conn.total_changes - before
+
+
+def freeze_recipients(mailing_id: int, order: str = "user_id", include_admins: bool = True) -> int:
+    """Замораживает список получателей рассылки в delivery_plan (один интервал) и возвращает их число.
+
+    Порядок отправки сохраняется в position: по user_id или, для order="engagement", по убыванию engagement_score.
+    """
+
+    admin_filter = "" if include_admins else " AND is_admin = 0"
+    if order == "engagement":
+        position_expr = "ROW_NUMBER() OVER (ORDER BY engagement_score DESC, user_id DESC)"
+    else:
+        position_expr = "user_id"
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        _purge_old_delivery_plans(conn)
+        conn.execute("DELETE FROM delivery_plan WHERE mailing_id = ?", (mailing_id,))
+        before = conn.total_changes
+        conn.execute(
+            f"""
+            INSERT INTO delivery_plan (mailing_id, bucket, user_id, position)
+            SELECT ?, 0, user_id, {position_expr}
+            FROM users
+            WHERE is_blocked = 0{admin_filter}
+            """,
+            (mailing_id,),
+        )
+        return conn.total_changes - before
+
+
+def get_delivery_plan_buckets(mailing_id: int) -> int:
+    """Число интервалов в плане доставки рассылки (0 — плана нет)."""
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        row = conn.execute("SELECT MAX(bucket) FROM delivery_plan WHERE mailing_id = ?", (mailing_id,)).fetchone()
+    return int(row[0]) + 1 if row[0] is not None else 0
+
+
+def delete_delivery_plan(mailing_id: int) -> None:
+    """Удаляет план доставки рассылки, отправка которой закончилась (завершена или отменена)."""
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute("DELETE FROM delivery_plan WHERE mailing_id = ?", (mailing_id,))
+
+
+def discard_prepared_mailing(mailing_id: int) -> None:
+    """Удаляет подготовленную, но не отправленную рассылку вместе с планом доставки."""
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute("DELETE FROM delivery_plan WHERE mailing_id = ?", (mailing_id,))
+        conn.execute("DELETE FROM mailings WHERE id = ? AND delivered_count = 0 AND error_count = 0", (mailing_id,))
+
+
+def iter_delivery_plan_bucket(
+    mailing_id: int,
+    bucket: int,
+    recent_since: Optional[str] = None,
+    page_size: int = 500,
+) -> Iterator[Tuple[int, bool]]:
+    """Постранично отдаёт получателей одного интервала плана в виде (user_id, был ли активен после recent_since)."""
+
+    recent_expr = "u.last_seen >= ?" if recent_since is not None else "0"
+    recent_params: list = [recent_since] if recent_since is not None else []
+    query = f"""
+        SELECT p.user_id, p.position, {recent_expr} AS recent
+        FROM delivery_plan p
+        JOIN users u ON u.user_id = p.user_id
+        WHERE p.mailing_id = ? AND p.bucket = ? AND p.position > ? AND u.is_blocked = 0
+        ORDER BY p.position ASC
+        LIMIT ?
+    """
+
+    last_position = -1
+    while True:
+        with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+            rows = conn.execute(query, [*recent_params, mailing_id, bucket, last_position, page_size]).fetchall()
+
+        for row in rows:
+            yield int(row["user_id"]), bool(row["recent"])
+
+        if len(rows) < page_size:
+            return
+        last_position = int(rows[-1]["position"])
+
+
 def get_admin_users():
     with closing(_get_conn()) as conn:  # type: ignore[call-arg]
         rows = conn.execute(
@@ -153,19 +905,113 @@ def create_mailing(
     from_chat: str,
     message_id: int,
     recipients_count: int,
+    message_ids: Optional[Sequence[int]] = None,
+    scheduled_id: Optional[int] = None,
+    track_clicks: bool = False,
 ) -> int:
     now = datetime.utcnow().isoformat()
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
         cur = conn.execute(
             """
-            INSERT INTO mailings (type, created_at, post_link, from_chat, message_id, recipients_count)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO mailings (
+                type, created_at, post_link, from_chat, message_id, recipients_count, message_ids, scheduled_id,
+                track_clicks
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (mailing_type, now, post_link, from_chat, message_id, recipients_count),
+            (
+                mailing_type,
+                now,
+                post_link,
+                from_chat,
+                message_id,
+                recipients_count,
+                _join_message_ids(message_ids or [message_id]),
+                scheduled_id,
+                int(track_clicks),
+            ),
         )
         return int(cur.lastrowid)
 
 
+def flush_mailing_clicks(clicks: Iterable[Tuple[int, int]]) -> None:
+    """Записывает накопленные клики (mailing_id, user_id) одной транзакцией.
+
+    Повторные клики того же пользователя по той же рассылке игнорируются (PRIMARY KEY),
+    click_count увеличивается на число реально добавленных строк.
+    """
+
+    by_mailing: dict[int, list[int]] = {}
+    for mailing_id, user_id in clicks:
+        by_mailing.setdefault(mailing_id, []).append(user_id)
+    if not by_mailing:
+        return
+
+    now = datetime.utcnow().isoformat()
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        for mailing_id, user_ids in by_mailing.items():
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO mailing_clicks (mailing_id, user_id, clicked_at) VALUES (?, ?, ?)",
+                [(mailing_id, uid, now) for uid in user_ids],
+            )
+            added = conn.total_changes - before
+            if added:
+                conn.execute(
+                    "UPDATE mailings SET click_count = click_count + ? WHERE id = ?",
+                    (added, mailing_id),
+                )
+
+
+def record_mailing_deliveries(mailing_id: int, outcomes: Iterable[Tuple[int, str, Optional[str]]]) -> None:
+    """Записывает пачку итогов доставки (user_id, outcome, класс ошибки) одной транзакцией в БД событий.
+
+    Повторная отправка тому же получателю (проход по временным ошибкам) перезаписывает итог.
+    """
+
+    now = datetime.utcnow().isoformat()
+    rows = [(mailing_id, uid, outcome, error, now) for uid, outcome, error in outcomes]
+    if not rows:
+        return
+    with closing(_get_events_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO mailing_deliveries (mailing_id, user_id, outcome, error, attempted_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+
+
+def purge_mailing_deliveries(before_iso: str, batch_size: int = 5000) -> int:
+    """Удаляет итоги доставки рассылок, созданных раньше before_iso. Возвращает число удалённых строк.
+
+    Удаление идёт короткими транзакциями по batch_size строк, чтобы не держать блокировку записи БД событий.
+    """
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        mailing_ids = [row[0] for row in conn.execute("SELECT id FROM mailings WHERE created_at < ?", (before_iso,))]
+
+    removed = 0
+    with closing(_get_events_conn()) as conn:  # type: ignore[call-arg]
+        for mailing_id in mailing_ids:
+            while True:
+                with conn:
+                    cur = conn.execute(
+                        """
+                        DELETE FROM mailing_deliveries
+                        WHERE mailing_id = ? AND user_id IN (
+                            SELECT user_id FROM mailing_deliveries WHERE mailing_id = ? LIMIT ?
+                        )
+                        """,
+                        (mailing_id, mailing_id, batch_size),
+                    )
+                removed += cur.rowcount
+                if cur.rowcount < batch_size:
+                    break
+    return removed
+
+
 def update_mailing_counters(
     mailing_id: int,
     delivered_delta: int,
@@ -183,22 +1029,281 @@ def update_mailing_counters(
         )
 
 
-def add_webview_event(user_id: int) -> None:
+def save_mailing_content(mailing_id: int, content_json: str) -> None:
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(
+            "UPDATE mailings SET content_json = ? WHERE id = ?",
+            (content_json, mailing_id),
+        )
+
+
+def get_mailing(mailing_id: int) -> Optional[sqlite3.Row]:
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        return conn.execute(
+            """
+            SELECT id, type, recipients_count, track_clicks, delivery_order, delivered_count, error_count
+            FROM mailings
+            WHERE id = ?
+            """,
+            (mailing_id,),
+        ).fetchone()
+
+
+def get_mailing_content(mailing_id: int) -> Optional[str]:
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        row = conn.execute("SELECT content_json FROM mailings WHERE id = ?", (mailing_id,)).fetchone()
+    return row["content_json"] if row is not None else None
+
+
+def save_mailing_delivery_metrics(
+    mailing_id: int,
+    delivery_order: str,
+    active_p50_seconds: Optional[int],
+    active_p90_seconds: Optional[int],
+) -> None:
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(
+            """
+            UPDATE mailings
+            SET delivery_order = ?, active_p50_seconds = ?, active_p90_seconds = ?
+            WHERE id = ?
+            """,
+            (delivery_order, active_p50_seconds, active_p90_seconds, mailing_id),
+        )
+
+
+def add_webview_event(user_id: int, session: Optional[DbSession] = None) -> None:
     now = datetime.utcnow().isoformat()
+    _write(session, "INSERT INTO webview_events (user_id, created_at) VALUES (?, ?)", (user_id, now), events=True)
+
+
+def get_fsm_keys() -> List[str]:
+    with closing(_get_conn()) as conn:
+        return [row["key"] for row in conn.execute("SELECT key FROM fsm_states")]
+
+
+def get_fsm_record(key: str) -> Optional[sqlite3.Row]:
+    with closing(_get_conn()) as conn:
+        return conn.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)).fetchone()
+
+
+def save_fsm_record(key: str, state: Optional[str], data_json: str, updated_at: str) -> None:
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
         conn.execute(
-            "INSERT INTO webview_events (user_id, created_at) VALUES (?, ?)",
-            (user_id, now),
+            """
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """,
+            (key, state, data_json, updated_at),
+        )
+
+
+def delete_fsm_record(key: str) -> None:
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+
+
+def delete_expired_fsm_records(before_iso: str) -> List[str]:
+    """Удаляет состояния FSM, не менявшиеся с before_iso; возвращает их ключи."""
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        return [
+            row["key"] for row in conn.execute("DELETE FROM fsm_states WHERE updated_at < ? RETURNING key", (before_iso,))
+        ]
+
+
+def flush_campaign_counters(starts: dict[str, int], webview_user_ids: Iterable[int]) -> None:
+    """Записывает накопленные счётчики кампаний одной транзакцией.
+
+    starts — число /start по каждому источнику; webview_user_ids — открывшие WebView за период.
+    Конверсия засчитывается один раз на пользователя с источником: флаг converted ставится
+    пачкой UPDATE ... RETURNING source, и возвращённые источники суммируются.
+    """
+
+    now = datetime.utcnow().isoformat()
+    user_ids = list(webview_user_ids)
+    conversions: dict[str, int] = {}
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        for offset in range(0, len(user_ids), 500):
+            chunk = user_ids[offset : offset + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"""
+                UPDATE users SET converted = 1
+                WHERE user_id IN ({placeholders}) AND converted = 0 AND source IS NOT NULL
+                RETURNING source
+                """,
+                chunk,
+            ).fetchall()
+            for row in rows:
+                conversions[row["source"]] = conversions.get(row["source"], 0) + 1
+
+        sources = set(starts) | set(conversions)
+        conn.executemany(
+            """
+            INSERT INTO campaign_stats (source, starts, conversions, first_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (source) DO UPDATE SET
+                starts = starts + excluded.starts,
+                conversions = conversions + excluded.conversions,
+                last_seen = excluded.last_seen
+            """,
+            [(src, starts.get(src, 0), conversions.get(src, 0), now, now) for src in sources],
         )
 
 
-def get_user_stats() -> Tuple[int, int, int, int, int, int]:
+def get_campaign_report(limit: int = 20, use_snapshot: bool = False):
+    """Кампании по числу привлечённых пользователей: (source, users, starts, conversions, last_seen)."""
+
+    with closing(_get_snapshot_conn() if use_snapshot else _get_conn()) as conn:  # type: ignore[call-arg]
+        return conn.execute(
+            """
+            SELECT c.source,
+                   COALESCE(u.users, 0) AS users,
+                   c.starts,
+                   c.conversions,
+                   c.last_seen
+            FROM campaign_stats c
+            LEFT JOIN (
+                SELECT source, COUNT(*) AS users FROM users WHERE source IS NOT NULL GROUP BY source
+            ) u ON u.source = c.source
+            ORDER BY users DESC, c.starts DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+
+
+def _iter_export(sql: str, params: Sequence = (), events: bool = False, chunk_size: int = 1000) -> Iterator[Sequence]:
+    """Построчно отдаёт выгрузку: сначала заголовок (имена колонок), затем строки-кортежи.
+
+    Чтение идёт через отдельное соединение только для чтения: в режиме WAL оно не блокирует запись,
+    а курсор держит в памяти не больше chunk_size строк. events=True — БД событий подключена как схема events.
+    """
+
+    conn = sqlite3.connect(_ro_uri(DB_PATH), uri=True)
+    with closing(conn):
+        if events:
+            conn.execute("ATTACH DATABASE ? AS events", (_ro_uri(EVENTS_DB_PATH),))
+        cur = conn.execute(sql, params)
+        yield [column[0] for column in cur.description]
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield from rows
+
+
+def iter_users_export() -> Iterator[Sequence]:
+    """Пользователи: первый и последний визит, источник, исключение из рассылок и последние ошибки доставки."""
+
+    return _iter_export(
+        """
+        SELECT user_id, is_admin, first_seen, last_seen, source, converted,
+               is_blocked, delivery_failures, last_error, last_error_at
+        FROM users
+        ORDER BY user_id
+        """
+    )
+
+
+def iter_mailings_export() -> Iterator[Sequence]:
+    """Рассылки и их счётчики."""
+
+    return _iter_export(
+        """
+        SELECT id, type, created_at, post_link, scheduled_id, delivery_order,
+               recipients_count, delivered_count, error_count, click_count,
+               active_p50_seconds, active_p90_seconds
+        FROM mailings
+        ORDER BY id
+        """
+    )
+
+
+def iter_mailing_deliveries_export(mailing_id: int) -> Iterator[Sequence]:
+    """Итоги доставки рассылки по получателям и время клика по отслеживаемой кнопке."""
+
+    return _iter_export(
+        """
+        SELECT d.user_id, d.outcome, d.error, d.attempted_at, c.clicked_at
+        FROM events.mailing_deliveries AS d
+        LEFT JOIN mailing_clicks AS c ON c.mailing_id = d.mailing_id AND c.user_id = d.user_id
+        WHERE d.mailing_id = ?
+        ORDER BY d.user_id
+        """,
+        (mailing_id,),
+        events=True,
+    )
+
+
+def iter_cohort_users(
+    since_iso: str,
+    utc_offset_minutes: int,
+    use_snapshot: bool = True,
+    chunk_size: int = 50_000,
+) -> Iterator[list[tuple[int, int, int]]]:
+    """Пачками отдаёт (user_id, день first_seen, день last_seen) пользователей, пришедших после since_iso.
+
+    Дни — номер местного дня от 1970-01-01 (сдвиг utc_offset_minutes); порядок — по user_id.
+    """
+
+    day_shift = utc_offset_minutes / 1440.0
+    with closing(_get_snapshot_conn() if use_snapshot else _get_conn()) as conn:  # type: ignore[call-arg]
+        # Кортежи вместо sqlite3.Row: строк много, и они сразу складываются в массивы
+        conn.row_factory = None
+        cur = conn.execute(
+            """
+            SELECT user_id,
+                   CAST(julianday(first_seen) - 2440587.5 + ? AS INTEGER),
+                   CAST(julianday(last_seen) - 2440587.5 + ? AS INTEGER)
+            FROM users
+            WHERE first_seen >= ?
+            ORDER BY user_id
+            """,
+            (day_shift, day_shift, since_iso),
+        )
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+def iter_cohort_webview_days(
+    since_iso: str,
+    utc_offset_minutes: int,
+    use_snapshot: bool = True,
+    chunk_size: int = 200_000,
+) -> Iterator[list[tuple[int, int]]]:
+    """Пачками отдаёт различные пары (user_id, местный день) открытий WebView после since_iso."""
+
+    day_shift = utc_offset_minutes / 1440.0
+    with closing(_get_snapshot_conn() if use_snapshot else _get_conn_with_events()) as conn:  # type: ignore[call-arg]
+        conn.row_factory = None
+        cur = conn.execute(
+            """
+            SELECT DISTINCT user_id, CAST(julianday(created_at) - 2440587.5 + ? AS INTEGER)
+            FROM events.webview_events
+            WHERE created_at >= ?
+            """,
+            (day_shift, since_iso),
+        )
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+
+def get_user_stats(use_snapshot: bool = False) -> Tuple[int, int, int, int, int, int]:
     now = datetime.utcnow()
     day_ago = (now - timedelta(days=1)).isoformat()
     week_ago = (now - timedelta(days=7)).isoformat()
     month_ago = (now - timedelta(days=30)).isoformat()
 
-    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+    with closing(_get_snapshot_conn() if use_snapshot else _get_conn()) as conn:  # type: ignore[call-arg]
         total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
         new_24h = conn.execute(
             "SELECT COUNT(*) FROM users WHERE first_seen >= ?",
@@ -223,11 +1328,12 @@ def get_user_stats() -> Tuple[int, int, int, int, int, int]:
     return int(total), int(new_24h), int(active_24h), int(active_7d), int(active_30d), int(blocked)
 
 
-def get_recent_mailings(limit: int = 5) -> Iterable[sqlite3.Row]:
-    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+def get_recent_mailings(limit: int = 5, use_snapshot: bool = False) -> Iterable[sqlite3.Row]:
+    with closing(_get_snapshot_conn() if use_snapshot else _get_conn()) as conn:  # type: ignore[call-arg]
         rows = conn.execute(
             """
-            SELECT id, type, created_at, recipients_count, delivered_count, error_count
+            SELECT id, type, created_at, recipients_count, delivered_count, error_count,
+                   track_clicks, click_count
             FROM mailings
             ORDER BY id DESC
             LIMIT ?
@@ -244,6 +1350,9 @@ def create_scheduled_mailing(
     message_id: int,
     admin_chat_id: int,
     scheduled_at_iso: str,
+    message_ids: Optional[Sequence[int]] = None,
+    recurrence: Optional[str] = None,
+    track_clicks: bool = False,
 ) -> int:
     now = datetime.utcnow().isoformat()
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
@@ -251,31 +1360,135 @@ def create_scheduled_mailing(
             """
             INSERT INTO scheduled_mailings (
                 mailing_type, post_link, from_chat, message_id,
-                admin_chat_id, scheduled_at, created_at
+                admin_chat_id, scheduled_at, created_at, message_ids,
+                recurrence, next_run_at, track_clicks
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (mailing_type, post_link, from_chat, message_id, admin_chat_id, scheduled_at_iso, now),
+            (
+                mailing_type,
+                post_link,
+                from_chat,
+                message_id,
+                admin_chat_id,
+                scheduled_at_iso,
+                now,
+                _join_message_ids(message_ids or [message_id]),
+                recurrence,
+                scheduled_at_iso,
+                int(track_clicks),
+            ),
         )
         return int(cur.lastrowid)
 
 
-def get_due_scheduled_mailings(now_iso: str) -> Iterable[sqlite3.Row]:
-    """Возвращает запланированные рассылки, время которых уже наступило."""
+def get_due_scheduled_mailings(now_iso: str, limit: int = 1) -> Iterable[sqlite3.Row]:
+    """Возвращает запланированные рассылки, время которых уже наступило (самые ранние первыми).
+
+    По умолчанию — только одну, ближайшую: выборка идёт по индексу (status, next_run_at),
+    правила повторения при этом не разворачиваются.
+    """
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        rows = conn.execute(
+            """
+            SELECT id, mailing_type, post_link, from_chat, message_id, message_ids, admin_chat_id,
+                   scheduled_at, recurrence, next_run_at, track_clicks, prepared_mailing_id, prepared_for
+            FROM scheduled_mailings
+            WHERE status = 'pending' AND next_run_at <= ?
+            ORDER BY next_run_at ASC
+            LIMIT ?
+            """,
+            (now_iso, limit),
+        ).fetchall()
+    return rows
+
+
+def get_scheduled_mailings_to_warm_up(until_iso: str, limit: int = 1) -> Iterable[sqlite3.Row]:
+    """Ожидающие задачи, срабатывающие не позже until_iso и ещё не подготовленные к этому срабатыванию."""
 
     with closing(_get_conn()) as conn:  # type: ignore[call-arg]
         rows = conn.execute(
             """
-            SELECT id, mailing_type, post_link, from_chat, message_id, admin_chat_id, scheduled_at
+            SELECT id, mailing_type, post_link, from_chat, message_id, message_ids, admin_chat_id,
+                   next_run_at, track_clicks, prepared_mailing_id, prepared_for
             FROM scheduled_mailings
-            WHERE status = 'pending' AND scheduled_at <= ?
-            ORDER BY scheduled_at ASC, id ASC
+            WHERE status = 'pending' AND next_run_at <= ?
+              AND (prepared_for IS NULL OR prepared_for != next_run_at)
+            ORDER BY next_run_at ASC
+            LIMIT ?
             """,
-            (now_iso,),
+            (until_iso, limit),
         ).fetchall()
     return rows
 
 
+def save_scheduled_warmup(
+    scheduled_id: int,
+    prepared_for: str,
+    prepared_mailing_id: Optional[int] = None,
+    error: Optional[str] = None,
+) -> bool:
+    """Записывает итог подготовки; False — задача уже не ожидает запуска (например, её отменили во время подготовки)."""
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        cur = conn.execute(
+            """
+            UPDATE scheduled_mailings
+            SET prepared_for = ?, prepared_mailing_id = ?, warmup_error = ?
+            WHERE id = ? AND status = 'pending'
+            """,
+            (prepared_for, prepared_mailing_id, error, scheduled_id),
+        )
+        return cur.rowcount > 0
+
+
+def get_prepared_mailing_id(scheduled_id: int) -> Optional[int]:
+    """Подготовленная заранее рассылка ожидающей задачи (None — не подготовлена или уже запускается)."""
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        row = conn.execute(
+            """
+            SELECT prepared_mailing_id
+            FROM scheduled_mailings
+            WHERE id = ? AND status = 'pending' AND prepared_for = next_run_at
+            """,
+            (scheduled_id,),
+        ).fetchone()
+    return int(row[0]) if row is not None and row[0] is not None else None
+
+
+def get_next_scheduled_run_at() -> Optional[str]:
+    """Время ближайшего срабатывания среди ожидающих задач (или None)."""
+
+    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+        row = conn.execute(
+            """
+            SELECT next_run_at
+            FROM scheduled_mailings
+            WHERE status = 'pending'
+            ORDER BY next_run_at ASC
+            LIMIT 1
+            """
+        ).fetchone()
+    return row["next_run_at"] if row is not None else None
+
+
+def reschedule_recurring_mailing(mailing_id: int, next_run_at_iso: str, last_run_at_iso: str) -> None:
+    """Переносит повторяющуюся рассылку на следующее срабатывание (если её не отменили во время отправки)."""
+
+    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
+        conn.execute(
+            """
+            UPDATE scheduled_mailings
+            SET status = 'pending', next_run_at = ?, last_run_at = ?,
+                prepared_mailing_id = NULL, prepared_for = NULL, warmup_error = NULL
+            WHERE id = ? AND status = 'processing'
+            """,
+            (next_run_at_iso, last_run_at_iso, mailing_id),
+        )
+
+
 def update_scheduled_mailing_status(mailing_id: int, status: str) -> None:
     with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
         conn.execute(
@@ -291,7 +1504,8 @@ def get_scheduled_mailings(limit: int = 10) -> Iterable[sqlite3.Row]:
         rows = conn.execute(
             """
             SELECT id, mailing_type, post_link, from_chat, message_id,
-                   admin_chat_id, scheduled_at, created_at, status
+                   admin_chat_id, scheduled_at, created_at, status,
+                   recurrence, next_run_at, last_run_at, prepared_for, warmup_error
             FROM scheduled_mailings
             ORDER BY scheduled_at DESC, id DESC
             LIMIT ?
@@ -301,23 +1515,74 @@ def get_scheduled_mailings(limit: int = 10) -> Iterable[sqlite3.Row]:
     return rows
 
 
-def save_channel_post(chat_id: str, message_id: int, text_preview: str | None) -> None:
+def save_channel_post(
+    chat_id: str,
+    message_id: int,
+    text_preview: str | None,
+    media_group_id: str | None = None,
+    session: Optional[DbSession] = None,
+) -> None:
+    """Сохраняет пост канала. Сообщения одного альбома склеиваются в одну запись по media_group_id."""
+
     now = datetime.utcnow().isoformat()
-    with closing(_get_conn()) as conn, conn:  # type: ignore[call-arg]
-        conn.execute(
-            """
-            INSERT INTO channel_posts (chat_id, message_id, created_at, text_preview)
-            VALUES (?, ?, ?, ?)
-            """,
-            (chat_id, message_id, now, text_preview),
-        )
+    _write(
+        session,
+        """
+        INSERT INTO channel_posts (chat_id, message_id, created_at, text_preview, media_group_id, message_ids)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chat_id, media_group_id) DO UPDATE SET
+            message_id = MIN(message_id, excluded.message_id),
+            message_ids = message_ids || ',' || excluded.message_ids,
+            text_preview = COALESCE(text_preview, excluded.text_preview)
+        """,
+        (chat_id, message_id, now, text_preview, media_group_id, str(message_id)),
+        events=True,
+    )
+
+
+def save_channel_post_content(
+    chat_id: str,
+    message_id: int,
+    payload_json: Optional[str],
+    session: Optional[DbSession] = None,
+) -> None:
+    """Сохраняет (или обновляет после редактирования) содержимое сообщения канала для рассылок."""
+
+    now = datetime.utcnow().isoformat()
+    _write(
+        session,
+        """
+        INSERT INTO channel_post_content (chat_id, message_id, payload, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id, message_id) DO UPDATE SET payload = excluded.payload, updated_at = excluded.updated_at
+        """,
+        (chat_id, message_id, payload_json, now),
+        events=True,
+    )
+
+
+def get_channel_post_content(chat_id: str, message_ids: Sequence[int]) -> dict[int, Optional[str]]:
+    """Сохранённое содержимое сообщений канала: message_id -> payload (None — тип не поддерживается).
+
+    Сообщений, которых нет в таблице, нет и в результате.
+    """
+
+    if not message_ids:
+        return {}
+    placeholders = ",".join("?" * len(message_ids))
+    with closing(_get_events_conn()) as conn:  # type: ignore[call-arg]
+        rows = conn.execute(
+            f"SELECT message_id, payload FROM channel_post_content WHERE chat_id = ? AND message_id IN ({placeholders})",
+            (chat_id, *message_ids),
+        ).fetchall()
+    return {int(row["message_id"]): row["payload"] for row in rows}
 
 
 def get_recent_channel_posts(limit: int = 10) -> Iterable[sqlite3.Row]:
-    with closing(_get_conn()) as conn:  # type: ignore[call-arg]
+    with closing(_get_events_conn()) as conn:  # type: ignore[call-arg]
         rows = conn.execute(
             """
-            SELECT id, chat_id, message_id, created_at, text_preview
+            SELECT id, chat_id, message_id, message_ids, created_at, text_preview
             FROM channel_posts
             ORDER BY id DESC
             LIMIT ?
@@ -0,0 +1,72 @@
+from typing import Any, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+from config import (
+    BOT_TOKEN,
+    DELIVERY_DNS_TTL_SECONDS,
+    DELIVERY_KEEPALIVE_SECONDS,
+    DELIVERY_POOL_SIZE,
+    DELIVERY_TIMEOUT_SECONDS,
+    TELEGRAM_API_BASE,
+)
+from outbound import BROADCAST, INTERACTIVE, outbound_scheduler
+
+
+def get_api_server(base: Optional[str] = None) -> TelegramAPIServer:
+    """Адрес Bot API: боевой сервер или локальная замена из TELEGRAM_API_BASE."""
+
+    base = TELEGRAM_API_BASE if base is None else base
+    if not base:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(base)
+
+
+class DeliverySession(AiohttpSession):
+    """aiohttp-сессия для массовой отправки с собственным пулом соединений.
+
+    Настраиваются размер пула, keep-alive простаивающих соединений, кэш DNS и таймаут запросов.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DELIVERY_POOL_SIZE,
+        keepalive_seconds: float = DELIVERY_KEEPALIVE_SECONDS,
+        dns_ttl_seconds: int = DELIVERY_DNS_TTL_SECONDS,
+        timeout_seconds: float = DELIVERY_TIMEOUT_SECONDS,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(limit=pool_size, timeout=timeout_seconds, **kwargs)
+        self._connector_init.update(
+            {
+                # Все запросы идут на один хост, поэтому ограничение на хост совпадает с общим
+                "limit_per_host": pool_size,
+                "keepalive_timeout": keepalive_seconds,
+                "use_dns_cache": True,
+                "ttl_dns_cache": dns_ttl_seconds,
+            }
+        )
+
+
+def create_bot(api_base: Optional[str] = None) -> Bot:
+    """Бот для long polling и ответов пользователям (стандартная сессия aiogram).
+
+    Его отправки идут через общий планировщик с приоритетом INTERACTIVE.
+    """
+
+    session = AiohttpSession(api=get_api_server(api_base))
+    session.middleware(outbound_scheduler.middleware(INTERACTIVE))
+    return Bot(token=BOT_TOKEN, session=session)
+
+
+def create_delivery_bot(api_base: Optional[str] = None, **session_kwargs: Any) -> Bot:
+    """Отдельный клиент для рассылок: тот же токен, но свой пул соединений и таймауты.
+
+    Отправки рассылок делят с ответами общий лимит Telegram, но уступают им очередь (приоритет BROADCAST).
+    """
+
+    session = DeliverySession(api=get_api_server(api_base), **session_kwargs)
+    session.middleware(outbound_scheduler.middleware(BROADCAST))
+    return Bot(token=BOT_TOKEN, session=session)
@@ -0,0 +1,86 @@
+import asyncio
+import csv
+import gzip
+import io
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+from db import iter_mailing_deliveries_export, iter_mailings_export, iter_users_export
+
+
+# Предел размера документа, который бот может отправить через Bot API
+MAX_EXPORT_BYTES = 50 * 1024 * 1024
+# Степень сжатия gzip: 6 — почти как 9 по размеру, но заметно быстрее
+GZIP_LEVEL = 6
+
+# Одновременно строится не больше одной выгрузки
+_export_lock = asyncio.Lock()
+
+
+def is_exporting() -> bool:
+    return _export_lock.locked()
+
+
+@dataclass
+class Export:
+    path: str
+    filename: str
+    rows: int
+    size: int
+
+
+def write_csv_gz(rows: Iterable[Sequence], fileobj: io.BufferedIOBase) -> int:
+    """Построчно пишет rows в fileobj как CSV, сжатый gzip. Возвращает число строк без заголовка.
+
+    В памяти одновременно только одна строка и буферы gzip, поэтому расход памяти не зависит от размера выгрузки.
+    """
+
+    count = -1
+    with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=GZIP_LEVEL) as gz:
+        with io.TextIOWrapper(gz, encoding="utf-8", newline="") as text:
+            writer = csv.writer(text)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    return max(count, 0)
+
+
+def _build(name: str, rows: Callable[[], Iterator[Sequence]]) -> Export:
+    filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv.gz"
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".csv.gz")
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            count = write_csv_gz(rows(), raw)
+    except BaseException:
+        os.remove(path)
+        raise
+    return Export(path=path, filename=filename, rows=count, size=os.path.getsize(path))
+
+
+async def build_export(kind: str, mailing_id: Optional[int] = None) -> Export:
+    """Строит выгрузку во временный файл в отдельном потоке; файл удаляет вызывающий (remove_export).
+
+    kind: users — пользователи, mailings — рассылки со счётчиками, deliveries — итоги доставки рассылки mailing_id.
+    """
+
+    if kind == "users":
+        name, rows = "users", iter_users_export
+    elif kind == "mailings":
+        name, rows = "mailings", iter_mailings_export
+    elif kind == "deliveries" and mailing_id is not None:
+        name, rows = f"mailing_{mailing_id}_deliveries", lambda: iter_mailing_deliveries_export(mailing_id)
+    else:
+        raise ValueError(f"Неизвестная выгрузка: {kind}")
+
+    async with _export_lock:
+        return await asyncio.to_thread(_build, name, rows)
+
+
+def remove_export(export: Export) -> None:
+    try:
+        os.remove(export.path)
+    except FileNotFoundError:
+        pass
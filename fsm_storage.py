@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from config import FSM_CACHE_SIZE, FSM_STATE_TTL_SECONDS
+from db import delete_expired_fsm_records, delete_fsm_record, get_fsm_keys, get_fsm_record, save_fsm_record
+from logger_utils import log_error
+
+
+@dataclass
+class _Record:
+    state: Optional[str]
+    data: Dict[str, Any] = field(default_factory=dict)
+    # time.time() последнего изменения — от него отсчитывается TTL
+    updated_at: float = 0.0
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в таблице fsm_states с кэшем в памяти процесса.
+
+    - Хранятся только непустые состояния; их ключи целиком держатся в памяти (_keys), поэтому
+      пользователь без состояния (обычный /start с state.clear()) не вызывает ни чтения, ни записи в БД.
+    - Записи сквозные: состояние сразу пишется в БД и переживает перезапуск бота.
+    - Прочитанные записи кэшируются в LRU на FSM_CACHE_SIZE ключей.
+    - Состояние без изменений дольше FSM_STATE_TTL_SECONDS считается брошенным: при чтении оно пустое,
+      а fsm_cleanup_worker удаляет такие записи из БД.
+
+    Ключи загружаются при первом обращении, отдельно в каждом процессе: в режиме вебхука
+    с несколькими процессами апдейты пользователя всегда обрабатывает один и тот же процесс.
+    """
+
+    def __init__(
+        self,
+        cache_size: int = FSM_CACHE_SIZE,
+        ttl_seconds: int = FSM_STATE_TTL_SECONDS,
+        key_builder: Optional[KeyBuilder] = None,
+    ) -> None:
+        self.cache_size = max(1, cache_size)
+        self.ttl_seconds = ttl_seconds
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._keys: Optional[set[str]] = None
+        self._cache: "OrderedDict[str, _Record]" = OrderedDict()
+
+    def _known_keys(self) -> set[str]:
+        if self._keys is None:
+            self._keys = set(get_fsm_keys())
+        return self._keys
+
+    def _expired(self, record: _Record, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - record.updated_at > self.ttl_seconds
+
+    def _remember(self, name: str, record: _Record) -> None:
+        self._cache[name] = record
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _forget(self, name: str) -> None:
+        self._known_keys().discard(name)
+        self._cache.pop(name, None)
+
+    def _load(self, key: StorageKey) -> Optional[_Record]:
+        name = self.key_builder.build(key)
+        if name not in self._known_keys():
+            return None
+
+        record = self._cache.get(name)
+        if record is not None:
+            self._cache.move_to_end(name)
+        else:
+            row = get_fsm_record(name)
+            if row is None:
+                # Запись удалил другой процесс (очистка по TTL)
+                self._forget(name)
+                return None
+            record = _Record(
+                state=row["state"],
+                data=json.loads(row["data"]),
+                updated_at=datetime.fromisoformat(row["updated_at"]).replace(tzinfo=timezone.utc).timestamp(),
+            )
+            self._remember(name, record)
+
+        if self._expired(record, time.time()):
+            self._forget(name)
+            delete_fsm_record(name)
+            return None
+        return record
+
+    def _store(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]) -> None:
+        name = self.key_builder.build(key)
+        if state is None and not data:
+            if name in self._known_keys():
+                self._forget(name)
+                delete_fsm_record(name)
+            return
+
+        now = time.time()
+        save_fsm_record(
+            name,
+            state,
+            json.dumps(data, ensure_ascii=False),
+            datetime.utcfromtimestamp(now).isoformat(),
+        )
+        self._known_keys().add(name)
+        self._remember(name, _Record(state=state, data=data, updated_at=now))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._load(key)
+        state_name = state.state if isinstance(state, State) else state
+        self._store(key, state_name, record.data if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._load(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        record = self._load(key)
+        self._store(key, record.state if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._load(key)
+        return dict(record.data) if record else {}
+
+    async def close(self) -> None:
+        self._cache.clear()
+        self._keys = None
+
+    def purge_expired(self) -> int:
+        """Удаляет из БД брошенные состояния (старше TTL). Возвращает число удалённых."""
+
+        if self.ttl_seconds <= 0:
+            return 0
+        before = datetime.utcfromtimestamp(time.time() - self.ttl_seconds).isoformat()
+        removed = delete_expired_fsm_records(before)
+        for name in removed:
+            self._forget(name)
+        return len(removed)
+
+
+fsm_storage = SQLiteStorage()
+
+
+async def fsm_cleanup_worker() -> None:
+    """Фоновая задача, удаляющая брошенные состояния FSM."""
+
+    if fsm_storage.ttl_seconds <= 0:
+        return
+    interval = min(fsm_storage.ttl_seconds, 3600)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = fsm_storage.purge_expired()
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="fsm_cleanup_worker",
+                message="Ошибка при удалении устаревших состояний FSM",
+                exc=e,
+            )
+        else:
+            if removed:
+                logging.info("Удалено устаревших состояний FSM: %s", removed)
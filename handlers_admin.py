@@ -1,19 +1,57 @@
+import asyncio
+import html
+import logging
+
 from aiogram import Router, F, types
-from aiogram.filters import StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery
-
-from config import is_admin
+from aiogram.types import BufferedInputFile, CallbackQuery, FSInputFile
+
+from cohorts import get_cohort_report
+from config import (
+    ANALYTICS_BACKUP_PAGES,
+    ANALYTICS_SNAPSHOT_SECONDS,
+    DB_CHECKPOINT_SECONDS,
+    MAILING_DELIVERIES_PURGE_SECONDS,
+    MAILING_DELIVERIES_RETENTION_DAYS,
+    is_admin,
+)
 from constants import ADMIN_CMD_STATS_TEXT, ADMIN_CMD_SCHEDULED_TEXT, ADMIN_CMD_PANEL_TEXT
-from datetime import datetime
-
-from db import get_user_stats, get_recent_mailings, get_scheduled_mailings, update_scheduled_mailing_status
+from datetime import datetime, timedelta
+
+from db import (
+    checkpoint_databases,
+    discard_prepared_mailing,
+    get_analytics_snapshot_time,
+    get_prepared_mailing_id,
+    get_campaign_report,
+    get_user_stats,
+    get_recent_mailings,
+    get_scheduled_mailings,
+    update_scheduled_mailing_status,
+    refresh_analytics_snapshot,
+    purge_mailing_deliveries,
+)
+from exports import MAX_EXPORT_BYTES, build_export, is_exporting, remove_export
 from keyboards import build_admin_menu_markup
+from logger_utils import log_error
+from profiling import MAX_PROFILE_SECONDS, is_profiling, profile_cpu, profile_memory
+from recurrence import parse_rule
 from states import AdminStates
 
 
 router = Router()
 
+# Предел длины текста одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+def _snapshot_note() -> str:
+    snapshot_time = get_analytics_snapshot_time()
+    if snapshot_time is None:
+        return "Данные: рабочая БД (снимок аналитики ещё не готов)."
+    return f"Данные на {snapshot_time.strftime('%d.%m.%Y %H:%M')} (снимок обновляется раз в {ANALYTICS_SNAPSHOT_SECONDS // 60} мин)."
+
 
 @router.callback_query(F.data == "open_admin")
 async def cb_open_admin(callback: CallbackQuery, state: FSMContext) -> None:
@@ -62,11 +100,17 @@ async def cb_admin_scheduled_mailings(callback: CallbackQuery) -> None:
     pending_buttons = []
 
     for index, row in enumerate(rows, start=1):
+        # Для повторяющихся рассылок показываем ближайшее срабатывание
+        when_iso = row["next_run_at"] or row["scheduled_at"]
         try:
-            scheduled_dt = datetime.fromisoformat(row["scheduled_at"])
+            scheduled_dt = datetime.fromisoformat(when_iso)
             scheduled_human = scheduled_dt.strftime("%d.%m.%Y %H:%M")
         except Exception:
-            scheduled_human = row["scheduled_at"]
+            scheduled_human = when_iso
+
+        recurrence = parse_rule(row["recurrence"]) if row["recurrence"] else None
+        if recurrence is not None:
+            scheduled_human = f"{scheduled_human} ({recurrence.describe()})"
 
         mtype = row["mailing_type"]
         if mtype == "news":
@@ -83,6 +127,12 @@ async def cb_admin_scheduled_mailings(callback: CallbackQuery) -> None:
         status_code = row["status"]
         if status_code == "pending":
             status_label = "ожидает отправки"
+            # Результат предварительной подготовки к ближайшему срабатыванию
+            if row["prepared_for"] is not None and row["prepared_for"] == row["next_run_at"]:
+                if row["warmup_error"]:
+                    status_label += f", не готова: {row['warmup_error']}"
+                else:
+                    status_label += ", подготовлена"
         elif status_code == "processing":
             status_label = "в процессе"
         elif status_code == "done":
@@ -141,11 +191,17 @@ async def admin_menu_scheduled_mailings(message: types.Message) -> None:
     pending_buttons = []
 
     for index, row in enumerate(rows, start=1):
+        # Для повторяющихся рассылок показываем ближайшее срабатывание
+        when_iso = row["next_run_at"] or row["scheduled_at"]
         try:
-            scheduled_dt = datetime.fromisoformat(row["scheduled_at"])
+            scheduled_dt = datetime.fromisoformat(when_iso)
             scheduled_human = scheduled_dt.strftime("%d.%m.%Y %H:%M")
         except Exception:
-            scheduled_human = row["scheduled_at"]
+            scheduled_human = when_iso
+
+        recurrence = parse_rule(row["recurrence"]) if row["recurrence"] else None
+        if recurrence is not None:
+            scheduled_human = f"{scheduled_human} ({recurrence.describe()})"
 
         mtype = row["mailing_type"]
         if mtype == "news":
@@ -162,6 +218,12 @@ async def admin_menu_scheduled_mailings(message: types.Message) -> None:
         status_code = row["status"]
         if status_code == "pending":
             status_label = "ожидает отправки"
+            # Результат предварительной подготовки к ближайшему срабатыванию
+            if row["prepared_for"] is not None and row["prepared_for"] == row["next_run_at"]:
+                if row["warmup_error"]:
+                    status_label += f", не готова: {row['warmup_error']}"
+                else:
+                    status_label += ", подготовлена"
         elif status_code == "processing":
             status_label = "в процессе"
         elif status_code == "done":
@@ -212,7 +274,11 @@ async def cb_admin_cancel_scheduled(callback: CallbackQuery) -> None:
         await callback.answer("Не удалось распознать рассылку. Попробуйте обновить список.", show_alert=True)
         return
 
+    # Рассылка могла быть уже подготовлена заранее — удаляем её вместе с зафиксированным списком получателей
+    prepared_mailing_id = get_prepared_mailing_id(mailing_id)
     update_scheduled_mailing_status(mailing_id, "cancelled")
+    if prepared_mailing_id is not None:
+        discard_prepared_mailing(prepared_mailing_id)
     await callback.answer("Запланированная рассылка отменена.", show_alert=True)
 
 
@@ -223,9 +289,10 @@ async def cb_admin_show_stats(callback: CallbackQuery) -> None:
         await callback.answer("Нет доступа", show_alert=True)
         return
 
-    total, new_24h, active_24h, active_7d, active_30d, blocked = get_user_stats()
+    # Тяжёлые агрегаты читаем из снимка аналитики, а не из рабочей БД
+    total, new_24h, active_24h, active_7d, active_30d, blocked = get_user_stats(use_snapshot=True)
 
-    mailings_rows = list(get_recent_mailings(limit=5))
+    mailings_rows = list(get_recent_mailings(limit=5, use_snapshot=True))
 
     text_lines = [
         "📊 Статистика аудитории:",
@@ -254,12 +321,17 @@ async def cb_admin_show_stats(callback: CallbackQuery) -> None:
             else:
                 type_label = row["type"]
 
-            text_lines.append(
-                (
-                    f"{index}. {type_label}: доставлено {row['delivered_count']} из {row['recipients_count']}, "
-                    f"ошибок: {row['error_count']}"
-                )
+            line = (
+                f"{index}. {type_label}: доставлено {row['delivered_count']} из {row['recipients_count']}, "
+                f"ошибок: {row['error_count']}"
             )
+            if row["track_clicks"]:
+                ctr = row["click_count"] / row["delivered_count"] * 100 if row["delivered_count"] else 0.0
+                line += f", кликов: {row['click_count']} (CTR {ctr:.1f}%)"
+            text_lines.append(line)
+
+    text_lines.append("")
+    text_lines.append(_snapshot_note())
 
     await callback.message.answer("\n".join(text_lines))
     await callback.answer()
@@ -271,9 +343,10 @@ async def admin_menu_show_stats(message: types.Message) -> None:
     if not is_admin(user_id):
         return
 
-    total, new_24h, active_24h, active_7d, active_30d, blocked = get_user_stats()
+    # Тяжёлые агрегаты читаем из снимка аналитики, а не из рабочей БД
+    total, new_24h, active_24h, active_7d, active_30d, blocked = get_user_stats(use_snapshot=True)
 
-    mailings_rows = list(get_recent_mailings(limit=5))
+    mailings_rows = list(get_recent_mailings(limit=5, use_snapshot=True))
 
     text_lines = [
         "📊 Статистика аудитории:",
@@ -302,11 +375,285 @@ async def admin_menu_show_stats(message: types.Message) -> None:
             else:
                 type_label = row["type"]
 
-            text_lines.append(
-                (
-                    f"{index}. {type_label}: доставлено {row['delivered_count']} из {row['recipients_count']}, "
-                    f"ошибок: {row['error_count']}"
-                )
+            line = (
+                f"{index}. {type_label}: доставлено {row['delivered_count']} из {row['recipients_count']}, "
+                f"ошибок: {row['error_count']}"
             )
+            if row["track_clicks"]:
+                ctr = row["click_count"] / row["delivered_count"] * 100 if row["delivered_count"] else 0.0
+                line += f", кликов: {row['click_count']} (CTR {ctr:.1f}%)"
+            text_lines.append(line)
+
+    text_lines.append("")
+    text_lines.append(_snapshot_note())
 
     await message.answer("\n".join(text_lines))
+
+
+@router.callback_query(F.data == "admin_campaigns")
+async def cb_admin_campaigns(callback: CallbackQuery) -> None:
+    user_id = callback.from_user.id
+    if not is_admin(user_id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    rows = get_campaign_report(limit=20, use_snapshot=True)
+
+    if not rows:
+        await callback.message.answer(
+            "Пока нет переходов по рекламным ссылкам.\n"
+            "Ссылка кампании: https://t.me/<username_бота>?start=<метка> (метка: латиница, цифры, _ и -)."
+        )
+        await callback.answer()
+        return
+
+    text_lines = ["📣 Кампании (первое касание):"]
+    for index, row in enumerate(rows, start=1):
+        users = row["users"]
+        conversion = f"{row['conversions'] / users * 100:.1f}%" if users else "—"
+        text_lines.append(
+            (
+                f"{index}. {row['source']}: новых {users}, запусков /start {row['starts']}, "
+                f"открыли WebView {row['conversions']} ({conversion})"
+            )
+        )
+
+    text_lines.append("")
+    text_lines.append(_snapshot_note())
+
+    await callback.message.answer("\n".join(text_lines))
+    await callback.answer()
+
+
+def _truncate_lines(text: str, limit: int) -> str:
+    """Обрезает текст по границе строк так, чтобы он уместился в limit символов."""
+
+    if len(text) <= limit:
+        return text
+    lines: list[str] = []
+    size = 0
+    for line in text.splitlines():
+        if size + len(line) + 1 > limit - 2:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    lines.append("…")
+    return "\n".join(lines)
+
+
+@router.callback_query(F.data == "admin_cohorts")
+async def cb_admin_cohorts(callback: CallbackQuery) -> None:
+    user_id = callback.from_user.id
+    if not is_admin(user_id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    await callback.answer("Считаю когорты...")
+    try:
+        report = await get_cohort_report()
+    except Exception as e:
+        log_error(
+            user_id=user_id,
+            context="admin_cohorts",
+            message="Не удалось построить отчёт по когортам",
+            exc=e,
+        )
+        await callback.message.answer("Не удалось построить отчёт по когортам, подробности в логе.")
+        return
+
+    # Таблица выровнена пробелами — отправляем моноширинным блоком, иначе колонки расползаются
+    header = "📈 Удержание по недельным когортам (доля активных в неделю N после прихода, WebV — открыли WebView):"
+    footer = html.escape(_snapshot_note())
+    table = _truncate_lines(html.escape(report.to_table()), MESSAGE_LIMIT - len(header) - len(footer) - 20)
+    await callback.message.answer(f"{header}\n\n<pre>{table}</pre>\n\n{footer}", parse_mode="HTML")
+
+    filename = f"cohorts_{report.generated_at.strftime('%Y%m%d')}.csv"
+    await callback.message.answer_document(
+        BufferedInputFile(report.to_csv().encode("utf-8"), filename=filename),
+        caption=f"Полная матрица удержания за {report.weeks} недель",
+    )
+
+
+PROFILE_USAGE_TEXT = (
+    "Использование:\n"
+    "/profile cpu 30 — сэмплирующий CPU-профиль на 30 секунд\n"
+    "/profile mem 30 — снимок памяти (tracemalloc) за 30 секунд\n"
+    f"Длительность: от 1 до {MAX_PROFILE_SECONDS} секунд."
+)
+
+
+@router.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: CommandObject) -> None:
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        return
+
+    parts = (command.args or "").split()
+    mode = parts[0].lower() if parts else ""
+    if mode not in ("cpu", "mem") or len(parts) > 2:
+        await message.answer(PROFILE_USAGE_TEXT)
+        return
+
+    seconds = 30
+    if len(parts) == 2:
+        if not parts[1].isdigit() or not 1 <= int(parts[1]) <= MAX_PROFILE_SECONDS:
+            await message.answer(PROFILE_USAGE_TEXT)
+            return
+        seconds = int(parts[1])
+
+    if is_profiling():
+        await message.answer("Профилирование уже выполняется, дождитесь результата.")
+        return
+
+    label = "CPU-профиль" if mode == "cpu" else "снимок памяти"
+    await message.answer(f"Снимаю {label} в течение {seconds} с...")
+
+    try:
+        if mode == "cpu":
+            report, summary = await profile_cpu(seconds)
+        else:
+            report, summary = await profile_memory(seconds)
+    except Exception as e:
+        log_error(
+            user_id=user_id,
+            context="profile",
+            message="Не удалось выполнить профилирование",
+            exc=e,
+        )
+        await message.answer("Не удалось выполнить профилирование, подробности в логе.")
+        return
+
+    filename = f"{mode}_profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    await message.answer_document(
+        BufferedInputFile(report.encode("utf-8"), filename=filename),
+        caption=summary[:1024],
+    )
+
+
+EXPORT_USAGE_TEXT = (
+    "Использование:\n"
+    "/export users — пользователи: первый и последний визит, источник, исключение из рассылок\n"
+    "/export mailings — рассылки и их счётчики\n"
+    "/export deliveries 123 — итоги доставки рассылки 123 по получателям\n"
+    "Файл — CSV, сжатый gzip."
+)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject) -> None:
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        return
+
+    parts = (command.args or "").split()
+    kind = parts[0].lower() if parts else ""
+    mailing_id = None
+    if kind in ("users", "mailings") and len(parts) == 1:
+        pass
+    elif kind == "deliveries" and len(parts) == 2 and parts[1].isdigit():
+        mailing_id = int(parts[1])
+    else:
+        await message.answer(EXPORT_USAGE_TEXT)
+        return
+
+    if is_exporting():
+        await message.answer("Выгрузка уже выполняется, дождитесь результата.")
+        return
+
+    await message.answer("Готовлю выгрузку...")
+    try:
+        export = await build_export(kind, mailing_id)
+    except Exception as e:
+        log_error(
+            user_id=user_id,
+            context="export",
+            message=f"Не удалось построить выгрузку {kind}",
+            exc=e,
+        )
+        await message.answer("Не удалось построить выгрузку, подробности в логе.")
+        return
+
+    try:
+        if kind == "deliveries" and not export.rows:
+            await message.answer(f"Нет итогов доставки для рассылки id={mailing_id}.")
+            return
+        if export.size > MAX_EXPORT_BYTES:
+            await message.answer(
+                f"Выгрузка слишком большая для отправки ботом: {export.size / 1024 / 1024:.1f} МБ "
+                f"(предел {MAX_EXPORT_BYTES // 1024 // 1024} МБ)."
+            )
+            return
+        await message.answer_document(
+            FSInputFile(export.path, filename=export.filename),
+            caption=f"Строк: {export.rows}, {export.size / 1024:.0f} КБ",
+        )
+    finally:
+        remove_export(export)
+
+
+async def analytics_snapshot_worker() -> None:
+    """Фоновая задача, периодически обновляющая снимок БД для аналитики админки."""
+
+    while True:
+        try:
+            seconds = await asyncio.to_thread(refresh_analytics_snapshot, ANALYTICS_BACKUP_PAGES)
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="analytics_snapshot_worker",
+                message="Ошибка при обновлении снимка аналитики",
+                exc=e,
+            )
+        else:
+            logging.info("Снимок аналитики обновлён за %.2f с", seconds)
+
+        await asyncio.sleep(ANALYTICS_SNAPSHOT_SECONDS)
+
+
+async def mailing_deliveries_purge_worker() -> None:
+    """Фоновая задача, удаляющая из БД событий итоги доставки рассылок старше MAILING_DELIVERIES_RETENTION_DAYS."""
+
+    if MAILING_DELIVERIES_RETENTION_DAYS <= 0:
+        return
+
+    while True:
+        before = (datetime.utcnow() - timedelta(days=MAILING_DELIVERIES_RETENTION_DAYS)).isoformat()
+        try:
+            removed = await asyncio.to_thread(purge_mailing_deliveries, before)
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="mailing_deliveries_purge_worker",
+                message="Ошибка при удалении старых итогов доставки рассылок",
+                exc=e,
+            )
+        else:
+            if removed:
+                logging.info("Удалено старых итогов доставки рассылок: %s", removed)
+
+        await asyncio.sleep(MAILING_DELIVERIES_PURGE_SECONDS)
+
+
+async def db_checkpoint_worker() -> None:
+    """Фоновая задача, периодически переносящая WAL основной БД и БД событий в их файлы.
+
+    Автоматический checkpoint срабатывает внутри коммита того, кто переполнил WAL; плановый перенос
+    вне обработки апдейтов держит WAL небольшим и снимает эту работу с обработчиков.
+    """
+
+    while True:
+        await asyncio.sleep(DB_CHECKPOINT_SECONDS)
+        try:
+            result = await asyncio.to_thread(checkpoint_databases)
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="db_checkpoint_worker",
+                message="Ошибка при checkpoint WAL",
+                exc=e,
+            )
+            continue
+
+        for name, (wal_pages, checkpointed) in result.items():
+            if wal_pages:
+                logging.info("Checkpoint %s: страниц в WAL=%s, перенесено=%s", name, wal_pages, checkpointed)
@@ -1,20 +1,45 @@
+from typing import Optional
+
 from aiogram import Router, types
 
-from db import save_channel_post
+from db import DbSession, save_channel_post, save_channel_post_content
+from mailing_content import dump_payload, extract_payload
 
 
 router = Router()
 
 
-@router.channel_post()
-async def on_channel_post(message: types.Message) -> None:
+def _channel_key(message: types.Message) -> str:
     # Для публичных каналов стараемся сохранять username, чтобы формировать корректные t.me/имя_канала/ID
     if message.chat.username:
-        chat_id = message.chat.username
-    else:
-        chat_id = str(message.chat.id)
+        return message.chat.username
+    return str(message.chat.id)
+
+
+@router.channel_post()
+async def on_channel_post(message: types.Message, db_session: Optional[DbSession] = None) -> None:
+    chat_id = _channel_key(message)
 
     text = message.text or message.caption or ""
     preview = text.strip().replace("\n", " ")[:200] if text else None
 
-    save_channel_post(chat_id=chat_id, message_id=message.message_id, text_preview=preview)
+    # Сообщения альбома приходят отдельными апдейтами с общим media_group_id — в БД они склеиваются в один пост
+    save_channel_post(
+        chat_id=chat_id,
+        message_id=message.message_id,
+        text_preview=preview,
+        media_group_id=message.media_group_id,
+        session=db_session,
+    )
+    # Содержимое для рассылки сохраняется сразу: при запуске рассылки пост не нужно перечитывать через Bot API
+    save_channel_post_content(chat_id, message.message_id, dump_payload(extract_payload(message)), session=db_session)
+
+
+@router.edited_channel_post()
+async def on_edited_channel_post(message: types.Message, db_session: Optional[DbSession] = None) -> None:
+    save_channel_post_content(
+        _channel_key(message),
+        message.message_id,
+        dump_payload(extract_payload(message)),
+        session=db_session,
+    )
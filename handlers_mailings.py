@@ -1,41 +1,110 @@
 import asyncio
 import re
+import time
+from dataclasses import dataclass
 from typing import Optional, Tuple
 
-from aiogram import Router, F, types
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram import Bot, Router, F, types
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from aiogram.filters import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery
 
-from config import is_admin
+from config import (
+    DELIVERY_CONCURRENCY,
+    DELIVERY_MAX_FAILURES,
+    ENGAGEMENT_REFRESH_SECONDS,
+    MAILING_ORDER,
+    MAILING_RATE_PER_SECOND,
+    MAILING_SPREAD_BUCKET_MINUTES,
+    MAILING_SPREAD_HOURS,
+    MAILING_SPREAD_MIN_RECIPIENTS,
+    MAILING_TRACK_CLICKS,
+    MAILING_WARMUP_MINUTES,
+    is_admin,
+)
 from constants import ADMIN_CMD_BY_LINK_TEXT, ADMIN_CMD_FROM_POSTS_TEXT
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 from db import (
     create_mailing,
-    get_active_users,
+    count_active_users,
+    iter_active_users,
+    build_delivery_plan,
+    freeze_recipients,
+    get_delivery_plan_buckets,
+    iter_delivery_plan_bucket,
     get_admin_users,
     mark_user_blocked,
+    get_failing_user_ids,
+    record_delivery_failures,
+    record_mailing_deliveries,
+    reset_delivery_failures,
     get_recent_channel_posts,
     create_scheduled_mailing,
+    delete_delivery_plan,
+    discard_prepared_mailing,
     get_due_scheduled_mailings,
+    get_next_scheduled_run_at,
+    get_scheduled_mailings_to_warm_up,
+    save_scheduled_warmup,
+    reschedule_recurring_mailing,
     update_scheduled_mailing_status,
+    refresh_engagement_scores,
+    refresh_peak_hours,
+    save_mailing_delivery_metrics,
+    save_mailing_content,
+    get_mailing,
+    get_mailing_content,
+    parse_message_ids,
 )
 from keyboards import (
     build_admin_menu_markup,
     build_mailing_type_markup,
     build_mailing_confirm_markup,
     build_channel_posts_list_markup,
+    build_mailing_click_button,
+    build_running_mailings_markup,
 )
 from states import AdminStates
 from logger_utils import log_error
+from mailing_content import dump_content, load_content, resolve_content, send_payload, with_extra_button
+from mailing_runtime import MailingRegistry, MailingRun, mailing_registry
+from middlewares import antiflood, update_lanes
+from outbound import outbound_scheduler
+from recurrence import TZ, parse_rule
 import logging
 
 
 router = Router()
 
+# За сколько секунд до старта запланированной рассылки открываются соединения пула доставки
+# (меньше DELIVERY_KEEPALIVE_SECONDS, чтобы они не успели закрыться)
+CONNECTIONS_WARMUP_LEAD_SECONDS = 5
+
+# Сколько временно неудачных отправок (сеть, 5xx, повторный 429) держим для повторного прохода в конце рассылки
+MAX_RETRY_QUEUE = 10_000
+# Сколько изменений счётчиков ошибок доставки копим перед записью в БД одной транзакцией
+FAILURE_BATCH_SIZE = 500
+# Сколько итогов доставки по получателям копим перед записью в БД событий
+OUTCOME_BATCH_SIZE = 1000
+
+# Ответы 400, после которых повторять отправку этому пользователю бессмысленно: класс -> фрагмент текста ошибки
+PERMANENT_DELIVERY_ERRORS = {
+    "chat_not_found": "chat not found",
+    "user_deactivated": "user is deactivated",
+    "user_not_found": "user not found",
+    "peer_id_invalid": "peer_id_invalid",
+    "no_rights": "have no rights to send a message",
+}
+
 
 POST_LINK_RE = re.compile(r"https?://t\.me/(?P<chat>[^/]+)/(?P<msg>\d+)")
 
@@ -51,6 +120,78 @@ def parse_post_link(link: str) -> Optional[Tuple[str, int]]:
     return chat, msg_id
 
 
+async def _copy_post(bot, chat_id: int, from_chat: str, message_ids: list[int]) -> None:
+    """Копирует пост в чат: одиночное сообщение — copy_message, альбом — одним вызовом copy_messages."""
+
+    if len(message_ids) == 1:
+        await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat, message_id=message_ids[0])
+        return
+
+    copied = await bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat, message_ids=message_ids)
+    if not copied:
+        # copy_messages молча пропускает недоступные сообщения; пустой ответ — пост не доставлен
+        raise TelegramBadRequest(method=None, message="copy_messages: ни одно сообщение не скопировано")
+
+
+def _permanent_error_class(exc: TelegramBadRequest) -> Optional[str]:
+    text = exc.message.lower()
+    for error_class, fragment in PERMANENT_DELIVERY_ERRORS.items():
+        if fragment in text:
+            return error_class
+    return None
+
+
+async def _deliver(
+    bot, uid: int, from_chat: str, message_ids: list[int], payloads: Optional[list]
+) -> Tuple[str, Optional[str]]:
+    """Отправляет пост одному получателю.
+
+    Возвращает (исход, класс ошибки). Исход: "sent", "blocked", "unreachable" (постоянная ошибка 400,
+    класс — ключ PERMANENT_DELIVERY_ERRORS), "retry" (временная ошибка, можно повторить) или "failed".
+    """
+
+    async def send_once() -> None:
+        if payloads is not None:
+            await send_payload(bot, uid, payloads)
+        else:
+            await _copy_post(bot, uid, from_chat, message_ids)
+
+    try:
+        await send_once()
+        return "sent", None
+    except TelegramForbiddenError:
+        mark_user_blocked(uid)
+        return "blocked", "forbidden"
+    except TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        try:
+            await send_once()
+            return "sent", None
+        except Exception:  # noqa: BLE001
+            return "retry", None
+    except (TelegramNetworkError, TelegramServerError):
+        return "retry", None
+    except TelegramBadRequest as e:
+        error_class = _permanent_error_class(e)
+        if error_class is not None:
+            return "unreachable", error_class
+        log_error(
+            user_id=uid,
+            context="mailing_send",
+            message="Не удалось отправить сообщение пользователю",
+            exc=e,
+        )
+        return "failed", None
+    except Exception as e:  # noqa: BLE001
+        log_error(
+            user_id=uid,
+            context="mailing_send",
+            message="Не удалось отправить сообщение пользователю",
+            exc=e,
+        )
+        return "failed", None
+
+
 def _map_mtype(code: str) -> str:
     if code == "news":
         return "news"
@@ -181,6 +322,7 @@ async def admin_receive_post_link(message: types.Message, state: FSMContext) ->
         post_link=message.text.strip(),
         from_chat=successful_from_chat,
         message_id=msg_id,
+        message_ids=[msg_id],
     )
 
     await state.set_state(AdminStates.waiting_for_mailing_type)
@@ -269,19 +411,17 @@ async def cb_choose_post(callback: CallbackQuery, state: FSMContext) -> None:
 
     from_chat = row["chat_id"]
     message_id = int(row["message_id"])
+    message_ids = parse_message_ids(row["message_ids"], message_id)
 
     await state.update_data(
         post_link=f"https://t.me/{from_chat}/{message_id}",
         from_chat=from_chat,
         message_id=message_id,
+        message_ids=message_ids,
     )
 
     try:
-        await callback.bot.copy_message(
-            chat_id=callback.message.chat.id,
-            from_chat_id=from_chat,
-            message_id=message_id,
-        )
+        await _copy_post(callback.bot, callback.message.chat.id, from_chat, message_ids)
     except TelegramBadRequest:
         await callback.answer(
             "Не удалось получить публикацию из канала. Убедитесь, что у бота достаточно прав.", show_alert=True
@@ -314,105 +454,395 @@ async def cb_choose_mailing_type(callback: CallbackQuery, state: FSMContext) ->
     raw_type = callback.data.replace("mtype_", "")
     mailing_type = _map_mtype(raw_type)
 
-    await state.update_data(mailing_type=mailing_type)
+    await state.update_data(mailing_type=mailing_type, track_clicks=MAILING_TRACK_CLICKS)
 
     await callback.message.answer(
         "Вы выбрали тип рассылки: {0}. Выберите способ отправки.".format(mailing_type),
-        reply_markup=build_mailing_confirm_markup(),
+        reply_markup=build_mailing_confirm_markup(track_clicks=MAILING_TRACK_CLICKS),
     )
     await callback.answer()
 
 
-async def _send_mailing_task(bot, admin_chat_id: int, data: dict) -> None:
+@router.callback_query(StateFilter(AdminStates.waiting_for_mailing_type), F.data == "mconfirm_track")
+async def cb_mailing_toggle_tracking(callback: CallbackQuery, state: FSMContext) -> None:
+    user_id = callback.from_user.id
+    if not is_admin(user_id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    data = await state.get_data()
+    track_clicks = not data.get("track_clicks", False)
+    await state.update_data(track_clicks=track_clicks)
+
+    await callback.message.edit_reply_markup(reply_markup=build_mailing_confirm_markup(track_clicks=track_clicks))
+    await callback.answer(
+        "Под рассылкой будет кнопка «Играть» со статистикой кликов" if track_clicks else "Кнопка «Играть» не добавляется"
+    )
+
+
+@dataclass
+class _PreparedMailing:
+    """Рассылка, готовая к отправке: запись в mailings, кэш содержимого и (если есть) план получателей."""
+
+    mailing_id: int
+    recipients_count: int
+    payloads: Optional[list]
+    delivery_order: str
+    # Число интервалов в delivery_plan; 0 — получатели читаются из users по ходу рассылки
+    plan_buckets: int = 0
+
+
+async def _prepare_mailing(
+    bot,
+    admin_chat_id: int,
+    data: dict,
+    rate: float,
+    start_at: datetime,
+    freeze: bool = False,
+) -> Optional[_PreparedMailing]:
+    """Читает пост, создаёт запись рассылки и план доставки. None — получателей нет.
+
+    freeze=True фиксирует список получателей в delivery_plan (подготовка запланированной рассылки заранее).
+    TelegramBadRequest из resolve_content пробрасывается: исходный пост удалён или недоступен.
+    """
+
+    from_chat = str(data["from_chat"])
+    message_id = int(data["message_id"])
+    message_ids = [int(mid) for mid in data.get("message_ids") or [message_id]]
+    mailing_type = str(data["mailing_type"])
+
+    if mailing_type == "test_mailing":
+        recipients_count = len(get_admin_users())
+        delivery_order = "user_id"
+    else:
+        recipients_count = count_active_users(include_admins=True)
+        delivery_order = MAILING_ORDER
+
+    if not recipients_count:
+        return None
+
+    # Содержимое поста читаем один раз до рассылки: дальше отправка идёт «родными» методами
+    # из кэша и не зависит от исходного поста (переживает его удаление посреди рассылки)
+    payloads = await resolve_content(bot, admin_chat_id, from_chat, message_ids)
+
+    # Отслеживаемую кнопку можно добавить только к одиночному сообщению из кэша (у альбомов кнопок нет)
+    track_clicks = bool(data.get("track_clicks")) and payloads is not None and len(payloads) == 1
+    if data.get("track_clicks") and not track_clicks:
+        await bot.send_message(
+            admin_chat_id,
+            "Кнопка «Играть» со статистикой кликов не добавлена: пост — альбом или неподдерживаемый тип сообщения.",
+        )
+
+    mailing_id = create_mailing(
+        mailing_type=mailing_type,
+        post_link=str(data["post_link"]),
+        from_chat=from_chat,
+        message_id=message_id,
+        recipients_count=recipients_count,
+        message_ids=message_ids,
+        scheduled_id=data.get("scheduled_id"),
+        track_clicks=track_clicks,
+    )
+    if track_clicks:
+        payloads = with_extra_button(payloads, build_mailing_click_button(mailing_id))
+    if payloads is not None:
+        save_mailing_content(mailing_id, dump_content(payloads))
+    else:
+        logging.info("Рассылка id=%s: тип поста не поддерживается кэшем, отправка через copy_message", mailing_id)
+
+    prepared = _PreparedMailing(mailing_id, recipients_count, payloads, delivery_order)
+
+    # Большие рассылки растягиваются на окно MAILING_SPREAD_HOURS: каждому получателю заранее
+    # назначается интервал по его часу активности, интервалы отправляются по очереди с обычной скоростью.
+    # Важные уведомления и тестовые рассылки уходят сразу.
+    if (
+        MAILING_SPREAD_HOURS > 0
+        and mailing_type not in ("test_mailing", "important_notification")
+        and recipients_count >= MAILING_SPREAD_MIN_RECIPIENTS
+    ):
+        spread_buckets = max(1, MAILING_SPREAD_HOURS * 60 // MAILING_SPREAD_BUCKET_MINUTES)
+        local_start = start_at.astimezone(TZ)
+        # Запас 20% ёмкости интервала — под повторы и ответы пользователям
+        bucket_capacity = int(rate * MAILING_SPREAD_BUCKET_MINUTES * 60 * 0.8)
+        prepared.recipients_count = await asyncio.to_thread(
+            build_delivery_plan,
+            mailing_id,
+            local_start.hour,
+            local_start.minute,
+            MAILING_SPREAD_BUCKET_MINUTES,
+            spread_buckets,
+            bucket_capacity,
+        )
+        prepared.plan_buckets = spread_buckets
+        prepared.delivery_order = "spread"
+        logging.info(
+            "Рассылка id=%s: план доставки на %s ч, интервалов=%s, получателей=%s",
+            mailing_id,
+            MAILING_SPREAD_HOURS,
+            spread_buckets,
+            prepared.recipients_count,
+        )
+    elif freeze and mailing_type != "test_mailing":
+        prepared.recipients_count = await asyncio.to_thread(freeze_recipients, mailing_id, delivery_order)
+        prepared.plan_buckets = 1
+
+    # Порядок сохраняем сразу: по нему восстанавливается подготовленная заранее рассылка
+    save_mailing_delivery_metrics(mailing_id, prepared.delivery_order, None, None)
+    return prepared
+
+
+def _load_prepared_mailing(mailing_id: int) -> Optional[_PreparedMailing]:
+    """Восстанавливает подготовленную заранее рассылку; None — её нет или отправка уже начиналась."""
+
+    row = get_mailing(mailing_id)
+    if row is None or row["delivered_count"] or row["error_count"]:
+        return None
+    plan_buckets = get_delivery_plan_buckets(mailing_id)
+    return _PreparedMailing(
+        mailing_id=mailing_id,
+        recipients_count=int(row["recipients_count"]),
+        payloads=load_content(get_mailing_content(mailing_id)),
+        delivery_order=row["delivery_order"] or MAILING_ORDER,
+        plan_buckets=plan_buckets,
+    )
+
+
+async def _send_mailing_task(bot, admin_chat_id: int, data: dict, run: MailingRun, delivery_bot=None) -> None:
+    # Сообщения админу идут через основной бот, получателям — через отдельный пул доставки
+    sender = delivery_bot or bot
+
     from_chat: str = str(data["from_chat"])  # type: ignore[assignment]
     message_id: int = int(data["message_id"])  # type: ignore[assignment]
+    message_ids: list[int] = [int(mid) for mid in data.get("message_ids") or [message_id]]
     mailing_type: str = str(data["mailing_type"])  # type: ignore[assignment]
     post_link: str = str(data["post_link"])  # type: ignore[assignment]
 
     logging.info(
-        "Старт рассылки: type=%s post_link=%s from_chat=%s message_id=%s admin_chat_id=%s",
+        "Старт рассылки: type=%s post_link=%s from_chat=%s message_ids=%s admin_chat_id=%s",
         mailing_type,
         post_link,
         from_chat,
-        message_id,
+        message_ids,
         admin_chat_id,
     )
 
-    if mailing_type == "test_mailing":
-        recipients = get_admin_users()
-    else:
-        recipients = get_active_users(include_admins=True)
+    # «Недавно активные» — заходили в бота за последние 7 дней; по ним считаем метрики ранней доставки
+    recent_since = (datetime.utcnow() - timedelta(days=7)).isoformat()
+
+    # Запланированная рассылка могла быть подготовлена заранее (см. _warm_up_scheduled_mailing)
+    prepared: Optional[_PreparedMailing] = None
+    if data.get("prepared_mailing_id"):
+        prepared = _load_prepared_mailing(int(data["prepared_mailing_id"]))
+        if prepared is None:
+            logging.info("Подготовленная рассылка id=%s не найдена, готовлю заново", data["prepared_mailing_id"])
 
-    if not recipients:
+    if prepared is None:
+        try:
+            prepared = await _prepare_mailing(bot, admin_chat_id, data, run.rate, datetime.now(TZ))
+        except TelegramBadRequest:
+            await bot.send_message(
+                admin_chat_id,
+                "Не удалось прочитать исходный пост: он удалён или недоступен боту. Рассылка не запущена.",
+            )
+            raise
+
+    if prepared is None or not prepared.recipients_count:
         await bot.send_message(admin_chat_id, "Нет получателей для рассылки.")
         return
 
-    mailing_id = create_mailing(
-        mailing_type=mailing_type,
-        post_link=post_link,
-        from_chat=from_chat,
-        message_id=message_id,
-        recipients_count=len(recipients),
-    )
+    mailing_id = prepared.mailing_id
+    recipients_count = prepared.recipients_count
+    payloads = prepared.payloads
+    delivery_order = prepared.delivery_order
+    run.mailing_id = mailing_id
+    run.total = recipients_count
+
+    if mailing_type == "test_mailing":
+        recent_total = 0
+        recipients = ((uid, False) for uid in get_admin_users())
+    else:
+        recent_total = count_active_users(include_admins=True, since=recent_since)
+        recipients = iter_active_users(include_admins=True, order=delivery_order, recent_since=recent_since)
 
     delivered = 0
     errors = 0
+    recent_delivered = 0
+    active_p50_seconds: Optional[int] = None
+    active_p90_seconds: Optional[int] = None
+    retry_queue: list[tuple[int, bool]] = []
+
+    # Счётчики постоянных ошибок: сбрасываем только тем, у кого они были, и пишем в БД пачками
+    failing_ids = get_failing_user_ids() if mailing_type != "test_mailing" else set()
+    failures: list[tuple[int, str]] = []
+    recovered: list[int] = []
+    # Итоги по получателям для выгрузки /export deliveries; пишутся в БД событий своими пачками
+    outcomes: list[tuple[int, str, Optional[str]]] = []
+    unreachable = 0
+    suppressed = 0
+
+    def flush_failures() -> None:
+        nonlocal suppressed
+        suppressed += record_delivery_failures(failures, DELIVERY_MAX_FAILURES)
+        reset_delivery_failures(recovered)
+        failures.clear()
+        recovered.clear()
+
+    def flush_outcomes() -> None:
+        record_mailing_deliveries(mailing_id, outcomes)
+        outcomes.clear()
+
+    spread_buckets = prepared.plan_buckets if delivery_order == "spread" else 0
+    start_text = f"Начинаю рассылку (id={mailing_id}) по {recipients_count} пользователям...\n"
+    if spread_buckets:
+        start_text += (
+            f"Рассылка растянута на {MAILING_SPREAD_HOURS} ч (интервалы по {MAILING_SPREAD_BUCKET_MINUTES} мин) "
+            f"с учётом часов активности пользователей.\n"
+        )
+    await bot.send_message(admin_chat_id, start_text + "Управление: Админ-панель → «Активные рассылки».")
 
-    await bot.send_message(
-        admin_chat_id,
-        f"Начинаю рассылку (id={mailing_id}) по {len(recipients)} пользователям...",
-    )
+    started_at = time.monotonic()
 
-    for idx, uid in enumerate(recipients, start=1):
-        try:
-            await bot.copy_message(chat_id=uid, from_chat_id=from_chat, message_id=message_id)
+    def account(sent: bool, recent: bool) -> None:
+        nonlocal delivered, errors, recent_delivered, active_p50_seconds, active_p90_seconds
+
+        if sent:
             delivered += 1
-        except TelegramForbiddenError:
-            mark_user_blocked(uid)
-            errors += 1
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-            try:
-                await bot.copy_message(chat_id=uid, from_chat_id=from_chat, message_id=message_id)
-                delivered += 1
-            except Exception:
-                errors += 1
-        except Exception as e:  # noqa: BLE001
-            log_error(
-                user_id=uid,
-                context="mailing_send",
-                message="Не удалось отправить сообщение пользователю",
-                exc=e,
-            )
+            if recent:
+                recent_delivered += 1
+                elapsed = int(time.monotonic() - started_at)
+                if active_p50_seconds is None and recent_delivered * 2 >= recent_total:
+                    active_p50_seconds = elapsed
+                if active_p90_seconds is None and recent_delivered * 10 >= recent_total * 9:
+                    active_p90_seconds = elapsed
+        else:
             errors += 1
 
-        if idx % 30 == 0:
-            await asyncio.sleep(2)
+        run.delivered = delivered
+        run.errors = errors
+
+    # Отправки идут параллельно (до DELIVERY_CONCURRENCY одновременно), темп задаёт run.throttle()
+    slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+    in_flight: set[asyncio.Task] = set()
+
+    async def deliver_one(uid: int, recent: bool, queue_on_retry: bool) -> None:
+        nonlocal unreachable
+        try:
+            outcome, error_class = await _deliver(sender, uid, from_chat, message_ids, payloads)
+            if outcome == "retry" and queue_on_retry and len(retry_queue) < MAX_RETRY_QUEUE:
+                retry_queue.append((uid, recent))
+                return
+            if outcome == "unreachable" and error_class is not None:
+                unreachable += 1
+                failures.append((uid, error_class))
+            elif outcome == "sent" and uid in failing_ids:
+                recovered.append(uid)
+            if len(failures) + len(recovered) >= FAILURE_BATCH_SIZE:
+                flush_failures()
+            outcomes.append((uid, outcome, error_class))
+            if len(outcomes) >= OUTCOME_BATCH_SIZE:
+                flush_outcomes()
+            account(outcome == "sent", recent)
+        finally:
+            slots.release()
+
+    async def drain(items, queue_on_retry: bool) -> int:
+        """Отправляет получателям из items; возвращает, скольким отправка была запущена."""
+
+        started = 0
+        for uid, recent in items:
+            # Пауза, отмена и текущая скорость рассылки — см. MailingRun.throttle
+            if not await run.throttle():
+                break
+            await slots.acquire()
+            task = asyncio.create_task(deliver_one(uid, recent, queue_on_retry))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            started += 1
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        return started
+
+    if prepared.plan_buckets:
+        # Получатели зафиксированы в delivery_plan: либо интервалы растянутой рассылки,
+        # либо один интервал с замороженным при подготовке списком
+        bucket_seconds = MAILING_SPREAD_BUCKET_MINUTES * 60
+        for bucket in range(prepared.plan_buckets):
+            # Интервал не начинается раньше своего времени; если предыдущий затянулся — сразу следом
+            while not run.cancelled:
+                remaining = started_at + bucket * bucket_seconds - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 5))
+            if run.cancelled:
+                break
+            await drain(iter_delivery_plan_bucket(mailing_id, bucket, recent_since=recent_since), queue_on_retry=True)
+    else:
+        await drain(recipients, queue_on_retry=True)
+
+    # Повторный проход по временным ошибкам — из того же кэша, без обращения к исходному посту
+    if retry_queue:
+        logging.info("Рассылка id=%s: повторная отправка %s получателям", mailing_id, len(retry_queue))
+    pending_retries = list(retry_queue)
+    retried = await drain(pending_retries, queue_on_retry=False)
+    for uid, _ in pending_retries[retried:]:
+        # Повтор не состоялся (рассылку отменили) — итогом остаётся временная ошибка
+        outcomes.append((uid, "retry", None))
+        account(False, False)
+    flush_failures()
+    flush_outcomes()
 
     from db import update_mailing_counters  # локальный импорт, чтобы избежать циклов
 
     update_mailing_counters(mailing_id, delivered_delta=delivered, error_delta=errors)
+    save_mailing_delivery_metrics(mailing_id, delivery_order, active_p50_seconds, active_p90_seconds)
+    if prepared.plan_buckets:
+        # Отправка закончена — зафиксированный список получателей больше не нужен
+        delete_delivery_plan(mailing_id)
 
     summary_text = (
-        f"Рассылка (id={mailing_id}) завершена.\n"
-        f"Получателей: {len(recipients)}\n"
+        f"Рассылка (id={mailing_id}) {'отменена' if run.cancelled else 'завершена'}.\n"
+        f"Получателей: {recipients_count}\n"
         f"Доставлено: {delivered}\n"
         f"Ошибки: {errors}"
     )
+    if unreachable:
+        summary_text += (
+            f"\nНедоступны (чат не найден, аккаунт удалён и т.п.): {unreachable}, "
+            f"исключены из рассылок после {DELIVERY_MAX_FAILURES} ошибок подряд: {suppressed}"
+        )
+    if recent_total:
+        summary_text += (
+            f"\nАктивные за 7 дней ({recent_total}): 50% получили через {_format_seconds(active_p50_seconds)}, "
+            f"90% — через {_format_seconds(active_p90_seconds)} (порядок: {delivery_order})"
+        )
 
     logging.info(
-        "Рассылка завершена: id=%s recipients=%s delivered=%s errors=%s",
+        "Рассылка завершена: id=%s cancelled=%s recipients=%s delivered=%s errors=%s unreachable=%s suppressed=%s "
+        "order=%s active_p50=%s active_p90=%s",
         mailing_id,
-        len(recipients),
+        run.cancelled,
+        recipients_count,
         delivered,
         errors,
+        unreachable,
+        suppressed,
+        delivery_order,
+        active_p50_seconds,
+        active_p90_seconds,
     )
 
     await bot.send_message(admin_chat_id, summary_text)
 
 
+def _format_seconds(seconds: Optional[int]) -> str:
+    if seconds is None:
+        return "—"
+    minutes, sec = divmod(seconds, 60)
+    return f"{minutes} мин {sec} с" if minutes else f"{sec} с"
+
+
 @router.callback_query(StateFilter(AdminStates.waiting_for_mailing_type), F.data == "mconfirm_send")
-async def cb_mailing_confirm_send(callback: CallbackQuery, state: FSMContext) -> None:
+async def cb_mailing_confirm_send(callback: CallbackQuery, state: FSMContext, delivery_bot: Optional[Bot] = None) -> None:
     user_id = callback.from_user.id
     if not is_admin(user_id):
         await callback.answer("У вас нет прав для работы с рассылками.", show_alert=True)
@@ -425,11 +855,26 @@ async def cb_mailing_confirm_send(callback: CallbackQuery, state: FSMContext) ->
         await state.clear()
         return
 
-    await callback.answer("Рассылка запущена", show_alert=False)
-    await callback.message.answer("Рассылка отправляется в фоне. Итоговый отчёт придёт позже.")
+    admin_chat_id = callback.message.chat.id
+    key = MailingRegistry.make_key(
+        str(data["mailing_type"]),
+        str(data["from_chat"]),
+        data.get("message_ids") or [int(data["message_id"])],
+    )
+    run = mailing_registry.start(
+        key,
+        mailing_type=str(data["mailing_type"]),
+        admin_chat_id=admin_chat_id,
+        runner=lambda run: _send_mailing_task(callback.bot, admin_chat_id, data, run, delivery_bot),
+    )
     await state.clear()
 
-    asyncio.create_task(_send_mailing_task(callback.bot, callback.message.chat.id, data))
+    if run is None:
+        await callback.answer("Эта рассылка уже запущена.", show_alert=True)
+        return
+
+    await callback.answer("Рассылка запущена", show_alert=False)
+    await callback.message.answer("Рассылка отправляется в фоне. Итоговый отчёт придёт позже.")
 
 
 @router.callback_query(StateFilter(AdminStates.waiting_for_mailing_type), F.data == "mconfirm_cancel")
@@ -456,7 +901,11 @@ async def cb_mailing_confirm_schedule(callback: CallbackQuery, state: FSMContext
     await state.set_state(AdminStates.waiting_for_schedule_time)
     await callback.message.answer(
         "Укажите дату и время отправки в формате ДД.ММ.ГГГГ ЧЧ:ММ.\n"
-        "Например: 26.12.2025 14:30",
+        "Например: 26.12.2025 14:30\n\n"
+        "Или правило повторения (время Душанбе):\n"
+        "• ежедневно 14:30\n"
+        "• еженедельно пн,ср,пт 14:30\n"
+        "• cron 30 14 * * 1-5",
     )
     await callback.answer()
 
@@ -474,21 +923,29 @@ async def admin_set_schedule_time(message: types.Message, state: FSMContext) ->
         return
 
     text = message.text.strip()
-    try:
-        naive_dt = datetime.strptime(text, "%d.%m.%Y %H:%M")
-    except ValueError:
-        await message.answer(
-            "Не получилось разобрать дату. Проверьте формат. Пример: 26.12.2025 14:30",
-        )
-        return
 
     # Используем часовой пояс Душанбе (Asia/Dushanbe)
     tz = ZoneInfo("Asia/Dushanbe")
-    dt = naive_dt.replace(tzinfo=tz)
     now = datetime.now(tz)
-    if dt <= now:
-        await message.answer("Время отправки уже прошло. Укажите будущую дату и время.")
-        return
+
+    recurrence = None
+    try:
+        naive_dt = datetime.strptime(text, "%d.%m.%Y %H:%M")
+    except ValueError:
+        recurrence = parse_rule(text)
+        if recurrence is None:
+            await message.answer(
+                "Не получилось разобрать дату или правило. Примеры: 26.12.2025 14:30, "
+                "ежедневно 14:30, еженедельно пн,ср 14:30, cron 30 14 * * 1-5",
+            )
+            return
+        # Первое срабатывание материализуем сразу — дальше планировщик смотрит только на next_run_at
+        dt = recurrence.next_after(now)
+    else:
+        dt = naive_dt.replace(tzinfo=tz)
+        if dt <= now:
+            await message.answer("Время отправки уже прошло. Укажите будущую дату и время.")
+            return
 
     data = await state.get_data()
     if not {"post_link", "from_chat", "message_id", "mailing_type"} <= data.keys():
@@ -501,6 +958,7 @@ async def admin_set_schedule_time(message: types.Message, state: FSMContext) ->
     post_link = str(data["post_link"])
     from_chat = str(data["from_chat"])
     message_id = int(data["message_id"])
+    message_ids = [int(mid) for mid in data.get("message_ids") or [message_id]]
 
     scheduled_id = create_scheduled_mailing(
         mailing_type=mailing_type,
@@ -509,6 +967,9 @@ async def admin_set_schedule_time(message: types.Message, state: FSMContext) ->
         message_id=message_id,
         admin_chat_id=message.chat.id,
         scheduled_at_iso=scheduled_at_iso,
+        message_ids=message_ids,
+        recurrence=recurrence.rule if recurrence is not None else None,
+        track_clicks=bool(data.get("track_clicks")),
     )
 
     await state.clear()
@@ -516,12 +977,15 @@ async def admin_set_schedule_time(message: types.Message, state: FSMContext) ->
     # Короткое описание для удобства админа
     preview = post_link
     preview_text = f"ID {scheduled_id}, тип: {mailing_type}, источник: {preview}"
+    if recurrence is not None:
+        preview_text += f"\nПовтор: {recurrence.describe()}"
 
     logging.info(
-        "Создана запланированная рассылка: id=%s type=%s when=%s admin_chat_id=%s",
+        "Создана запланированная рассылка: id=%s type=%s when=%s recurrence=%s admin_chat_id=%s",
         scheduled_id,
         mailing_type,
         scheduled_at_iso,
+        recurrence.rule if recurrence is not None else None,
         message.chat.id,
     )
 
@@ -533,48 +997,374 @@ async def admin_set_schedule_time(message: types.Message, state: FSMContext) ->
     )
 
 
-async def scheduled_mailings_worker(bot) -> None:
+def _render_running_mailings() -> str:
+    runs = mailing_registry.active()
+    if not runs:
+        return "\n\n".join(
+            [
+                "Сейчас нет активных рассылок.",
+                outbound_scheduler.describe(),
+                update_lanes.describe() + "\n" + antiflood.describe(),
+            ]
+        )
+
+    lines = ["▶️ Активные рассылки:"]
+    for run in runs:
+        status = "на паузе" if run.paused else "идёт"
+        if run.cancelled:
+            status = "отменяется"
+        mailing_ref = f"id={run.mailing_id}" if run.mailing_id is not None else "подготовка"
+        lines.append(
+            f"#{run.run_id} ({mailing_ref}, {run.mailing_type}) — {status}, "
+            f"{run.processed}/{run.total}, ошибок: {run.errors}, скорость: {run.rate:g} сообщ./с",
+        )
+    lines.append("")
+    lines.append(outbound_scheduler.describe())
+    lines.append("")
+    lines.append(update_lanes.describe())
+    lines.append(antiflood.describe())
+    return "\n".join(lines)
+
+
+@router.callback_query(F.data == "admin_running_mailings")
+async def cb_admin_running_mailings(callback: CallbackQuery) -> None:
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    await callback.message.answer(
+        _render_running_mailings(),
+        reply_markup=build_running_mailings_markup(mailing_registry.active()),
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("mrun_"))
+async def cb_running_mailing_control(callback: CallbackQuery) -> None:
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+
+    # Формат: mrun_<action>_<run_id>
+    try:
+        _, action, run_id_str = callback.data.split("_", 2)
+        run_id = int(run_id_str)
+    except ValueError:
+        await callback.answer("Не удалось распознать команду.", show_alert=True)
+        return
+
+    if action == "refresh":
+        run = None
+    else:
+        run = mailing_registry.get(run_id)
+        if run is None:
+            await callback.answer("Рассылка уже завершена.", show_alert=True)
+            return
+
+    if run is None:
+        notice = "Список обновлён"
+    elif action == "pause":
+        run.pause()
+        notice = f"Рассылка #{run_id} на паузе"
+    elif action == "resume":
+        run.resume()
+        notice = f"Рассылка #{run_id} продолжается"
+    elif action == "cancel":
+        run.cancel()
+        notice = f"Рассылка #{run_id} отменяется"
+    elif action == "slower":
+        notice = f"Скорость #{run_id}: {run.set_rate(run.rate / 2):g} сообщ./с"
+    elif action == "faster":
+        notice = f"Скорость #{run_id}: {run.set_rate(run.rate * 2):g} сообщ./с"
+    else:
+        await callback.answer("Неизвестное действие.", show_alert=True)
+        return
+
+    logging.info("Управление рассылкой: admin=%s action=%s run_id=%s", callback.from_user.id, action, run_id)
+
+    try:
+        await callback.message.edit_text(
+            _render_running_mailings(),
+            reply_markup=build_running_mailings_markup(mailing_registry.active()),
+        )
+    except TelegramBadRequest:
+        # Текст не изменился — Telegram отвечает ошибкой «message is not modified»
+        pass
+    await callback.answer(notice)
+
+
+async def scheduled_mailings_worker(bot, delivery_bot=None) -> None:
     """Фоновая задача, отслеживающая запланированные рассылки."""
 
     tz = ZoneInfo("Asia/Dushanbe")
+    # Срабатывание, для которого соединения пула доставки уже открыты заранее
+    connections_ready_for: Optional[str] = None
+    # Запущенные и ещё не завершившиеся срабатывания: scheduled_id -> рассылка
+    scheduled_runs: dict[int, MailingRun] = {}
     while True:
-        now_iso = datetime.now(tz).isoformat()
-        rows = list(get_due_scheduled_mailings(now_iso))
-
-        if rows:
-            logging.info("Найдено %s запланированных рассылок к отправке", len(rows))
+        now = datetime.now(tz)
+        if MAILING_WARMUP_MINUTES > 0:
+            # Подготавливаем по одной задаче за итерацию, ближайшие — первыми
+            until = now + timedelta(minutes=MAILING_WARMUP_MINUTES)
+            imminent = get_next_scheduled_run_at()
+            if imminent is not None and (datetime.fromisoformat(imminent) - now).total_seconds() <= 60:
+                # Ближайшая рассылка стартует меньше чем через минуту — не задерживаем её подготовкой более поздних
+                until = min(until, datetime.fromisoformat(imminent))
+            # Подготовка идёт на каждой итерации, в том числе пока уже запущенные рассылки отправляются;
+            # её сбой (например, недоступен чат админа) не должен останавливать запуск наступивших задач
+            for row in get_scheduled_mailings_to_warm_up(until.isoformat(), limit=1):
+                try:
+                    await _warm_up_scheduled_mailing(bot, row)
+                except Exception as e:  # noqa: BLE001
+                    log_error(
+                        user_id=int(row["admin_chat_id"]),
+                        context="scheduled_mailings_worker",
+                        message=f"Ошибка подготовки запланированной рассылки ID {row['id']}",
+                        exc=e,
+                    )
+            now = datetime.now(tz)
+
+        # Берём только ближайшую наступившую задачу; следующие — на следующих итерациях без паузы
+        rows = list(get_due_scheduled_mailings(now.isoformat(), limit=1))
+
+        if not rows:
+            next_run_at = get_next_scheduled_run_at()
+            if (
+                MAILING_WARMUP_MINUTES > 0
+                and next_run_at is not None
+                and next_run_at != connections_ready_for
+                and (datetime.fromisoformat(next_run_at) - now).total_seconds() <= CONNECTIONS_WARMUP_LEAD_SECONDS
+            ):
+                # За несколько секунд до старта открываем соединения пула доставки (TCP + TLS),
+                # чтобы первые сообщения не ждали рукопожатий
+                await _open_delivery_connections(delivery_bot or bot)
+                connections_ready_for = next_run_at
+                now = datetime.now(tz)
+            await asyncio.sleep(_seconds_until_next_run(now, next_run_at))
+            continue
 
         for row in rows:
             mailing_id = int(row["id"])
             logging.info(
-                "Запускаю запланированную рассылку: scheduled_id=%s type=%s when=%s",
+                "Запускаю запланированную рассылку: scheduled_id=%s type=%s when=%s recurrence=%s",
                 mailing_id,
                 row["mailing_type"],
-                row["scheduled_at"],
+                row["next_run_at"],
+                row["recurrence"],
             )
 
-            update_scheduled_mailing_status(mailing_id, "processing")
-
             data = {
                 "from_chat": row["from_chat"],
                 "message_id": int(row["message_id"]),
+                "message_ids": parse_message_ids(row["message_ids"], int(row["message_id"])),
                 "mailing_type": row["mailing_type"],
                 "post_link": row["post_link"],
+                "scheduled_id": mailing_id,
+                "track_clicks": bool(row["track_clicks"]),
             }
+            if row["prepared_mailing_id"] and row["prepared_for"] == row["next_run_at"]:
+                data["prepared_mailing_id"] = int(row["prepared_mailing_id"])
 
             admin_chat_id = int(row["admin_chat_id"])
+            recurrence = parse_rule(row["recurrence"]) if row["recurrence"] else None
+
+            key = MailingRegistry.make_key(data["mailing_type"], data["from_chat"], data["message_ids"])
+            run = mailing_registry.start(
+                key,
+                mailing_type=data["mailing_type"],
+                admin_chat_id=admin_chat_id,
+                runner=lambda run, data=data, admin_chat_id=admin_chat_id: _send_mailing_task(
+                    bot, admin_chat_id, data, run, delivery_bot
+                ),
+            )
+            update_scheduled_mailing_status(mailing_id, "processing")
 
-            try:
-                await _send_mailing_task(bot, admin_chat_id, data)
-            except Exception as e:  # noqa: BLE001
-                log_error(
-                    user_id=admin_chat_id,
-                    context="scheduled_mailing_worker",
-                    message="Ошибка при выполнении запланированной рассылки",
-                    exc=e,
+            if run is None:
+                # Тот же пост с тем же типом прямо сейчас уже уходит — второй раз не шлём
+                await bot.send_message(
+                    admin_chat_id,
+                    f"Запланированная рассылка ID {mailing_id} пропущена: такая же рассылка уже выполняется.",
                 )
-                update_scheduled_mailing_status(mailing_id, "failed")
-            else:
-                update_scheduled_mailing_status(mailing_id, "done")
+                if "prepared_mailing_id" in data:
+                    discard_prepared_mailing(data["prepared_mailing_id"])
+                _finish_scheduled_run(mailing_id, row["next_run_at"], recurrence, "failed")
+                continue
+
+            # Не ждём окончания рассылки: цикл продолжает запускать следующие задачи,
+            # итог срабатывания записывается, когда завершится задача рассылки
+            scheduled_runs[mailing_id] = run
+            run.task.add_done_callback(
+                lambda _task, mailing_id=mailing_id, run_at=row["next_run_at"], recurrence=recurrence: (
+                    _on_scheduled_run_done(mailing_id, scheduled_runs.pop(mailing_id), run_at, recurrence)
+                )
+            )
+
+
+def _on_scheduled_run_done(mailing_id: int, run: MailingRun, run_at: str, recurrence) -> None:
+    if run.error is not None:
+        status = "failed"
+    elif run.cancelled:
+        status = "cancelled"
+    else:
+        status = "done"
+
+    try:
+        _finish_scheduled_run(mailing_id, run_at, recurrence, status)
+    except Exception as e:  # noqa: BLE001
+        log_error(
+            user_id=run.admin_chat_id,
+            context="scheduled_mailings_worker",
+            message=f"Ошибка при завершении запланированной рассылки ID {mailing_id}",
+            exc=e,
+        )
+
+
+def _finish_scheduled_run(mailing_id: int, run_at: str, recurrence, status: str) -> None:
+    """Записывает итог срабатывания: повторяющуюся рассылку переносит на следующее, разовую закрывает."""
+
+    if recurrence is None:
+        update_scheduled_mailing_status(mailing_id, status)
+        return
+
+    # Отмена одного срабатывания не отменяет серию (серию отменяют из списка запланированных).
+    # Следующее срабатывание считаем от запланированного времени, а не от фактического конца
+    # рассылки; пропущенные (бот был выключен) срабатывания не догоняем
+    scheduled_for = datetime.fromisoformat(run_at)
+    next_run = recurrence.next_after(max(scheduled_for, datetime.now(scheduled_for.tzinfo)))
+    reschedule_recurring_mailing(mailing_id, next_run.isoformat(), run_at)
+    logging.info(
+        "Повторяющаяся рассылка scheduled_id=%s: срабатывание %s, следующее %s",
+        mailing_id,
+        status,
+        next_run.isoformat(),
+    )
+
+
+def _seconds_until_next_run(now: datetime, next_run_at: Optional[str]) -> float:
+    """Сколько спать до ближайшей задачи: не дольше 30 секунд, чтобы подхватывать новые задачи.
+
+    При включённой подготовке просыпаемся и за MAILING_WARMUP_MINUTES до срабатывания (подготовка),
+    и за CONNECTIONS_WARMUP_LEAD_SECONDS (открытие соединений), а затем — ровно к его секунде.
+    """
+
+    if next_run_at is None:
+        return 30.0
+    delta = (datetime.fromisoformat(next_run_at) - now).total_seconds()
+    if MAILING_WARMUP_MINUTES > 0:
+        for lead in (MAILING_WARMUP_MINUTES * 60, CONNECTIONS_WARMUP_LEAD_SECONDS):
+            if delta > lead:
+                return min(30.0, delta - lead)
+    return min(30.0, max(0.01, delta))
+
+
+async def _open_delivery_connections(sender) -> None:
+    """Открывает до DELIVERY_CONCURRENCY соединений пула доставки лёгкими запросами getMe."""
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(sender.get_me() for _ in range(DELIVERY_CONCURRENCY)), return_exceptions=True)
+    failed = sum(1 for result in results if isinstance(result, BaseException))
+    logging.info(
+        "Соединения для рассылки открыты заранее: %s из %s за %.0f мс",
+        len(results) - failed,
+        len(results),
+        (time.monotonic() - started) * 1000,
+    )
+
+
+async def _warm_up_scheduled_mailing(bot, row) -> None:
+    """Готовит запланированную рассылку заранее: читает пост, фиксирует получателей и план доставки.
+
+    Результат привязывается к конкретному срабатыванию (prepared_for = next_run_at); о проблемах
+    админ узнаёт сразу, а не в момент отправки.
+    """
+
+    scheduled_id = int(row["id"])
+    admin_chat_id = int(row["admin_chat_id"])
+    prepared_for = row["next_run_at"]
+    run_at = datetime.fromisoformat(prepared_for)
+
+    # Подготовка к предыдущему срабатыванию (например, после переноса) больше не нужна
+    if row["prepared_mailing_id"]:
+        discard_prepared_mailing(int(row["prepared_mailing_id"]))
+
+    data = {
+        "from_chat": row["from_chat"],
+        "message_id": int(row["message_id"]),
+        "message_ids": parse_message_ids(row["message_ids"], int(row["message_id"])),
+        "mailing_type": row["mailing_type"],
+        "post_link": row["post_link"],
+        "scheduled_id": scheduled_id,
+        "track_clicks": bool(row["track_clicks"]),
+    }
+
+    started = time.monotonic()
+    error: Optional[str] = None
+    prepared: Optional[_PreparedMailing] = None
+    try:
+        prepared = await _prepare_mailing(
+            bot, admin_chat_id, data, MAILING_RATE_PER_SECOND, run_at, freeze=True
+        )
+        if prepared is None:
+            error = "нет получателей"
+    except TelegramBadRequest:
+        error = "исходный пост удалён или недоступен боту"
+    except Exception as e:  # noqa: BLE001
+        error = "ошибка подготовки"
+        log_error(
+            user_id=admin_chat_id,
+            context="scheduled_mailings_worker",
+            message=f"Ошибка подготовки запланированной рассылки ID {scheduled_id}",
+            exc=e,
+        )
+
+    if not save_scheduled_warmup(scheduled_id, prepared_for, prepared.mailing_id if prepared else None, error):
+        # Задачу отменили, пока шла подготовка: подготовленная рассылка никому не нужна
+        if prepared is not None:
+            discard_prepared_mailing(prepared.mailing_id)
+        logging.info("Запланированная рассылка scheduled_id=%s отменена во время подготовки", scheduled_id)
+        return
+    when = run_at.astimezone(TZ).strftime("%H:%M")
+
+    if error is not None:
+        logging.info("Подготовка запланированной рассылки scheduled_id=%s не удалась: %s", scheduled_id, error)
+        await bot.send_message(
+            admin_chat_id,
+            f"Внимание: запланированная рассылка ID {scheduled_id} (старт в {when}) не готова — {error}. "
+            f"Исправьте причину до старта или отмените рассылку; в {when} бот попробует ещё раз.",
+        )
+        return
+
+    logging.info(
+        "Запланированная рассылка scheduled_id=%s подготовлена: mailing_id=%s получателей=%s порядок=%s за %.1f с",
+        scheduled_id,
+        prepared.mailing_id,
+        prepared.recipients_count,
+        prepared.delivery_order,
+        time.monotonic() - started,
+    )
+
+
+async def engagement_scores_worker() -> None:
+    """Фоновая задача, периодически пересчитывающая engagement_score и peak_hour пользователей."""
+
+    while True:
+        if mailing_registry.has_active():
+            logging.info("Пересчёт engagement_score отложен: идёт рассылка")
+            await asyncio.sleep(60)
+            continue
+
+        try:
+            await asyncio.to_thread(refresh_engagement_scores)
+            offset_minutes = int(datetime.now(TZ).utcoffset().total_seconds() // 60)
+            await asyncio.to_thread(refresh_peak_hours, offset_minutes)
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="engagement_scores_worker",
+                message="Ошибка при пересчёте engagement_score / peak_hour",
+                exc=e,
+            )
+        else:
+            logging.info("engagement_score и peak_hour пользователей пересчитаны")
 
-        await asyncio.sleep(30)
+        await asyncio.sleep(ENGAGEMENT_REFRESH_SECONDS)
@@ -1,10 +1,13 @@
+from typing import Optional
+
 from aiogram import Router, F, types
-from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram.filters import CommandStart, Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery
 
 from config import SITE_URL, is_admin
-from db import upsert_user, add_webview_event
+from counters import campaign_counters, mailing_clicks, parse_campaign_payload
+from db import DbSession, upsert_user, add_webview_event
 from keyboards import (
     build_main_menu_markup,
     build_admin_menu_markup,
@@ -19,10 +22,20 @@ router = Router()
 
 
 @router.message(CommandStart())
-async def cmd_start(message: types.Message, state: FSMContext) -> None:
+async def cmd_start(
+    message: types.Message,
+    state: FSMContext,
+    command: CommandObject,
+    db_session: Optional[DbSession] = None,
+) -> None:
     user_id = message.from_user.id
     admin_flag = is_admin(user_id)
-    upsert_user(user_id, is_admin=admin_flag)
+    # /start <payload> из рекламной ссылки t.me/<bot>?start=<payload>: источник первого касания
+    source = parse_campaign_payload(command.args)
+    # /start — явный возврат пользователя: снова включаем ему рассылки
+    upsert_user(user_id, is_admin=admin_flag, session=db_session, source=source, reactivate=True)
+    if source is not None:
+        campaign_counters.record_start(source)
 
     await state.clear()
 
@@ -60,11 +73,18 @@ async def cmd_admin(message: types.Message, state: FSMContext) -> None:
 
 
 @router.callback_query(F.data == "open_webview")
-async def cb_open_webview(callback: CallbackQuery) -> None:
+async def cb_open_webview(
+    callback: CallbackQuery,
+    db_session: Optional[DbSession] = None,
+    shed_load: bool = False,
+) -> None:
     user_id = callback.from_user.id
     admin_flag = is_admin(user_id)
-    upsert_user(user_id, is_admin=admin_flag)
-    add_webview_event(user_id)
+    # Записи фиксируются в конце апдейта (см. DbSessionMiddleware): пользователь — в основной БД, событие — в БД событий;
+    # при перегрузке last_seen не обновляется — событие WebView всё равно записывается
+    upsert_user(user_id, is_admin=admin_flag, session=db_session, touch=not shed_load)
+    add_webview_event(user_id, session=db_session)
+    campaign_counters.record_webview(user_id)
     keyboard = build_admin_reply_keyboard() if admin_flag else build_user_reply_keyboard()
 
     await callback.message.answer(
@@ -72,3 +92,23 @@ async def cb_open_webview(callback: CallbackQuery) -> None:
         reply_markup=keyboard,
     )
     await callback.answer()
+
+
+@router.callback_query(F.data.startswith("mclick_"))
+async def cb_mailing_click(
+    callback: CallbackQuery,
+    db_session: Optional[DbSession] = None,
+    shed_load: bool = False,
+) -> None:
+    user_id = callback.from_user.id
+    raw_id = callback.data.replace("mclick_", "")
+    if raw_id.isdigit():
+        # Клик только копится в памяти; в БД попадает пачкой (см. counters.py)
+        mailing_clicks.record_click(int(raw_id), user_id)
+    upsert_user(user_id, is_admin=is_admin(user_id), session=db_session, touch=not shed_load)
+
+    await callback.message.answer(
+        "Откройте сервис по кнопке ниже:",
+        reply_markup=build_open_site_inline_markup(SITE_URL),
+    )
+    await callback.answer()
@@ -38,6 +38,9 @@ def build_admin_menu_markup() -> InlineKeyboardMarkup:
             ],
             [InlineKeyboardButton(text="Статистика", callback_data="admin_show_stats")],
             [InlineKeyboardButton(text="Запланированные рассылки", callback_data="admin_scheduled_mailings")],
+            [InlineKeyboardButton(text="Активные рассылки", callback_data="admin_running_mailings")],
+            [InlineKeyboardButton(text="Кампании", callback_data="admin_campaigns")],
+            [InlineKeyboardButton(text="Когорты", callback_data="admin_cohorts")],
             [InlineKeyboardButton(text="Закрыть", callback_data="admin_close")],
         ]
     )
@@ -58,13 +61,17 @@ def build_mailing_type_markup() -> InlineKeyboardMarkup:
     )
 
 
-def build_mailing_confirm_markup() -> InlineKeyboardMarkup:
+def build_mailing_confirm_markup(track_clicks: bool = False) -> InlineKeyboardMarkup:
+    track_label = "✅ Кнопка «Играть» со статистикой кликов" if track_clicks else "➕ Кнопка «Играть» со статистикой кликов"
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(text="Отправить сейчас", callback_data="mconfirm_send"),
                 InlineKeyboardButton(text="Запланировать", callback_data="mconfirm_schedule"),
             ],
+            [
+                InlineKeyboardButton(text=track_label, callback_data="mconfirm_track"),
+            ],
             [
                 InlineKeyboardButton(text="Отмена", callback_data="mconfirm_cancel"),
             ]
@@ -72,11 +79,20 @@ def build_mailing_confirm_markup() -> InlineKeyboardMarkup:
     )
 
 
+def build_mailing_click_button(mailing_id: int) -> InlineKeyboardButton:
+    """Отслеживаемая кнопка «Играть» под рассылкой: клик считается по mailing_id и открывает ссылку на сервис."""
+
+    return InlineKeyboardButton(text="Играть", callback_data=f"mclick_{mailing_id}")
+
+
 def build_channel_posts_list_markup(rows) -> InlineKeyboardMarkup:
     buttons = []
     for index, row in enumerate(rows, start=1):
         title = row["text_preview"] or "Пост без текста"
         title = title.replace("\n", " ")
+        message_ids = row["message_ids"] or ""
+        if "," in message_ids:
+            title = f"[альбом, {message_ids.count(',') + 1}] {title}"
         max_len = 70
         if len(title) > max_len:
             title = title[: max_len - 1] + "…"
@@ -88,6 +104,26 @@ def build_channel_posts_list_markup(rows) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def build_running_mailings_markup(runs) -> InlineKeyboardMarkup:
+    buttons = []
+    for run in runs:
+        toggle = (
+            InlineKeyboardButton(text=f"▶️ #{run.run_id}", callback_data=f"mrun_resume_{run.run_id}")
+            if run.paused
+            else InlineKeyboardButton(text=f"⏸ #{run.run_id}", callback_data=f"mrun_pause_{run.run_id}")
+        )
+        buttons.append(
+            [
+                toggle,
+                InlineKeyboardButton(text="🐢 ×½", callback_data=f"mrun_slower_{run.run_id}"),
+                InlineKeyboardButton(text="🐇 ×2", callback_data=f"mrun_faster_{run.run_id}"),
+                InlineKeyboardButton(text="⛔", callback_data=f"mrun_cancel_{run.run_id}"),
+            ]
+        )
+    buttons.append([InlineKeyboardButton(text="Обновить", callback_data="mrun_refresh_0")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 def build_user_reply_keyboard() -> ReplyKeyboardMarkup:
     play_button = KeyboardButton(text="Играть")
     return ReplyKeyboardMarkup(keyboard=[[play_button]], resize_keyboard=True)
@@ -0,0 +1,226 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    LinkPreviewOptions,
+    MessageEntity,
+)
+
+from db import get_channel_post_content, save_channel_post_content
+from logger_utils import log_error
+
+
+# Типы сообщений, которые умеем отправлять «родным» методом из закэшированного payload.
+# Для остальных (опросы, геопозиции и т.п.) рассылка откатывается на copy_message.
+_MEDIA_KINDS = ("photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker")
+_ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+
+def _dump_entities(entities: Optional[Sequence[MessageEntity]]) -> Optional[List[Dict[str, Any]]]:
+    if not entities:
+        return None
+    return [entity.model_dump(mode="json", exclude_none=True) for entity in entities]
+
+
+def _load_entities(raw: Optional[List[Dict[str, Any]]]) -> Optional[List[MessageEntity]]:
+    if not raw:
+        return None
+    return [MessageEntity.model_validate(item) for item in raw]
+
+
+def extract_payload(message: types.Message) -> Optional[Dict[str, Any]]:
+    """Достаёт из сообщения всё, что нужно для повторной отправки: текст, entities, file_id, кнопки.
+
+    Возвращает None, если тип сообщения не поддерживается.
+    """
+
+    payload: Dict[str, Any] = {}
+
+    if message.text is not None:
+        payload["kind"] = "text"
+        payload["text"] = message.text
+        payload["entities"] = _dump_entities(message.entities)
+        if message.link_preview_options is not None:
+            payload["link_preview_options"] = message.link_preview_options.model_dump(mode="json", exclude_none=True)
+    else:
+        # animation проверяем раньше document: у GIF-анимаций Telegram заполняет оба поля
+        kind = next((k for k in ("animation", *_MEDIA_KINDS) if getattr(message, k, None)), None)
+        if kind is None:
+            return None
+
+        media = getattr(message, kind)
+        payload["kind"] = kind
+        # У фото список размеров — берём самый большой
+        payload["file_id"] = media[-1].file_id if kind == "photo" else media.file_id
+        if kind not in ("video_note", "sticker"):
+            payload["caption"] = message.caption
+            payload["caption_entities"] = _dump_entities(message.caption_entities)
+        if message.has_media_spoiler:
+            payload["has_spoiler"] = True
+        if getattr(message, "show_caption_above_media", None):
+            payload["show_caption_above_media"] = True
+
+    if message.reply_markup is not None:
+        payload["reply_markup"] = message.reply_markup.model_dump(mode="json", exclude_none=True)
+
+    return payload
+
+
+def dump_content(payloads: Sequence[Dict[str, Any]]) -> str:
+    return json.dumps(list(payloads), ensure_ascii=False)
+
+
+def load_content(raw: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+    if not raw:
+        return None
+    return json.loads(raw)
+
+
+def dump_payload(payload: Optional[Dict[str, Any]]) -> Optional[str]:
+    return json.dumps(payload, ensure_ascii=False) if payload is not None else None
+
+
+async def _probe_payload(bot: Bot, probe_chat_id: int, from_chat: str, message_id: int) -> Optional[Dict[str, Any]]:
+    """Читает сообщение, которого нет в channel_post_content: пересылает его в служебный чат, разбирает и удаляет копию.
+
+    Бот не может прочитать сообщение канала по id напрямую, поэтому используется forward_message,
+    который возвращает полное сообщение. Если источник недоступен, пробрасывается TelegramBadRequest.
+    """
+
+    forwarded = await bot.forward_message(
+        chat_id=probe_chat_id,
+        from_chat_id=from_chat,
+        message_id=message_id,
+        disable_notification=True,
+    )
+    try:
+        return extract_payload(forwarded)
+    finally:
+        try:
+            await bot.delete_message(chat_id=probe_chat_id, message_id=forwarded.message_id)
+        except TelegramBadRequest as e:
+            log_error(
+                user_id=probe_chat_id,
+                context="mailing_content_resolve",
+                message="Не удалось удалить служебную копию поста",
+                exc=e,
+            )
+
+
+async def resolve_content(
+    bot: Bot,
+    probe_chat_id: int,
+    from_chat: str,
+    message_ids: Sequence[int],
+) -> Optional[List[Dict[str, Any]]]:
+    """Содержимое поста для рассылки.
+
+    Берётся из channel_post_content — бот сохраняет туда каждый пост канала при получении (и после
+    редактирования), без обращений к Bot API. Только сообщения, которых там нет (пост опубликован
+    до появления бота в канале или ссылка на чужой канал), читаются пересылкой в probe_chat_id
+    и тоже сохраняются — следующие срабатывания повторяющейся рассылки их уже не пересылают.
+    Возвращает None, если хотя бы одно сообщение не поддерживается (тогда шлём через copy_message).
+    """
+
+    stored = get_channel_post_content(from_chat, message_ids)
+    payloads: List[Dict[str, Any]] = []
+    for message_id in message_ids:
+        if message_id in stored:
+            raw = stored[message_id]
+            payload = json.loads(raw) if raw is not None else None
+        else:
+            payload = await _probe_payload(bot, probe_chat_id, from_chat, message_id)
+            save_channel_post_content(from_chat, message_id, dump_payload(payload))
+
+        if payload is None:
+            return None
+        payloads.append(payload)
+
+    if len(payloads) > 1 and any(p["kind"] not in _ALBUM_MEDIA for p in payloads):
+        # В альбоме могут быть только фото/видео/документы/аудио
+        return None
+
+    return payloads
+
+
+def with_extra_button(payloads: Sequence[Dict[str, Any]], button: InlineKeyboardButton) -> List[Dict[str, Any]]:
+    """Копия контента с дополнительной строкой кнопок; только для одиночных сообщений (у альбомов кнопок нет)."""
+
+    if len(payloads) != 1:
+        raise ValueError("Кнопку можно добавить только к одиночному сообщению")
+
+    payload = dict(payloads[0])
+    markup = payload.get("reply_markup") or {"inline_keyboard": []}
+    payload["reply_markup"] = {
+        **markup,
+        "inline_keyboard": [*markup.get("inline_keyboard", []), [button.model_dump(mode="json", exclude_none=True)]],
+    }
+    return [payload]
+
+
+async def send_payload(bot: Bot, chat_id: int, payloads: Sequence[Dict[str, Any]]) -> None:
+    """Отправляет закэшированный контент «родным» методом: send_message / send_photo / send_media_group и т.д."""
+
+    if len(payloads) > 1:
+        media = []
+        for payload in payloads:
+            media_cls = _ALBUM_MEDIA[payload["kind"]]
+            kwargs: Dict[str, Any] = {
+                "media": payload["file_id"],
+                "caption": payload.get("caption"),
+                "caption_entities": _load_entities(payload.get("caption_entities")),
+            }
+            if payload.get("has_spoiler") and payload["kind"] in ("photo", "video"):
+                kwargs["has_spoiler"] = True
+            media.append(media_cls(**kwargs))
+        await bot.send_media_group(chat_id=chat_id, media=media)
+        return
+
+    payload = payloads[0]
+    kind = payload["kind"]
+    reply_markup = (
+        InlineKeyboardMarkup.model_validate(payload["reply_markup"]) if payload.get("reply_markup") else None
+    )
+
+    if kind == "text":
+        preview = payload.get("link_preview_options")
+        await bot.send_message(
+            chat_id=chat_id,
+            text=payload["text"],
+            entities=_load_entities(payload.get("entities")),
+            link_preview_options=LinkPreviewOptions.model_validate(preview) if preview else None,
+            reply_markup=reply_markup,
+        )
+        return
+
+    if kind in ("video_note", "sticker"):
+        method = bot.send_video_note if kind == "video_note" else bot.send_sticker
+        await method(chat_id, payload["file_id"], reply_markup=reply_markup)
+        return
+
+    kwargs = {
+        "caption": payload.get("caption"),
+        "caption_entities": _load_entities(payload.get("caption_entities")),
+        "reply_markup": reply_markup,
+    }
+    if kind in ("photo", "video", "animation"):
+        if payload.get("has_spoiler"):
+            kwargs["has_spoiler"] = True
+        if payload.get("show_caption_above_media"):
+            kwargs["show_caption_above_media"] = True
+
+    method = getattr(bot, f"send_{kind}")
+    await method(chat_id, payload["file_id"], **kwargs)
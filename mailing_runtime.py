@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from config import MAILING_DUPLICATE_WINDOW_SECONDS, MAILING_RATE_PER_SECOND
+from logger_utils import log_error
+
+
+MIN_RATE_PER_SECOND = 1.0
+MAX_RATE_PER_SECOND = 30.0
+
+
+def _new_resume_event() -> asyncio.Event:
+    event = asyncio.Event()
+    event.set()
+    return event
+
+
+@dataclass
+class MailingRun:
+    """Идущая рассылка: прогресс и ручки управления (пауза, отмена, скорость)."""
+
+    run_id: int
+    key: str
+    mailing_type: str
+    admin_chat_id: int
+    rate: float = MAILING_RATE_PER_SECOND
+    mailing_id: Optional[int] = None
+    total: int = 0
+    delivered: int = 0
+    errors: int = 0
+    cancelled: bool = False
+    error: Optional[BaseException] = None
+    task: Optional[asyncio.Task] = None
+    _resume: asyncio.Event = field(default_factory=_new_resume_event)
+    _next_send_at: float = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return not self._resume.is_set()
+
+    @property
+    def processed(self) -> int:
+        return self.delivered + self.errors
+
+    def pause(self) -> None:
+        self._resume.clear()
+
+    def resume(self) -> None:
+        self._resume.set()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        # Будим цикл отправки, если он стоит на паузе, чтобы он сразу увидел отмену
+        self._resume.set()
+
+    def set_rate(self, rate: float) -> float:
+        self.rate = min(MAX_RATE_PER_SECOND, max(MIN_RATE_PER_SECOND, rate))
+        return self.rate
+
+    async def throttle(self) -> bool:
+        """Ждёт очереди на следующую отправку с учётом паузы и скорости.
+
+        Возвращает False, если рассылку отменили.
+        """
+
+        while True:
+            await self._resume.wait()
+            if self.cancelled:
+                return False
+
+            now = time.monotonic()
+            wait = self._next_send_at - now
+            if wait <= 0:
+                self._next_send_at = max(now, self._next_send_at) + 1.0 / self.rate
+                return True
+
+            # Спим короткими отрезками, чтобы пауза и смена скорости применялись сразу
+            await asyncio.sleep(min(wait, 0.5))
+
+
+class MailingRegistry:
+    """Реестр рассылок, которые сейчас выполняются в этом процессе.
+
+    Реестр свой у каждого процесса: защита от дублей, пауза и отмена работают только потому, что
+    в режиме вебхука все апдейты админов попадают в процесс 0 (см. webhook.pick_worker),
+    где запускаются и запланированные рассылки.
+    """
+
+    def __init__(self, duplicate_window: float = MAILING_DUPLICATE_WINDOW_SECONDS) -> None:
+        self._runs: Dict[int, MailingRun] = {}
+        self._active_keys: Dict[str, int] = {}
+        # Ключ -> время завершения; порядок словаря — по времени завершения (старые в начале)
+        self._finished_keys: Dict[str, float] = {}
+        self._ids = itertools.count(1)
+        self._duplicate_window = duplicate_window
+
+    @staticmethod
+    def make_key(mailing_type: str, from_chat: str, message_ids: Sequence[int]) -> str:
+        """Ключ идемпотентности: один и тот же пост с тем же типом рассылки."""
+
+        return f"{mailing_type}:{from_chat}:{','.join(str(mid) for mid in sorted(message_ids))}"
+
+    def _prune_finished(self, now: float) -> None:
+        """Забывает рассылки, завершившиеся раньше окна дублей, — словарь не растёт бесконечно."""
+
+        while self._finished_keys:
+            key, finished_at = next(iter(self._finished_keys.items()))
+            if now - finished_at < self._duplicate_window:
+                return
+            del self._finished_keys[key]
+
+    def is_duplicate(self, key: str) -> bool:
+        if key in self._active_keys:
+            return True
+
+        self._prune_finished(time.monotonic())
+        return key in self._finished_keys
+
+    def start(
+        self,
+        key: str,
+        mailing_type: str,
+        admin_chat_id: int,
+        runner: Callable[[MailingRun], Awaitable[None]],
+    ) -> Optional[MailingRun]:
+        """Запускает рассылку под надзором реестра. None — такая рассылка уже идёт (повторный запуск)."""
+
+        # Проверка и регистрация идут без await между ними, поэтому двойное нажатие
+        # не может проскочить между ними даже при параллельной обработке апдейтов
+        if self.is_duplicate(key):
+            logging.warning("Повторный запуск рассылки отклонён: key=%s", key)
+            return None
+
+        run = MailingRun(
+            run_id=next(self._ids),
+            key=key,
+            mailing_type=mailing_type,
+            admin_chat_id=admin_chat_id,
+        )
+        self._runs[run.run_id] = run
+        self._active_keys[key] = run.run_id
+        run.task = asyncio.create_task(self._supervise(run, runner))
+        return run
+
+    async def _supervise(self, run: MailingRun, runner: Callable[[MailingRun], Awaitable[None]]) -> None:
+        try:
+            await runner(run)
+        except Exception as e:  # noqa: BLE001
+            run.error = e
+            log_error(
+                user_id=run.admin_chat_id,
+                context="mailing_runtime",
+                message=f"Рассылка run_id={run.run_id} завершилась с ошибкой",
+                exc=e,
+            )
+        finally:
+            self._runs.pop(run.run_id, None)
+            self._active_keys.pop(run.key, None)
+            now = time.monotonic()
+            # Повторно завершённый ключ переносится в конец, чтобы порядок оставался по времени
+            self._finished_keys.pop(run.key, None)
+            self._finished_keys[run.key] = now
+            self._prune_finished(now)
+
+    def get(self, run_id: int) -> Optional[MailingRun]:
+        return self._runs.get(run_id)
+
+    def active(self) -> List[MailingRun]:
+        return sorted(self._runs.values(), key=lambda run: run.run_id)
+
+    def has_active(self) -> bool:
+        return bool(self._runs)
+
+
+mailing_registry = MailingRegistry()
@@ -2,32 +2,89 @@ import asyncio
 import logging
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN, ADMIN_IDS
+from config import ADMIN_IDS, BOT_MODE
+from counters import counters_worker, flush_all_counters
 from db import init_db
+from delivery import create_bot, create_delivery_bot
+from fsm_storage import fsm_cleanup_worker, fsm_storage
 from handlers_start import router as start_router
-from handlers_admin import router as admin_router
-from handlers_mailings import router as mailings_router, scheduled_mailings_worker
+from handlers_admin import (
+    router as admin_router,
+    analytics_snapshot_worker,
+    db_checkpoint_worker,
+    mailing_deliveries_purge_worker,
+)
+from handlers_mailings import router as mailings_router, scheduled_mailings_worker, engagement_scores_worker
 from handlers_channel import router as channel_router
+from middlewares import DbSessionMiddleware, antiflood, update_lanes
 
 
-async def main() -> None:
-    init_db()
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+def create_dispatcher(delivery_bot: Bot) -> Dispatcher:
+    """Dispatcher со всеми роутерами и middleware бота (используется и нагрузочным стендом)."""
+
+    # Состояния FSM в БД: диалоги админки переживают перезапуск
+    dp = Dispatcher(storage=fsm_storage)
+    # Флуд от отдельных пользователей отсекается до очередей и БД
+    dp.update.outer_middleware(antiflood)
+    # Раздельные очереди админов, постов канала и пользователей; сессия БД открывается после очереди
+    dp.update.outer_middleware(update_lanes)
+    # Одна сессия БД на апдейт: по одной транзакции на каждый файл БД
+    dp.update.outer_middleware(DbSessionMiddleware())
+    dp["delivery_bot"] = delivery_bot
 
     dp.include_router(start_router)
     dp.include_router(admin_router)
     dp.include_router(mailings_router)
     dp.include_router(channel_router)
+    return dp
 
+
+def start_background_workers(bot: Bot, delivery_bot: Bot, primary: bool = True) -> list[asyncio.Task]:
+    """Запускает фоновые задачи. primary=False — дополнительный процесс вебхука: только задачи своего процесса."""
+
+    # Пачечная запись счётчиков кампаний (/start <payload>) и кликов по кнопкам рассылок
+    tasks = [asyncio.create_task(counters_worker())]
+    # Удаление брошенных состояний FSM (у каждого процесса свой кэш ключей)
+    tasks.append(asyncio.create_task(fsm_cleanup_worker()))
+    if not primary:
+        return tasks
     # Фоновый планировщик запланированных рассылок
-    asyncio.create_task(scheduled_mailings_worker(bot))
+    tasks.append(asyncio.create_task(scheduled_mailings_worker(bot, delivery_bot)))
+    # Пересчёт скоров вовлечённости для порядка доставки MAILING_ORDER=engagement
+    tasks.append(asyncio.create_task(engagement_scores_worker()))
+    # Снимок БД только для чтения под статистику и отчёты админки
+    tasks.append(asyncio.create_task(analytics_snapshot_worker()))
+    # Плановый checkpoint WAL основной БД и БД событий
+    tasks.append(asyncio.create_task(db_checkpoint_worker()))
+    # Удаление устаревших итогов доставки рассылок из БД событий
+    tasks.append(asyncio.create_task(mailing_deliveries_purge_worker()))
+    return tasks
 
-    logging.info("Бот запускается. Админы: %s", ADMIN_IDS)
-    await dp.start_polling(bot)
+
+async def main() -> None:
+    init_db()
+    bot = create_bot()
+    # Рассылки идут через отдельный HTTP-пул и не отнимают соединения у getUpdates и ответов
+    delivery_bot = create_delivery_bot()
+    dp = create_dispatcher(delivery_bot)
+
+    start_background_workers(bot, delivery_bot)
+
+    logging.info("Бот запускается (long polling). Админы: %s", ADMIN_IDS)
+    try:
+        # Если раньше бот работал через вебхук, getUpdates вернёт конфликт, пока вебхук не снят
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        flush_all_counters()
+        await delivery_bot.session.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+
+        run_webhook(create_dispatcher, start_background_workers)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import TelegramObject, Update, User
+
+from config import (
+    ANTIFLOOD_LIMIT,
+    ANTIFLOOD_WINDOW_SECONDS,
+    LANE_ADMIN_CONCURRENCY,
+    LANE_CHANNEL_CONCURRENCY,
+    LANE_QUEUE_LIMIT,
+    LANE_SHED_BACKLOG,
+    LANE_USER_CONCURRENCY,
+    is_admin,
+)
+from db import DbSession
+from logger_utils import log_error
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт: записи обработчика фиксируются в конце, одной транзакцией на каждый файл БД
+    (основная и события — см. DbSession).
+
+    Обработчик получает сессию аргументом db_session и передаёт её в функции db.py.
+    """
+
+    def __init__(self) -> None:
+        self.updates = 0
+        self.commits = 0
+        self.statements = 0
+        self.commit_seconds = 0.0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        session = DbSession()
+        data["db_session"] = session
+        try:
+            return await handler(event, data)
+        finally:
+            # Фиксируем записи и при ошибке обработчика (например, не удалось ответить пользователю):
+            # факт визита или открытия WebView к этому моменту уже произошёл
+            self._commit(session)
+
+    def _commit(self, session: DbSession) -> None:
+        self.updates += 1
+        pending = session.pending
+        if not pending:
+            return
+
+        started = time.perf_counter()
+        try:
+            session.commit()
+        except Exception as e:  # noqa: BLE001
+            log_error(
+                user_id=None,
+                context="db_session_middleware",
+                message=f"Не удалось зафиксировать {pending} записей апдейта",
+                exc=e,
+            )
+            return
+
+        self.commits += 1
+        self.statements += pending
+        self.commit_seconds += time.perf_counter() - started
+        if self.commits % 1000 == 0:
+            logging.info(
+                "DbSession: апдейтов=%s коммитов=%s записей=%s среднее время коммита=%.2f мс",
+                self.updates,
+                self.commits,
+                self.statements,
+                self.commit_seconds / self.commits * 1000,
+            )
+
+
+class _Lane:
+    """Очередь апдейтов одного вида: ограничение одновременной обработки и счётчики."""
+
+    def __init__(self, name: str, label: str, concurrency: int) -> None:
+        self.name = name
+        self.label = label
+        self.concurrency = max(1, concurrency)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.max_wait = 0.0
+
+
+class UpdateLanesMiddleware(BaseMiddleware):
+    """Раздельные очереди обработки апдейтов: админы, посты канала и пользователи.
+
+    У каждой очереди свой лимит одновременной обработки, поэтому всплеск нажатий «Играть» и open_webview
+    после рассылки не задерживает команды админа (например, паузу рассылки) и приём постов канала.
+
+    - В очереди может ждать не больше LANE_QUEUE_LIMIT апдейтов, лишние отбрасываются без обработки.
+    - Если в очереди пользователей ждут LANE_SHED_BACKLOG апдейтов и больше, обработчики получают
+      shed_load=True и пропускают второстепенные записи (повторное обновление last_seen).
+
+    Регистрируется раньше DbSessionMiddleware: сессия БД открывается, когда апдейт уже дождался очереди.
+    """
+
+    def __init__(
+        self,
+        admin_concurrency: int = LANE_ADMIN_CONCURRENCY,
+        channel_concurrency: int = LANE_CHANNEL_CONCURRENCY,
+        user_concurrency: int = LANE_USER_CONCURRENCY,
+        queue_limit: int = LANE_QUEUE_LIMIT,
+        shed_backlog: int = LANE_SHED_BACKLOG,
+    ) -> None:
+        self.lanes = {
+            "admin": _Lane("admin", "админы", admin_concurrency),
+            "channel": _Lane("channel", "посты канала", channel_concurrency),
+            "user": _Lane("user", "пользователи", user_concurrency),
+        }
+        self.queue_limit = queue_limit
+        self.shed_backlog = shed_backlog
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _lane_for(self, event: TelegramObject, data: Dict[str, Any]) -> _Lane:
+        if isinstance(event, Update) and (event.channel_post or event.edited_channel_post):
+            return self.lanes["channel"]
+        user: Optional[User] = data.get("event_from_user")
+        if user is not None and is_admin(user.id):
+            return self.lanes["admin"]
+        return self.lanes["user"]
+
+    def _semaphore(self, lane: _Lane) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый event loop (повторный asyncio.run в инструментах) — семафоры создаются заново
+            self._loop = loop
+            for item in self.lanes.values():
+                item.semaphore = None
+        if lane.semaphore is None:
+            lane.semaphore = asyncio.Semaphore(lane.concurrency)
+        return lane.semaphore
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        lane = self._lane_for(event, data)
+        if lane.waiting >= self.queue_limit:
+            lane.dropped += 1
+            if lane.dropped % 1000 == 1:
+                logging.warning("Очередь «%s» переполнена, отброшено апдейтов: %s", lane.label, lane.dropped)
+            return None
+
+        shed_load = lane.name == "user" and lane.waiting >= self.shed_backlog
+        data["shed_load"] = shed_load
+        if shed_load:
+            lane.shed += 1
+
+        semaphore = self._semaphore(lane)
+        enqueued_at = time.monotonic()
+        lane.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            lane.waiting -= 1
+        lane.max_wait = max(lane.max_wait, time.monotonic() - enqueued_at)
+
+        lane.active += 1
+        try:
+            return await handler(event, data)
+        finally:
+            lane.active -= 1
+            lane.processed += 1
+            semaphore.release()
+
+    def depths(self) -> Dict[str, int]:
+        return {name: lane.waiting for name, lane in self.lanes.items()}
+
+    def describe(self) -> str:
+        lines = [f"Очереди апдейтов (облегчённая обработка с {self.shed_backlog} ожидающих):"]
+        for lane in self.lanes.values():
+            line = (
+                f"• {lane.label}: в очереди {lane.waiting}, обрабатывается {lane.active}/{lane.concurrency}, "
+                f"обработано {lane.processed}, макс. ожидание {lane.max_wait * 1000:.0f} мс"
+            )
+            if lane.shed:
+                line += f", облегчено {lane.shed}"
+            if lane.dropped:
+                line += f", отброшено {lane.dropped}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+ANTIFLOOD_TEXT = "Слишком много нажатий, подождите несколько секунд."
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """Ограничение частоты апдейтов от одного пользователя до входа в очереди и обработчики.
+
+    На пользователя хранится скользящее окно из двух счётчиков (прошлое и текущее окно длиной window):
+    оценка числа апдейтов за последние window секунд — текущий счётчик плюс доля прошлого.
+    Апдейты сверх limit не доходят до обработчиков и БД: сообщения отбрасываются молча, на нажатие
+    кнопки один раз за окно отвечается коротким уведомлением (answerCallbackQuery), чтобы у клиента
+    не крутился индикатор загрузки. Записи пользователей, молчавших два окна, раз в окно удаляются.
+
+    Админы и апдейты без пользователя (посты канала) не ограничиваются.
+    """
+
+    def __init__(self, limit: int = ANTIFLOOD_LIMIT, window: float = ANTIFLOOD_WINDOW_SECONDS) -> None:
+        self.limit = limit
+        self.window = window
+        # user_id -> [номер окна, апдейтов в прошлом окне, в текущем, окно последнего уведомления]
+        self._windows: Dict[int, list[int]] = {}
+        self._evict_index = 0
+        self.limited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0 and self.window > 0
+
+    def _evict(self, index: int) -> None:
+        self._windows = {user_id: entry for user_id, entry in self._windows.items() if entry[0] >= index - 1}
+
+    def hit(self, user_id: int, now: float) -> tuple[bool, bool]:
+        """Учитывает апдейт. Возвращает (пропустить, уведомить пользователя об ограничении)."""
+
+        position = now / self.window
+        index = int(position)
+        if index > self._evict_index:
+            self._evict_index = index
+            self._evict(index)
+
+        entry = self._windows.get(user_id)
+        if entry is None:
+            entry = [index, 0, 0, -1]
+            self._windows[user_id] = entry
+        elif entry[0] != index:
+            entry[1] = entry[2] if entry[0] == index - 1 else 0
+            entry[2] = 0
+            entry[0] = index
+
+        estimate = entry[1] * (1 - (position - index)) + entry[2]
+        if estimate >= self.limit:
+            notify = entry[3] != index
+            entry[3] = index
+            return False, notify
+        entry[2] += 1
+        return True, False
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if not self.enabled or user is None or is_admin(user.id):
+            return await handler(event, data)
+
+        allowed, notify = self.hit(user.id, time.monotonic())
+        if allowed:
+            return await handler(event, data)
+
+        self.limited += 1
+        if notify and isinstance(event, Update) and event.callback_query is not None:
+            try:
+                await event.callback_query.answer(ANTIFLOOD_TEXT)
+            except TelegramAPIError:
+                pass
+        return None
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "Антифлуд: выключен."
+        return (
+            f"Антифлуд: не больше {self.limit} апдейтов за {self.window:g} с, отклонено {self.limited}, "
+            f"отслеживается пользователей {len(self._windows)}"
+        )
+
+
+update_lanes = UpdateLanesMiddleware()
+antiflood = AntiFloodMiddleware()
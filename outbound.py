@@ -0,0 +1,307 @@
+import asyncio
+import statistics
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, Optional, Protocol
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (
+    OUTBOUND_BURST,
+    OUTBOUND_CHAT_PER_SECOND,
+    OUTBOUND_GLOBAL_PER_SECOND,
+    OUTBOUND_GROUP_PER_MINUTE,
+)
+
+
+# Приоритеты исходящих сообщений: ответы пользователям и админам всегда идут раньше рассылок
+INTERACTIVE = 0
+BROADCAST = 1
+PRIORITY_LABELS = ("ответы", "рассылки")
+
+# Методы Bot API, которые Telegram считает отправкой сообщения в чат
+_MESSAGE_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+# Начинаются с send, но сообщений не создают и лимит сообщений чата не расходуют
+_NON_MESSAGE_METHODS = {"sendChatAction"}
+
+# Сколько последних ожиданий хранится для перцентилей
+_RECENT_WAITS = 1000
+# При таком числе отслеживаемых чатов из словаря выбрасываются те, чей лимит уже восстановился
+_CHAT_EVICT_THRESHOLD = 10_000
+
+
+def _is_message_method(method: Any) -> bool:
+    name = getattr(method, "__api_method__", "")
+    if name in _NON_MESSAGE_METHODS:
+        return False
+    return name.startswith("send") or name in _MESSAGE_METHODS
+
+
+def _message_cost(method: Any) -> int:
+    """Сколько сообщений создаёт запрос: альбом считается поштучно."""
+
+    media = getattr(method, "media", None)
+    if isinstance(media, list):
+        return max(1, len(media))
+    message_ids = getattr(method, "message_ids", None)
+    if isinstance(message_ids, list):
+        return max(1, len(message_ids))
+    return 1
+
+
+class _LaneStats:
+    """Метрики одного приоритета: выдано слотов и время ожидания в очереди."""
+
+    def __init__(self) -> None:
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent: Deque[float] = deque(maxlen=_RECENT_WAITS)
+
+    def record(self, wait: float) -> None:
+        self.granted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+    def percentile(self, q: int) -> float:
+        if len(self.recent) < 2:
+            return self.recent[0] if self.recent else 0.0
+        return statistics.quantiles(self.recent, n=100, method="inclusive")[q - 1]
+
+
+class RemoteSlots(Protocol):
+    """Источник слотов в другом процессе (процессы-обработчики вебхука получают слоты у главного процесса)."""
+
+    async def acquire(self, chat_id: Optional[Hashable], priority: int, cost: int) -> None: ...
+
+    def pause(self, seconds: float) -> None: ...
+
+
+class OutboundScheduler:
+    """Общий планировщик исходящих сообщений для всех клиентов бота (polling-бот и пул рассылок).
+
+    Лимиты Telegram считаются по алгоритму GCRA (виртуальный таймер с допуском на всплеск OUTBOUND_BURST):
+    - на чат: OUTBOUND_CHAT_PER_SECOND для личных чатов и OUTBOUND_GROUP_PER_MINUTE для групп и каналов;
+      место в лимите чата резервируется сразу, поэтому ожидание одного чата не задерживает остальные;
+    - общий: OUTBOUND_GLOBAL_PER_SECOND — слоты выдаёт одна задача-диспетчер, строго отдавая
+      приоритет очереди INTERACTIVE перед BROADCAST.
+
+    После 429 (TelegramRetryAfter) выдача слотов приостанавливается на retry_after для всех.
+
+    В процессах-обработчиках вебхука (use_remote) слоты вместе с лимитами чатов выдаёт планировщик
+    главного процесса — одна очередь с приоритетами и одна пауза после 429 на все процессы.
+    """
+
+    def __init__(
+        self,
+        per_second: float = OUTBOUND_GLOBAL_PER_SECOND,
+        chat_per_second: float = OUTBOUND_CHAT_PER_SECOND,
+        group_per_minute: float = OUTBOUND_GROUP_PER_MINUTE,
+        burst: int = OUTBOUND_BURST,
+    ) -> None:
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.chat_interval = 1.0 / chat_per_second if chat_per_second > 0 else 0.0
+        self.group_interval = 60.0 / group_per_minute if group_per_minute > 0 else 0.0
+        self.burst = max(1, burst)
+
+        self._queues: tuple[Deque[tuple[asyncio.Future, int]], ...] = (deque(), deque())
+        self._chat_waiting = [0, 0]
+        self._global_tat = 0.0
+        self._chat_tat: Dict[Hashable, float] = {}
+        self._paused_until = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._remote: Optional[RemoteSlots] = None
+        self._remote_waiting = [0, 0]
+        self.lanes = (_LaneStats(), _LaneStats())
+        self.retry_after_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def use_remote(self, remote: RemoteSlots) -> None:
+        """Дальше слоты выдаёт remote, а не этот процесс."""
+
+        self._remote = remote
+
+    def middleware(self, priority: int) -> "OutboundMiddleware":
+        return OutboundMiddleware(self, priority)
+
+    # ------------------------------------------------------------------
+    # Выдача слотов
+    # ------------------------------------------------------------------
+
+    def _chat_interval(self, chat_id: Hashable) -> float:
+        is_private = isinstance(chat_id, int) and chat_id > 0
+        return self.chat_interval if is_private else self.group_interval
+
+    def _reserve_chat(self, chat_id: Hashable, cost: int, now: float) -> float:
+        """Резервирует место в лимите чата; возвращает, сколько секунд подождать."""
+
+        interval = self._chat_interval(chat_id)
+        if not interval:
+            return 0.0
+
+        if len(self._chat_tat) > _CHAT_EVICT_THRESHOLD:
+            self._chat_tat = {key: tat for key, tat in self._chat_tat.items() if tat > now}
+
+        tat = max(self._chat_tat.get(chat_id, now), now)
+        allowed_at = max(now, tat - interval * (self.burst - 1))
+        self._chat_tat[chat_id] = tat + interval * cost
+        return allowed_at - now
+
+    def _release_chat(self, chat_id: Hashable, cost: int) -> None:
+        """Возвращает место в лимите чата, если отправку отменили до выдачи слота."""
+
+        interval = self._chat_interval(chat_id)
+        if interval and chat_id in self._chat_tat:
+            self._chat_tat[chat_id] -= interval * cost
+
+    async def acquire(self, chat_id: Optional[Hashable], priority: int, cost: int = 1) -> None:
+        enqueued_at = time.monotonic()
+
+        if self._remote is not None:
+            self._remote_waiting[priority] += 1
+            try:
+                await self._remote.acquire(chat_id, priority, cost)
+            finally:
+                self._remote_waiting[priority] -= 1
+            self.lanes[priority].record(time.monotonic() - enqueued_at)
+            return
+
+        if chat_id is not None:
+            delay = self._reserve_chat(chat_id, cost, enqueued_at)
+            if delay > 0:
+                self._chat_waiting[priority] += 1
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    # Сообщение не уйдёт — зарезервированное место не должно задерживать следующие в этот чат
+                    self._release_chat(chat_id, cost)
+                    raise
+                finally:
+                    self._chat_waiting[priority] -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append((future, cost))
+        self._ensure_dispatcher()
+        assert self._wakeup is not None
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Диспетчер пропускает отменённые ожидания; место в лимите чата возвращается
+            future.cancel()
+            if chat_id is not None:
+                self._release_chat(chat_id, cost)
+            raise
+        self.lanes[priority].record(time.monotonic() - enqueued_at)
+
+    def pause(self, seconds: float) -> None:
+        self.retry_after_count += 1
+        if self._remote is not None:
+            self._remote.pause(seconds)
+            return
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _ensure_dispatcher(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Новый event loop (например, повторный asyncio.run в инструментах) — диспетчер создаётся заново
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._dispatcher = None
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def _peek(self) -> Optional[Deque[tuple[asyncio.Future, int]]]:
+        for queue in self._queues:
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if queue:
+                return queue
+        return None
+
+    async def _dispatch(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            queue = self._peek()
+            if queue is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            ready_at = max(self._paused_until, self._global_tat - self.interval * (self.burst - 1))
+            if ready_at > now:
+                # После паузы очередь выбирается заново: за это время мог прийти ответ пользователю
+                await asyncio.sleep(ready_at - now)
+                continue
+
+            future, cost = queue.popleft()
+            self._global_tat = max(self._global_tat, now) + self.interval * cost
+            future.set_result(None)
+
+    # ------------------------------------------------------------------
+    # Метрики
+    # ------------------------------------------------------------------
+
+    def depth(self, priority: int) -> int:
+        queued = sum(1 for future, _ in self._queues[priority] if not future.done())
+        return queued + self._chat_waiting[priority] + self._remote_waiting[priority]
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        result: Dict[str, Dict[str, float]] = {}
+        for priority, label in enumerate(PRIORITY_LABELS):
+            lane = self.lanes[priority]
+            result[label] = {
+                "depth": self.depth(priority),
+                "granted": lane.granted,
+                "avg_wait_ms": lane.total_wait / lane.granted * 1000 if lane.granted else 0.0,
+                "p50_wait_ms": lane.percentile(50) * 1000,
+                "p99_wait_ms": lane.percentile(99) * 1000,
+                "max_wait_ms": lane.max_wait * 1000,
+            }
+        return result
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "Очередь исходящих сообщений: ограничение выключено."
+        source = ", слоты выдаёт главный процесс вебхука" if self._remote is not None else ""
+        lines = [
+            f"Очередь исходящих сообщений (лимит {1 / self.interval:g} сообщ./с, "
+            f"429 получено: {self.retry_after_count}{source}):"
+        ]
+        for label, values in self.stats().items():
+            lines.append(
+                f"• {label}: в очереди {values['depth']:.0f}, отправлено {values['granted']:.0f}, "
+                f"ожидание p50 {values['p50_wait_ms']:.0f} мс, p99 {values['p99_wait_ms']:.0f} мс, "
+                f"макс. {values['max_wait_ms']:.0f} мс",
+            )
+        return "\n".join(lines)
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: каждая отправка сообщения сначала получает слот у планировщика."""
+
+    def __init__(self, scheduler: OutboundScheduler, priority: int) -> None:
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def __call__(self, make_request, bot, method):
+        if not self.scheduler.enabled or not _is_message_method(method):
+            return await make_request(bot, method)
+
+        await self.scheduler.acquire(getattr(method, "chat_id", None), self.priority, _message_cost(method))
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.scheduler.pause(e.retry_after)
+            raise
+
+
+outbound_scheduler = OutboundScheduler()
@@ -0,0 +1,200 @@
+import asyncio
+import linecache
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+
+
+MAX_PROFILE_SECONDS = 300
+TOP_LIMIT = 40
+
+# Одновременно выполняется не больше одного профилирования
+_profile_lock = asyncio.Lock()
+
+
+def is_profiling() -> bool:
+    return _profile_lock.locked()
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_filename}:{code.co_firstlineno} {code.co_name}"
+
+
+class SamplingProfiler:
+    """Сэмплирующий CPU-профайлер для потока с event loop.
+
+    В главном потоке на Linux использует таймер ITIMER_PROF: SIGPROF приходит по мере расхода CPU,
+    а обработчик получает текущий кадр интерпретатора — поэтому простой в select() почти не попадает
+    в отчёт. В остальных случаях стек целевого потока снимает отдельный поток через
+    sys._current_frames(); такие сэмплы смещены к местам, где код отпускает GIL.
+
+    Считаются «собственное» время (функция на вершине стека) и «суммарное» (функция есть в стеке).
+    Пока профайлер не запущен, накладных расходов нет — никаких хуков в интерпретатор не ставится.
+    """
+
+    def __init__(self, target_thread_id: int, interval: float = 0.005) -> None:
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.samples = 0
+        self.self_counts: Counter = Counter()
+        self.total_counts: Counter = Counter()
+        self.mode = ""
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._previous_handler = None
+
+    def start(self) -> None:
+        use_signal = (
+            hasattr(signal, "setitimer")
+            and threading.get_ident() == self.target_thread_id
+            and threading.current_thread() is threading.main_thread()
+        )
+        if use_signal:
+            self.mode = "SIGPROF"
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            return
+
+        self.mode = "thread"
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self.mode == "SIGPROF":
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+            return
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _on_signal(self, signum, frame) -> None:
+        if frame is not None:
+            self._record(frame)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is not None:
+                self._record(frame)
+
+    def _record(self, frame) -> None:
+        self.samples += 1
+        self.self_counts[_frame_label(frame.f_code)] += 1
+
+        seen: set[str] = set()
+        while frame is not None:
+            label = _frame_label(frame.f_code)
+            if label not in seen:
+                seen.add(label)
+                self.total_counts[label] += 1
+            frame = frame.f_back
+
+    def report(self, seconds: float) -> str:
+        lines = [
+            f"CPU-профиль (сэмплирование), {datetime.now().isoformat(timespec='seconds')}",
+            (
+                f"Длительность: {seconds:.0f} с, интервал: {self.interval * 1000:.0f} мс, "
+                f"режим: {self.mode}, сэмплов: {self.samples}"
+            ),
+            "",
+            f"Топ-{TOP_LIMIT} по собственному времени (функция на вершине стека):",
+        ]
+        lines.extend(self._format(self.self_counts))
+        lines.append("")
+        lines.append(f"Топ-{TOP_LIMIT} по суммарному времени (функция в стеке):")
+        lines.extend(self._format(self.total_counts))
+        return "\n".join(lines)
+
+    def _format(self, counts: Counter) -> list[str]:
+        if not self.samples:
+            return ["  (нет сэмплов)"]
+        return [
+            f"  {count / self.samples * 100:6.2f}%  {count:7d}  {label}"
+            for label, count in counts.most_common(TOP_LIMIT)
+        ]
+
+
+async def profile_cpu(seconds: int, interval: float = 0.005) -> tuple[str, str]:
+    """Профилирует поток event loop seconds секунд. Возвращает (полный отчёт, краткая сводка)."""
+
+    async with _profile_lock:
+        profiler = SamplingProfiler(threading.get_ident(), interval=interval)
+        started = time.monotonic()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        elapsed = time.monotonic() - started
+
+    report = profiler.report(elapsed)
+    top = profiler.self_counts.most_common(5)
+    summary_lines = [f"CPU-профиль за {elapsed:.0f} с, сэмплов: {profiler.samples}"]
+    for label, count in top:
+        name = label.rsplit(" ", 1)[-1]
+        summary_lines.append(f"• {name}: {count / max(profiler.samples, 1) * 100:.1f}%")
+    return report, "\n".join(summary_lines)
+
+
+def _format_traceback_stat(stat) -> str:
+    frame = stat.traceback[0]
+    source = linecache.getline(frame.filename, frame.lineno).strip()
+    return f"{frame.filename}:{frame.lineno}  {source}"
+
+
+async def profile_memory(seconds: int, frames: int = 10) -> tuple[str, str]:
+    """Снимает tracemalloc-снимки в начале и конце окна seconds. Возвращает (полный отчёт, краткая сводка)."""
+
+    async with _profile_lock:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(frames)
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            # Если трассировку включили мы — выключаем, чтобы не платить за неё после замера
+            if started_here:
+                tracemalloc.stop()
+
+    snapshot_filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+    ]
+    before = before.filter_traces(snapshot_filters)
+    after = after.filter_traces(snapshot_filters)
+
+    growth = after.compare_to(before, "lineno")
+    top_now = after.statistics("lineno")
+
+    lines = [
+        f"Снимок памяти (tracemalloc), {datetime.now().isoformat(timespec='seconds')}",
+        f"Окно: {seconds} с, отслеживаемая память: {current / 1024 / 1024:.1f} МБ, пик: {peak / 1024 / 1024:.1f} МБ",
+        "",
+        f"Топ-{TOP_LIMIT} мест по приросту памяти за окно:",
+    ]
+    for stat in growth[:TOP_LIMIT]:
+        lines.append(
+            f"  {stat.size_diff / 1024:+10.1f} КБ  {stat.count_diff:+8d} блоков  {_format_traceback_stat(stat)}",
+        )
+    lines.append("")
+    lines.append(f"Топ-{TOP_LIMIT} мест по занимаемой памяти:")
+    for stat in top_now[:TOP_LIMIT]:
+        lines.append(f"  {stat.size / 1024:10.1f} КБ  {stat.count:8d} блоков  {_format_traceback_stat(stat)}")
+
+    summary_lines = [f"Память: {current / 1024 / 1024:.1f} МБ (пик {peak / 1024 / 1024:.1f} МБ)"]
+    if started_here:
+        summary_lines.append("Трассировка включалась только на время замера: учтены аллокации за окно.")
+    for stat in growth[:5]:
+        frame = stat.traceback[0]
+        summary_lines.append(f"• {frame.filename.rsplit('/', 1)[-1]}:{frame.lineno}: {stat.size_diff / 1024:+.1f} КБ")
+    return "\n".join(lines), "\n".join(summary_lines)
@@ -0,0 +1,174 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import FrozenSet, Optional
+from zoneinfo import ZoneInfo
+
+
+TZ = ZoneInfo("Asia/Dushanbe")
+
+_WEEKDAYS_RU = {
+    "пн": 0,
+    "вт": 1,
+    "ср": 2,
+    "чт": 3,
+    "пт": 4,
+    "сб": 5,
+    "вс": 6,
+}
+_WEEKDAY_LABELS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+_TIME_RE = r"(?P<hour>\d{1,2}):(?P<minute>\d{2})"
+_DAILY_RE = re.compile(rf"^(?:daily|ежедневно|каждый день)\s+{_TIME_RE}$", re.IGNORECASE)
+_WEEKLY_RE = re.compile(
+    rf"^(?:weekly|еженедельно|каждую неделю)\s+(?P<days>[^\s]+)\s+{_TIME_RE}$",
+    re.IGNORECASE,
+)
+_CRON_RE = re.compile(r"^cron\s+(?P<expr>\S+\s+\S+\s+\S+\s+\S+\s+\S+)$", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class Recurrence:
+    """Правило повторения рассылки. Внутри любое правило — это cron-выражение (время Asia/Dushanbe)."""
+
+    rule: str
+    minutes: FrozenSet[int]
+    hours: FrozenSet[int]
+    days: FrozenSet[int]
+    months: FrozenSet[int]
+    weekdays: FrozenSet[int]  # 0 — понедельник, как datetime.weekday()
+    days_restricted: bool
+    weekdays_restricted: bool
+
+    def _day_matches(self, day: datetime) -> bool:
+        if day.month not in self.months:
+            return False
+        dom_ok = day.day in self.days
+        dow_ok = day.weekday() in self.weekdays
+        # Как в cron: если ограничены и день месяца, и день недели — достаточно совпадения любого
+        if self.days_restricted and self.weekdays_restricted:
+            return dom_ok or dow_ok
+        return dom_ok and dow_ok
+
+    def next_after(self, after: datetime) -> datetime:
+        """Ближайшее срабатывание строго позже after (aware datetime, результат в Asia/Dushanbe)."""
+
+        start = (after.astimezone(TZ) + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        day = start.replace(hour=0, minute=0)
+        hours = sorted(self.hours)
+        minutes = sorted(self.minutes)
+
+        # Пять лет с запасом покрывают правила вида «29 февраля»
+        for offset in range(366 * 5):
+            candidate_day = day + timedelta(days=offset)
+            if not self._day_matches(candidate_day):
+                continue
+            for hour in hours:
+                for minute in minutes:
+                    candidate = candidate_day.replace(hour=hour, minute=minute)
+                    if candidate >= start:
+                        return candidate
+
+        raise ValueError(f"Правило {self.rule!r} не срабатывает в ближайшие годы")
+
+    def describe(self) -> str:
+        kind, _, rest = self.rule.partition(" ")
+        if kind == "daily":
+            return f"ежедневно в {rest}"
+        if kind == "weekly":
+            days, time_part = rest.split(" ")
+            labels = ",".join(_WEEKDAY_LABELS[int(d)] for d in days.split(","))
+            return f"еженедельно ({labels}) в {time_part}"
+        return f"по расписанию cron «{rest}»"
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    values: set[int] = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_str = part.split("/", 1)
+            step = int(step_str)
+            if step <= 0:
+                raise ValueError("шаг должен быть положительным")
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_str, end_str = part.split("-", 1)
+            start, end = int(start_str), int(end_str)
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+
+        if start < low or end > high or start > end:
+            raise ValueError(f"значение вне диапазона {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+def _from_cron(rule: str, expr: str) -> Recurrence:
+    minute_f, hour_f, dom_f, month_f, dow_f = expr.split()
+    # В cron 0 и 7 — воскресенье, 1 — понедельник; переводим в нумерацию datetime.weekday()
+    cron_dows = _parse_cron_field(dow_f, 0, 7)
+    weekdays = frozenset((d - 1) % 7 for d in cron_dows)
+    return Recurrence(
+        rule=rule,
+        minutes=_parse_cron_field(minute_f, 0, 59),
+        hours=_parse_cron_field(hour_f, 0, 23),
+        days=_parse_cron_field(dom_f, 1, 31),
+        months=_parse_cron_field(month_f, 1, 12),
+        weekdays=weekdays,
+        days_restricted=dom_f != "*",
+        weekdays_restricted=dow_f != "*",
+    )
+
+
+def _parse_time(match: "re.Match[str]") -> tuple[int, int]:
+    hour, minute = int(match.group("hour")), int(match.group("minute"))
+    if hour > 23 or minute > 59:
+        raise ValueError("некорректное время")
+    return hour, minute
+
+
+def parse_rule(text: str) -> Optional[Recurrence]:
+    """Разбирает правило повторения; None — текст не похож на правило или содержит ошибку.
+
+    Поддерживается (и в таком же виде хранится в БД в нормализованной форме):
+    - «ежедневно 14:30» / «daily 14:30»;
+    - «еженедельно пн,ср,пт 14:30» / «weekly 0,2,4 14:30»;
+    - «cron 30 14 * * 1-5» (минуты, часы, день месяца, месяц, день недели).
+    """
+
+    text = " ".join(text.strip().split())
+    try:
+        m = _DAILY_RE.match(text)
+        if m:
+            hour, minute = _parse_time(m)
+            return _from_cron(f"daily {hour:02d}:{minute:02d}", f"{minute} {hour} * * *")
+
+        m = _WEEKLY_RE.match(text)
+        if m:
+            hour, minute = _parse_time(m)
+            days: set[int] = set()
+            for token in m.group("days").lower().split(","):
+                token = token.strip()
+                if token in _WEEKDAYS_RU:
+                    days.add(_WEEKDAYS_RU[token])
+                elif token.isdigit() and int(token) <= 6:
+                    days.add(int(token))
+                else:
+                    return None
+            day_list = ",".join(str(d) for d in sorted(days))
+            cron_days = ",".join(str(d + 1) for d in sorted(days))
+            return _from_cron(f"weekly {day_list} {hour:02d}:{minute:02d}", f"{minute} {hour} * * {cron_days}")
+
+        m = _CRON_RE.match(text)
+        if m:
+            expr = m.group("expr")
+            return _from_cron(f"cron {expr}", expr)
+    except ValueError:
+        return None
+
+    return None
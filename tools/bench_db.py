@@ -0,0 +1,425 @@
+"""Бенчмарки db.py и конвейера рассылки на синтетических данных.
+
+Генерирует реалистичный набор данных (по умолчанию 1M пользователей, 10M событий WebView,
+100k постов канала, смесь заблокированных и админов), замеряет основные запросы и сквозную
+рассылку через локальную заглушку Bot API и пишет результаты в JSON.
+
+Примеры (из корня проекта):
+    python tools/bench_db.py                       # полный объём
+    python tools/bench_db.py --scale 0.01          # быстрый прогон (10k пользователей)
+    python tools/bench_db.py --db /tmp/bench.db    # переиспользовать сгенерированную базу
+    python tools/bench_db.py --baseline old.json   # сравнить с прошлым прогоном
+
+Код возврата 1 — какая-то метрика превысила порог из tools/bench_thresholds.json
+или ухудшилась относительно --baseline больше чем на --max-regression.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS = Path(__file__).resolve().parent
+DEFAULT_THRESHOLDS = TOOLS / "bench_thresholds.json"
+
+FULL_USERS = 1_000_000
+FULL_EVENTS = 10_000_000
+FULL_POSTS = 100_000
+FULL_SCHEDULED = 10_000
+CHUNK = 50_000
+
+
+def _prepare_env(db_path: Path) -> None:
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ["DB_PATH"] = str(db_path)
+    os.environ.setdefault("LOG_FILE", str(db_path.with_suffix(".log")))
+    # Меряем сам конвейер рассылки, а не лимиты Telegram
+    os.environ.setdefault("OUTBOUND_GLOBAL_PER_SECOND", "0")
+    for path in (ROOT, TOOLS):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+# ---------------------------------------------------------------------------
+# Генерация данных
+# ---------------------------------------------------------------------------
+
+
+def _chunks(rows: Iterator[tuple], size: int = CHUNK) -> Iterator[list[tuple]]:
+    batch: list[tuple] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iso(dt: datetime) -> str:
+    return dt.isoformat()
+
+
+def generate_dataset(db_path: Path, users: int, events: int, posts: int, scheduled: int, seed: int = 42) -> None:
+    """Заполняет базу синтетическими данными (схема создаётся через db.init_db())."""
+
+    import db
+
+    db.init_db()
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    conn = sqlite3.connect(db_path)
+    # Генерация — одноразовая операция, надёжность записи здесь не нужна
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    def user_rows() -> Iterator[tuple]:
+        for i in range(users):
+            first_seen = now - timedelta(days=rng.random() * 365)
+            # Большинство заходит редко: last_seen смещён к first_seen, меньшинство — активные
+            activity = rng.random() ** 3
+            last_seen = first_seen + (now - first_seen) * activity
+            is_admin = 1 if i % 50_000 == 0 else 0
+            is_blocked = 1 if rng.random() < 0.08 and not is_admin else 0
+            yield (100_000_000 + i, is_admin, _iso(first_seen), _iso(last_seen), is_blocked, rng.random())
+
+    for batch in _chunks(user_rows()):
+        conn.executemany(
+            """
+            INSERT INTO users (user_id, is_admin, first_seen, last_seen, is_blocked, engagement_score)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            batch,
+        )
+        conn.commit()
+
+    def event_rows() -> Iterator[tuple]:
+        # ~30% пользователей открывают WebView; частота распределена по степенному закону
+        active_users = max(1, int(users * 0.3))
+        for _ in range(events):
+            uid = 100_000_000 + int(active_users * rng.random() ** 2)
+            created = now - timedelta(seconds=rng.random() * 365 * 86400)
+            yield (uid, _iso(created))
+
+    # Таблицы событий живут в отдельном файле (EVENTS_DB_PATH)
+    events_conn = sqlite3.connect(db.EVENTS_DB_PATH)
+    events_conn.execute("PRAGMA journal_mode = OFF")
+    events_conn.execute("PRAGMA synchronous = OFF")
+
+    for batch in _chunks(event_rows()):
+        events_conn.executemany("INSERT INTO webview_events (user_id, created_at) VALUES (?, ?)", batch)
+        events_conn.commit()
+
+    def post_rows() -> Iterator[tuple]:
+        message_id = 1
+        for i in range(posts):
+            created = now - timedelta(seconds=(posts - i) * 600)
+            if rng.random() < 0.1:
+                size = rng.randint(2, 10)
+                ids = ",".join(str(message_id + k) for k in range(size))
+                yield ("bench_channel", message_id, _iso(created), f"Альбом {i}", f"group-{i}", ids)
+                message_id += size
+            else:
+                yield ("bench_channel", message_id, _iso(created), f"Пост {i}", None, str(message_id))
+                message_id += 1
+
+    for batch in _chunks(post_rows()):
+        events_conn.executemany(
+            """
+            INSERT INTO channel_posts (chat_id, message_id, created_at, text_preview, media_group_id, message_ids)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            batch,
+        )
+        events_conn.commit()
+
+    def scheduled_rows() -> Iterator[tuple]:
+        statuses = ["done"] * 8 + ["cancelled", "failed"]
+        for i in range(scheduled):
+            at = now + timedelta(minutes=rng.randint(-60 * 24 * 90, 60 * 24 * 30))
+            status = "pending" if at > now else rng.choice(statuses)
+            at_iso = at.isoformat() + "+05:00"
+            yield ("news", "https://t.me/bench_channel/1", "bench_channel", 1, "1", 1, at_iso, _iso(now), status, at_iso)
+
+    for batch in _chunks(scheduled_rows()):
+        conn.executemany(
+            """
+            INSERT INTO scheduled_mailings (
+                mailing_type, post_link, from_chat, message_id, message_ids, admin_chat_id,
+                scheduled_at, created_at, status, next_run_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            batch,
+        )
+        conn.commit()
+
+    # Как в рабочей установке: обе БД в режиме WAL (journal_mode = OFF выше — только на время генерации)
+    for generated in (conn, events_conn):
+        generated.execute("ANALYZE")
+        generated.commit()
+        generated.execute("PRAGMA journal_mode = WAL")
+        generated.close()
+
+
+# ---------------------------------------------------------------------------
+# Замеры
+# ---------------------------------------------------------------------------
+
+
+def _time_repeated(fn: Callable[[], object], repeat: int) -> dict:
+    samples: list[float] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {
+        "seconds": statistics.median(samples),
+        "min_seconds": samples[0],
+        "max_seconds": samples[-1],
+        "repeat": repeat,
+    }
+
+
+def bench_db_functions(users: int) -> dict:
+    import db
+
+    results: dict[str, dict] = {}
+    rng = random.Random(7)
+    now_iso = (datetime.utcnow().isoformat()) + "+05:00"
+
+    existing = [100_000_000 + rng.randrange(users) for _ in range(1000)]
+    fresh = iter(range(900_000_000, 900_100_000))
+
+    def upsert_mix() -> None:
+        for uid in existing:
+            db.upsert_user(uid)
+            db.upsert_user(next(fresh))
+
+    res = _time_repeated(upsert_mix, 1)
+    res["seconds"] /= 2000
+    res["unit"] = "per call"
+    results["upsert_user"] = res
+
+    results["get_user_stats"] = _time_repeated(db.get_user_stats, 3)
+    results["get_active_users"] = _time_repeated(lambda: db.get_active_users(include_admins=True), 3)
+    results["iter_active_users_engagement"] = _time_repeated(
+        lambda: sum(1 for _ in db.iter_active_users(include_admins=True, order="engagement")),
+        1,
+    )
+
+    res = _time_repeated(lambda: [list(db.get_due_scheduled_mailings(now_iso)) for _ in range(100)], 3)
+    res["seconds"] /= 100
+    res["unit"] = "per call"
+    results["get_due_scheduled_mailings"] = res
+
+    res = _time_repeated(lambda: [list(db.get_recent_channel_posts(limit=10)) for _ in range(100)], 3)
+    res["seconds"] /= 100
+    res["unit"] = "per call"
+    results["get_recent_channel_posts"] = res
+
+    results["refresh_engagement_scores"] = _time_repeated(db.refresh_engagement_scores, 1)
+    return results
+
+
+async def _bench_mailing(recipients: int, latency: float) -> dict:
+    """Сквозная рассылка по отдельной небольшой базе через заглушку Bot API."""
+
+    import db
+    from delivery import create_bot, create_delivery_bot
+    from fake_telegram_api import run_fake_api
+    from handlers_mailings import _send_mailing_task
+    from mailing_runtime import MailingRegistry
+
+    with tempfile.TemporaryDirectory() as tmp:
+        live_db = db.DB_PATH
+        db.DB_PATH = str(Path(tmp) / "mailing.db")
+        try:
+            db.init_db()
+            for uid in range(1, recipients + 1):
+                db.upsert_user(200_000_000 + uid)
+
+            async with run_fake_api(latency=latency) as (api_base, stats):
+                bot = create_bot(api_base=api_base)
+                delivery_bot = create_delivery_bot(api_base=api_base)
+                registry = MailingRegistry()
+                data = {
+                    "from_chat": "bench_channel",
+                    "message_id": 1,
+                    "message_ids": [1],
+                    "mailing_type": "news",
+                    "post_link": "https://t.me/bench_channel/1",
+                }
+
+                async def runner(run) -> None:
+                    # Без искусственного ограничения скорости: меряем сам конвейер
+                    run.rate = 1_000_000.0
+                    await _send_mailing_task(bot, 1, data, run, delivery_bot)
+
+                t0 = time.perf_counter()
+                run = registry.start("bench", "news", 1, runner)
+                await run.task
+                elapsed = time.perf_counter() - t0
+
+                await bot.session.close()
+                await delivery_bot.session.close()
+        finally:
+            db.DB_PATH = live_db
+
+    if run.error is not None:
+        raise run.error
+
+    return {
+        "seconds": elapsed,
+        "recipients": recipients,
+        "delivered": run.delivered,
+        "messages_per_sec": run.delivered / elapsed if elapsed else 0.0,
+        "api_requests": stats.requests,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Пороги и сравнение
+# ---------------------------------------------------------------------------
+
+
+def check_regressions(
+    results: dict,
+    scale: float,
+    thresholds_path: Optional[Path],
+    baseline_path: Optional[Path],
+    max_regression: float,
+) -> list[str]:
+    failures: list[str] = []
+
+    if thresholds_path is not None and thresholds_path.exists():
+        thresholds = json.loads(thresholds_path.read_text(encoding="utf-8"))
+        limits = thresholds.get(str(scale)) or thresholds.get(f"{scale:g}")
+        if limits is None:
+            print(f"! В {thresholds_path} нет порогов для scale={scale:g}, абсолютные пороги не проверяются")
+        else:
+            for name, limit in limits.items():
+                value = results.get(name, {}).get("seconds")
+                if value is not None and value > limit:
+                    failures.append(f"{name}: {value:.6f}s > порога {limit:.6f}s")
+
+    if baseline_path is not None:
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if baseline.get("scale") != scale:
+            print(f"! Базовый прогон сделан с scale={baseline.get('scale')}, сравнение может быть некорректным")
+        for name, metric in baseline.get("results", {}).items():
+            old = metric.get("seconds")
+            new = results.get(name, {}).get("seconds")
+            if old and new and new > old * (1 + max_regression):
+                failures.append(f"{name}: {new:.6f}s против {old:.6f}s в базовом прогоне (+{(new / old - 1) * 100:.0f}%)")
+
+    return failures
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Synthetic-data benchmarks for db.py and the mailing pipeline")
+    parser.add_argument("--scale", type=float, default=1.0, help="Dataset size relative to 1M users / 10M events")
+    parser.add_argument("--db", default="", help="Benchmark database path (reused if it already has data)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write JSON results")
+    parser.add_argument("--thresholds", default=str(DEFAULT_THRESHOLDS), help="JSON with absolute limits per scale")
+    parser.add_argument("--baseline", default="", help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed slowdown vs baseline (0.25 = 25%%)")
+    parser.add_argument("--mailing-recipients", type=int, default=2000)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Latency of the stand-in Bot API")
+    parser.add_argument("--skip-mailing", action="store_true")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    users = max(1, int(FULL_USERS * args.scale))
+    events = int(FULL_EVENTS * args.scale)
+    posts = max(1, int(FULL_POSTS * args.scale))
+    scheduled = max(1, int(FULL_SCHEDULED * args.scale))
+
+    tmp_dir = None
+    if args.db:
+        db_path = Path(args.db)
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(tmp_dir.name) / "bench.db"
+
+    _prepare_env(db_path)
+
+    try:
+        reuse = False
+        if db_path.exists():
+            with sqlite3.connect(db_path) as conn:
+                try:
+                    reuse = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] >= users
+                except sqlite3.OperationalError:
+                    reuse = False
+
+        generation_seconds = None
+        if not reuse:
+            print(f"Генерация данных: users={users} events={events} posts={posts} scheduled={scheduled} ...")
+            t0 = time.perf_counter()
+            generate_dataset(db_path, users, events, posts, scheduled)
+            generation_seconds = time.perf_counter() - t0
+            print(f"  готово за {generation_seconds:.1f}s")
+        else:
+            import db
+
+            db.init_db()
+
+        results = bench_db_functions(users)
+        if not args.skip_mailing:
+            results["mailing_end_to_end"] = asyncio.run(
+                _bench_mailing(args.mailing_recipients, args.api_latency_ms / 1000)
+            )
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "scale": args.scale,
+        "dataset": {"users": users, "webview_events": events, "channel_posts": posts, "scheduled_mailings": scheduled},
+        "generation_seconds": generation_seconds,
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    for name, metric in results.items():
+        print(f"{name:32} {metric['seconds'] * 1000:10.3f} ms")
+    print(f"Результаты: {args.output}")
+
+    failures = check_regressions(
+        results,
+        args.scale,
+        Path(args.thresholds) if args.thresholds else None,
+        Path(args.baseline) if args.baseline else None,
+        args.max_regression,
+    )
+    if failures:
+        print("Регрессии:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,117 @@
+"""Бенчмарк пула соединений для рассылок на локальной заглушке Bot API.
+
+Для каждого размера пула отправляет --messages сообщений с параллельностью --concurrency
+и параллельно измеряет задержку «интерактивных» запросов (getMe) — через тот же пул
+(shared) или через отдельную сессию, как у polling-бота (dedicated).
+
+Запуск из корня проекта:
+    python tools/bench_delivery_pool.py --pool-sizes 1,4,16,64 --latency-ms 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS = Path(__file__).resolve().parent
+
+
+def _prepare_env() -> None:
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_FILE", str(Path(tempfile.gettempdir()) / "bench_delivery_pool.log"))
+    # Меряем пул соединений, а не лимиты Telegram
+    os.environ.setdefault("OUTBOUND_GLOBAL_PER_SECOND", "0")
+    for path in (ROOT, TOOLS):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+async def _probe(bot, stop: asyncio.Event, latencies: list[float]) -> None:
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await bot.get_me()
+        latencies.append(time.perf_counter() - t0)
+        await asyncio.sleep(0.05)
+
+
+async def _run_case(api_base: str, pool_size: int, messages: int, concurrency: int, shared: bool) -> dict:
+    from delivery import create_bot, create_delivery_bot
+
+    delivery_bot = create_delivery_bot(api_base=api_base, pool_size=pool_size)
+    probe_bot = delivery_bot if shared else create_bot(api_base=api_base)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i: int) -> None:
+        async with semaphore:
+            await delivery_bot.send_message(chat_id=100_000 + i, text="bench")
+
+    stop = asyncio.Event()
+    probe_latencies: list[float] = []
+    probe_task = asyncio.create_task(_probe(probe_bot, stop, probe_latencies))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(messages)))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await probe_task
+    await delivery_bot.session.close()
+    if not shared:
+        await probe_bot.session.close()
+
+    return {
+        "pool_size": pool_size,
+        "mode": "shared" if shared else "dedicated",
+        "messages_per_sec": messages / elapsed,
+        "probe_p50_ms": statistics.median(probe_latencies) * 1000 if probe_latencies else 0.0,
+        "probe_max_ms": max(probe_latencies) * 1000 if probe_latencies else 0.0,
+    }
+
+
+async def _run(args: argparse.Namespace) -> None:
+    from fake_telegram_api import run_fake_api
+
+    pool_sizes = [int(x) for x in args.pool_sizes.split(",") if x.strip()]
+
+    async def run_all(api_base: str) -> None:
+        for pool_size in pool_sizes:
+            for shared in (True, False):
+                result = await _run_case(api_base, pool_size, args.messages, args.concurrency, shared)
+                print(
+                    "pool={pool_size:<4} {mode:9} throughput={messages_per_sec:8.1f} msg/s "
+                    "interactive p50={probe_p50_ms:7.1f}ms max={probe_max_ms:7.1f}ms".format(**result)
+                )
+
+    if args.api_base:
+        await run_all(args.api_base)
+        return
+
+    async with run_fake_api(latency=args.latency_ms / 1000) as (api_base, _stats):
+        await run_all(api_base)
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark delivery connection pool sizes")
+    parser.add_argument("--pool-sizes", default="1,4,16,64")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent sends issued by the mailing")
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Latency of the in-process stand-in API")
+    parser.add_argument("--api-base", default="", help="Use an already running stand-in instead of an in-process one")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    _prepare_env()
+    asyncio.run(_run(args))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
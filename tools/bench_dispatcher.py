@@ -0,0 +1,386 @@
+"""Нагрузочный стенд входящих апдейтов: синтетические Update в настоящий Dispatcher бота.
+
+Собирает Dispatcher так же, как main.py (те же роутеры и middleware), и подаёт ему апдейты
+с заданной частотой через feed_update: /start (в том числе с меткой кампании), «Играть»,
+нажатия open_webview, посты канала и действия админа. Исходящие вызовы Bot API уходят
+в локальную заглушку; база — временная.
+
+Отчёт: пропускная способность обработчиков, p50/p99 задержки (от запланированного момента
+поступления апдейта до конца обработки — очередь тоже учитывается) и темп записей в БД.
+
+Запуск из корня проекта:
+    python tools/bench_dispatcher.py --rate 200 --seconds 10
+    python tools/bench_dispatcher.py --rate 0 --updates 5000 --concurrency 64   # максимум пропускной способности
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS = Path(__file__).resolve().parent
+
+BENCH_ADMIN_ID = 1
+USER_ID_BASE = 1_000_000
+CHANNEL_ID = -1001234567890
+
+DEFAULT_MIX = "start=30,start_campaign=10,play=20,webview=25,channel=5,admin=10"
+
+
+def _prepare_env(db_path: Path, outbound_limits: bool) -> None:
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ["DB_PATH"] = str(db_path)
+    os.environ["LOG_FILE"] = str(db_path.with_suffix(".log"))
+    os.environ["ADMIN_IDS"] = str(BENCH_ADMIN_ID)
+    # Снимок аналитики держим рядом с временной базой
+    os.environ["ANALYTICS_DB_PATH"] = str(db_path.with_suffix(".analytics.db"))
+    if not outbound_limits:
+        # По умолчанию меряем обработку апдейтов, а не лимиты Telegram на исходящие
+        os.environ["OUTBOUND_GLOBAL_PER_SECOND"] = "0"
+    for path in (ROOT, TOOLS):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+def _install_write_counter(db_module) -> dict:
+    """Оборачивает соединения с основной БД и БД событий и считает изменяющие запросы и COMMIT."""
+
+    counters = {"writes": 0, "commits": 0, "connections": 0, "event_writes": 0, "event_commits": 0}
+
+    def wrap(original, writes_key: str, commits_key: str):
+        def traced_conn():
+            conn = original()
+            counters["connections"] += 1
+
+            def trace(statement: str) -> None:
+                head = statement.lstrip()[:7].upper()
+                if head.startswith("COMMIT"):
+                    counters[commits_key] += 1
+                elif head.startswith(("INSERT", "UPDATE", "DELETE", "REPLACE")):
+                    counters[writes_key] += 1
+
+            conn.set_trace_callback(trace)
+            return conn
+
+        return traced_conn
+
+    db_module._get_conn = wrap(db_module._get_conn, "writes", "commits")
+    db_module._get_events_conn = wrap(db_module._get_events_conn, "event_writes", "event_commits")
+    return counters
+
+
+# ---------------------------------------------------------------------------
+# Синтетические апдейты
+# ---------------------------------------------------------------------------
+
+
+class UpdateFactory:
+    """Строит словари Update в формате Bot API для разных сценариев."""
+
+    def __init__(self, users: int, seed: int = 1) -> None:
+        self.users = users
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.kinds: dict[str, Callable[[], dict]] = {
+            "start": self.start,
+            "start_campaign": self.start_campaign,
+            "play": self.play,
+            "webview": self.webview,
+            "channel": self.channel_post,
+            "admin": self.admin,
+        }
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "language_code": "ru"}
+
+    def _random_user_id(self) -> int:
+        return USER_ID_BASE + self.random.randrange(self.users)
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def _callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.callback_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+                    "text": "menu",
+                },
+            },
+        }
+
+    def start(self) -> dict:
+        return self._message(self._random_user_id(), "/start")
+
+    def start_campaign(self) -> dict:
+        source = f"bench_{self.random.randrange(5)}"
+        return self._message(self._random_user_id(), f"/start {source}")
+
+    def play(self) -> dict:
+        return self._message(self._random_user_id(), "Играть")
+
+    def webview(self) -> dict:
+        return self._callback(self._random_user_id(), "open_webview")
+
+    def channel_post(self) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "channel_post": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": CHANNEL_ID, "type": "channel", "title": "bench", "username": "bench_channel"},
+                "text": "Пост канала для рассылки",
+            },
+        }
+
+    def admin(self) -> dict:
+        from constants import ADMIN_CMD_PANEL_TEXT, ADMIN_CMD_SCHEDULED_TEXT, ADMIN_CMD_STATS_TEXT
+
+        choice = self.random.randrange(4)
+        if choice == 0:
+            return self._message(BENCH_ADMIN_ID, ADMIN_CMD_STATS_TEXT)
+        if choice == 1:
+            return self._message(BENCH_ADMIN_ID, ADMIN_CMD_SCHEDULED_TEXT)
+        if choice == 2:
+            return self._message(BENCH_ADMIN_ID, ADMIN_CMD_PANEL_TEXT)
+        return self._callback(BENCH_ADMIN_ID, "admin_campaigns")
+
+
+def parse_mix(raw: str) -> list[tuple[str, float]]:
+    mix: list[tuple[str, float]] = []
+    for part in raw.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+# ---------------------------------------------------------------------------
+# Прогон
+# ---------------------------------------------------------------------------
+
+
+def _percentile(values: list[float], q: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def _run(args: argparse.Namespace) -> dict:
+    import db
+    from aiogram.types import Update
+    from counters import flush_all_counters
+    from delivery import create_bot, create_delivery_bot
+    from fake_telegram_api import run_fake_api
+    from main import create_dispatcher
+    from middlewares import update_lanes
+
+    # Строка лога на каждый апдейт исказила бы замер и залила вывод
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    db.init_db()
+    for uid in range(args.users):
+        db.upsert_user(USER_ID_BASE + uid)
+    db.upsert_user(BENCH_ADMIN_ID, is_admin=True)
+    db_counters = _install_write_counter(db)
+
+    factory = UpdateFactory(args.users, seed=args.seed)
+    mix = parse_mix(args.mix)
+    unknown = [name for name, _ in mix if name not in factory.kinds]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)} (доступны: {', '.join(factory.kinds)})")
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    total = args.updates if args.rate <= 0 or not args.seconds else int(args.rate * args.seconds)
+    # Апдейты строятся заранее, чтобы генерация не попадала в замер
+    kinds = factory.random.choices(names, weights=weights, k=total)
+    raw_updates = [(kind, factory.kinds[kind]()) for kind in kinds]
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+
+    async with run_fake_api(latency=args.latency_ms / 1000) as (api_base, api_stats):
+        bot = create_bot(api_base=api_base)
+        delivery_bot = create_delivery_bot(api_base=api_base)
+        dp = create_dispatcher(delivery_bot)
+        updates = [(kind, Update.model_validate(raw, context={"bot": bot})) for kind, raw in raw_updates]
+
+        async def feed(kind: str, update: Update, scheduled_at: float) -> None:
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:  # noqa: BLE001
+                errors[kind] += 1
+            latencies[kind].append(time.perf_counter() - scheduled_at)
+
+        api_stats.reset()
+        db_counters.update(dict.fromkeys(db_counters, 0))
+        started = time.perf_counter()
+
+        if args.rate > 0:
+            # Открытая модель нагрузки: апдейты приходят по расписанию независимо от того,
+            # успевает ли бот, — как от Telegram при long polling
+            tasks = []
+            for i, (kind, update) in enumerate(updates):
+                scheduled_at = started + i / args.rate
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(feed(kind, update, scheduled_at)))
+            await asyncio.gather(*tasks)
+        else:
+            queue = iter(updates)
+
+            async def worker() -> None:
+                for kind, update in queue:
+                    await feed(kind, update, time.perf_counter())
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+        elapsed = time.perf_counter() - started
+        flush_started = time.perf_counter()
+        flush_all_counters()
+        flush_seconds = time.perf_counter() - flush_started
+
+        await bot.session.close()
+        await delivery_bot.session.close()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "target_rate": args.rate,
+        "updates": total,
+        "seconds": elapsed,
+        "updates_per_sec": total / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(all_latencies, 50) * 1000,
+        "p99_ms": _percentile(all_latencies, 99) * 1000,
+        "max_ms": max(all_latencies, default=0.0) * 1000,
+        "errors": dict(errors),
+        "by_kind": {
+            kind: {
+                "count": len(values),
+                "p50_ms": _percentile(values, 50) * 1000,
+                "p99_ms": _percentile(values, 99) * 1000,
+            }
+            for kind, values in sorted(latencies.items())
+        },
+        "db": {
+            "writes": db_counters["writes"],
+            "commits": db_counters["commits"],
+            "event_writes": db_counters["event_writes"],
+            "event_commits": db_counters["event_commits"],
+            "connections": db_counters["connections"],
+            "writes_per_sec": db_counters["writes"] / elapsed if elapsed else 0.0,
+            "commits_per_sec": db_counters["commits"] / elapsed if elapsed else 0.0,
+            "event_writes_per_sec": db_counters["event_writes"] / elapsed if elapsed else 0.0,
+            "counters_flush_ms": flush_seconds * 1000,
+        },
+        "lanes": {
+            name: {
+                "processed": lane.processed,
+                "max_wait_ms": lane.max_wait * 1000,
+                "shed": lane.shed,
+                "dropped": lane.dropped,
+            }
+            for name, lane in update_lanes.lanes.items()
+        },
+        "api": {
+            "requests": api_stats.requests,
+            "requests_per_sec": api_stats.requests / elapsed if elapsed else 0.0,
+            "by_method": dict(api_stats.by_method),
+        },
+    }
+
+
+def _print_report(result: dict) -> None:
+    target = f"{result['target_rate']:g}/s" if result["target_rate"] > 0 else "максимум"
+    print(
+        f"Апдейтов: {result['updates']} за {result['seconds']:.2f} с (цель: {target}) — "
+        f"{result['updates_per_sec']:.1f} апд./с"
+    )
+    print(
+        f"Задержка: p50={result['p50_ms']:.1f} мс p99={result['p99_ms']:.1f} мс max={result['max_ms']:.1f} мс"
+    )
+    for kind, values in result["by_kind"].items():
+        print(f"  {kind:15} n={values['count']:<7} p50={values['p50_ms']:8.1f} мс p99={values['p99_ms']:8.1f} мс")
+    if result["errors"]:
+        print(f"Ошибки обработчиков: {result['errors']}")
+    db_stats = result["db"]
+    print(
+        f"Основная БД: записей={db_stats['writes']} ({db_stats['writes_per_sec']:.1f}/с), "
+        f"коммитов={db_stats['commits']} ({db_stats['commits_per_sec']:.1f}/с); "
+        f"БД событий: записей={db_stats['event_writes']} ({db_stats['event_writes_per_sec']:.1f}/с), "
+        f"коммитов={db_stats['event_commits']}; "
+        f"соединений={db_stats['connections']}, сброс счётчиков={db_stats['counters_flush_ms']:.1f} мс"
+    )
+    for name, lane in result["lanes"].items():
+        print(
+            f"Очередь {name:8} обработано={lane['processed']:<7} макс. ожидание={lane['max_wait_ms']:8.1f} мс "
+            f"облегчено={lane['shed']} отброшено={lane['dropped']}"
+        )
+    api = result["api"]
+    print(f"Bot API: запросов={api['requests']} ({api['requests_per_sec']:.1f}/с)")
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Feed synthetic updates to the bot dispatcher")
+    parser.add_argument("--rate", type=float, default=200.0, help="Updates per second; 0 — as fast as possible")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration for --rate > 0")
+    parser.add_argument("--updates", type=int, default=5000, help="Number of updates for --rate 0")
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent updates for --rate 0")
+    parser.add_argument("--users", type=int, default=10_000, help="Distinct users in the synthetic traffic")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Scenario weights, e.g. start=30,webview=25")
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Latency of the in-process stand-in API")
+    parser.add_argument("--outbound-limits", action="store_true", help="Keep Telegram rate limits on replies")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="Write the JSON report to this file")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _prepare_env(Path(tmp) / "bench_dispatcher.db", args.outbound_limits)
+        result = asyncio.run(_run(args))
+
+    _print_report(result)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результаты: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,131 @@
+"""Бенчмарк обработчика open_webview: отдельные коммиты против одной сессии БД на апдейт.
+
+Запуск из корня проекта:
+    python tools/bench_update_session.py --updates 2000
+
+Используется временная база; Telegram не вызывается (ответы обработчика подменены заглушками).
+COMMIT считаются отдельно для основной БД и БД событий: сессия фиксирует по одной транзакции на каждый файл.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _prepare_env(db_path: Path) -> None:
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ["DB_PATH"] = str(db_path)
+    os.environ["LOG_FILE"] = str(db_path.with_suffix(".log"))
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))
+
+
+def _install_commit_counter(db_module) -> dict:
+    """Оборачивает db._get_conn и db._get_events_conn и считает выполненные COMMIT по каждому файлу БД."""
+
+    counters = {"main_commits": 0, "events_commits": 0, "connections": 0}
+
+    def wrap(original, key: str):
+        def traced_conn():
+            conn = original()
+            counters["connections"] += 1
+
+            def trace(statement: str) -> None:
+                if statement.strip().upper().startswith("COMMIT"):
+                    counters[key] += 1
+
+            conn.set_trace_callback(trace)
+            return conn
+
+        return traced_conn
+
+    db_module._get_conn = wrap(db_module._get_conn, "main_commits")
+    db_module._get_events_conn = wrap(db_module._get_events_conn, "events_commits")
+    return counters
+
+
+def _fake_callback(user_id: int) -> SimpleNamespace:
+    async def noop(*args, **kwargs) -> None:
+        return None
+
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(answer=noop),
+        answer=noop,
+    )
+
+
+async def _run(mode: str, updates: int, users: int) -> dict:
+    import db
+    from handlers_start import cb_open_webview
+    from middlewares import DbSessionMiddleware
+
+    counters = _install_commit_counter(db)
+    middleware = DbSessionMiddleware()
+
+    async def handler(event, data):
+        return await cb_open_webview(event, db_session=data["db_session"])
+
+    latencies: list[float] = []
+    started = time.perf_counter()
+    for i in range(updates):
+        callback = _fake_callback(1_000_000 + i % users)
+        t0 = time.perf_counter()
+        if mode == "session":
+            await middleware(handler, callback, {})
+        else:
+            await cb_open_webview(callback)
+        latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "updates": updates,
+        "main_commits_per_update": counters["main_commits"] / updates,
+        "events_commits_per_update": counters["events_commits"] / updates,
+        "connections_per_update": counters["connections"] / updates,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "updates_per_sec": updates / total,
+    }
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark per-update DB session vs per-call commits")
+    parser.add_argument("--updates", type=int, default=2000, help="Number of simulated open_webview updates")
+    parser.add_argument("--users", type=int, default=500, help="Number of distinct users")
+    parser.add_argument("--mode", choices=["legacy", "session", "both"], default="both")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    modes = ["legacy", "session"] if args.mode == "both" else [args.mode]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _prepare_env(Path(tmp) / "bench.db")
+        import db
+
+        db.init_db()
+        for mode in modes:
+            result = asyncio.run(_run(mode, args.updates, args.users))
+            print(
+                "{mode:8} commits/update: main={main_commits_per_update:.2f} events={events_commits_per_update:.2f} "
+                "connections/update={connections_per_update:.2f} "
+                "mean={mean_ms:.3f}ms p99={p99_ms:.3f}ms throughput={updates_per_sec:.0f} upd/s".format(**result)
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,267 @@
+"""Нагрузочный стенд режима вебхука: настоящий бот (BOT_MODE=webhook) с 1, 2, 4… процессами-обработчиками.
+
+Для каждого числа процессов запускает `python main.py` с временной базой, заглушкой Bot API
+(tools/fake_telegram_api.py, отдельный процесс) и WEBHOOK_URL="" (setWebhook не вызывается),
+после чего отправляет синтетические апдейты (те же сценарии, что в bench_dispatcher.py)
+POST-запросами на локальный вебхук с правильным секретом.
+
+Отчёт по каждому прогону:
+- время ответа вебхука (p50/p99) — то, что видит Telegram;
+- принято апдейтов в секунду;
+- обработано апдейтов в секунду — от первого POST до последнего вызова Bot API, сделанного
+  обработчиками (окончание обработки видно по затишью в счётчиках заглушки);
+- ускорение относительно одного процесса.
+
+Масштабирование по процессам видно только на машине с несколькими свободными ядрами:
+стенд, заглушка API и главный процесс бота тоже занимают CPU.
+
+Запуск из корня проекта:
+    python tools/bench_webhook.py --workers 1,2,4 --updates 5000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS = Path(__file__).resolve().parent
+
+for _path in (ROOT, TOOLS):
+    if str(_path) not in sys.path:
+        sys.path.insert(0, str(_path))
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+from aiohttp import ClientSession, ClientTimeout  # noqa: E402
+
+from bench_dispatcher import BENCH_ADMIN_ID, DEFAULT_MIX, UpdateFactory, parse_mix  # noqa: E402
+
+SECRET = "bench_webhook_secret"
+# Сколько секунд без новых вызовов Bot API считать окончанием обработки
+IDLE_SECONDS = 1.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: list[float], q: int) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def _build_updates(args: argparse.Namespace) -> list[bytes]:
+    factory = UpdateFactory(args.users, seed=args.seed)
+    mix = parse_mix(args.mix)
+    unknown = [name for name, _ in mix if name not in factory.kinds]
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)} (доступны: {', '.join(factory.kinds)})")
+    kinds = factory.random.choices([name for name, _ in mix], weights=[weight for _, weight in mix], k=args.updates)
+    return [json.dumps(factory.kinds[kind]()).encode() for kind in kinds]
+
+
+async def _wait_http(session: ClientSession, url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def _api_stats(session: ClientSession, api_base: str) -> dict:
+    async with session.get(f"{api_base}/stats") as response:
+        return await response.json()
+
+
+async def _wait_idle(session: ClientSession, api_base: str) -> dict:
+    """Ждёт, пока обработчики перестанут обращаться к Bot API."""
+
+    stats = await _api_stats(session, api_base)
+    while True:
+        await asyncio.sleep(IDLE_SECONDS / 4)
+        current = await _api_stats(session, api_base)
+        if current["requests"] == stats["requests"] and time.time() - current["last_request_at"] >= IDLE_SECONDS:
+            return current
+        stats = current
+
+
+async def _post_all(session: ClientSession, url: str, bodies: list[bytes], concurrency: int) -> tuple[list[float], int]:
+    latencies: list[float] = []
+    failed = 0
+    queue = iter(bodies)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"}
+
+    async def sender() -> None:
+        nonlocal failed
+        for body in queue:
+            started = time.perf_counter()
+            async with session.post(url, data=body, headers=headers) as response:
+                await response.read()
+                if response.status != 200:
+                    failed += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return latencies, failed
+
+
+async def _bench_workers(args: argparse.Namespace, workers: int, api_base: str, bodies: list[bytes]) -> dict:
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench_webhook.db"
+        env = dict(
+            os.environ,
+            BOT_MODE="webhook",
+            WEBHOOK_WORKERS=str(workers),
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(port),
+            WEBHOOK_PATH="/webhook",
+            WEBHOOK_SECRET=SECRET,
+            WEBHOOK_URL="",
+            TELEGRAM_API_BASE=api_base,
+            DB_PATH=str(db_path),
+            LOG_FILE=str(db_path.with_suffix(".log")),
+            ANALYTICS_DB_PATH=str(db_path.with_suffix(".analytics.db")),
+            ADMIN_IDS=str(BENCH_ADMIN_ID),
+            # Меряем обработку апдейтов, а не лимиты Telegram на исходящие
+            OUTBOUND_GLOBAL_PER_SECOND="0",
+        )
+        bot = subprocess.Popen(
+            [sys.executable, str(ROOT / "main.py")],
+            cwd=str(ROOT),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        url = f"http://127.0.0.1:{port}/webhook"
+        try:
+            async with ClientSession(timeout=ClientTimeout(total=60)) as session:
+                await _wait_http(session, url)
+
+                # Прогрев: соединения с заглушкой, кэши, первые записи в БД
+                await _post_all(session, url, bodies[: args.warmup], args.concurrency)
+                before = await _wait_idle(session, api_base)
+
+                started_wall = time.time()
+                started = time.perf_counter()
+                latencies, failed = await _post_all(session, url, bodies[args.warmup :], args.concurrency)
+                accepted_seconds = time.perf_counter() - started
+                after = await _wait_idle(session, api_base)
+
+                rejected_status = 0
+                async with session.post(url, data=bodies[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as r:
+                    rejected_status = r.status
+        finally:
+            bot.send_signal(signal.SIGTERM)
+            try:
+                bot.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+
+    updates = len(bodies) - args.warmup
+    handled_seconds = max(after["last_request_at"] - started_wall, accepted_seconds)
+    return {
+        "workers": workers,
+        "updates": updates,
+        "failed": failed,
+        "wrong_secret_status": rejected_status,
+        "ack_p50_ms": _percentile(latencies, 50) * 1000,
+        "ack_p99_ms": _percentile(latencies, 99) * 1000,
+        "accepted_per_sec": updates / accepted_seconds if accepted_seconds else 0.0,
+        "handled_seconds": handled_seconds,
+        "handled_per_sec": updates / handled_seconds if handled_seconds else 0.0,
+        "api_requests": after["requests"] - before["requests"],
+    }
+
+
+async def _run(args: argparse.Namespace) -> dict:
+    bodies = _build_updates(args)
+    api_port = _free_port()
+    api_base = f"http://127.0.0.1:{api_port}"
+    api = subprocess.Popen(
+        [
+            sys.executable,
+            str(TOOLS / "fake_telegram_api.py"),
+            "--port",
+            str(api_port),
+            "--latency-ms",
+            str(args.latency_ms),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        async with ClientSession() as session:
+            await _wait_http(session, f"{api_base}/stats")
+        runs = []
+        for workers in args.workers:
+            runs.append(await _bench_workers(args, workers, api_base, bodies))
+    finally:
+        api.terminate()
+        api.wait()
+
+    base = runs[0]["handled_per_sec"] or 1.0
+    for run in runs:
+        run["speedup"] = run["handled_per_sec"] / base
+    return {"cpu_count": os.cpu_count(), "runs": runs}
+
+
+def _print_report(result: dict) -> None:
+    print(f"CPU: {result['cpu_count']}")
+    print("процессов  ответ p50   ответ p99   принято/с  обработано/с  ускорение  вызовов API  ошибок")
+    for run in result["runs"]:
+        print(
+            f"{run['workers']:>9}  {run['ack_p50_ms']:7.1f} мс  {run['ack_p99_ms']:7.1f} мс  "
+            f"{run['accepted_per_sec']:9.0f}  {run['handled_per_sec']:12.0f}  {run['speedup']:8.2f}x  "
+            f"{run['api_requests']:11}  {run['failed']:6}"
+        )
+        if run["wrong_secret_status"] != 401:
+            print(f"  ! запрос с неверным секретом получил {run['wrong_secret_status']} вместо 401")
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark webhook mode with several worker processes")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to compare")
+    parser.add_argument("--updates", type=int, default=5000, help="Updates per run (after warm-up)")
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=40, help="Parallel webhook requests, as max_connections")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Latency of the stand-in Bot API")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="Write the JSON report to this file")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+    args.workers = [int(part) for part in args.workers.split(",") if part.strip()]
+    args.updates += args.warmup
+
+    result = asyncio.run(_run(args))
+    _print_report(result)
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"Результаты: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,142 @@
+"""Локальная заглушка Bot API для бенчмарков и нагрузочных прогонов.
+
+Отвечает на любые методы вида /bot<token>/<method> правдоподобным успешным ответом
+с настраиваемой задержкой. Запуск отдельным процессом:
+    python tools/fake_telegram_api.py --port 8081 --latency-ms 40
+
+и затем TELEGRAM_API_BASE=http://127.0.0.1:8081 для бота или бенчмарков.
+Счётчики запросов отдаются по GET /stats.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterable, Optional
+
+from aiohttp import web
+
+
+@dataclass
+class FakeApiStats:
+    requests: int = 0
+    by_method: dict[str, int] = field(default_factory=dict)
+    in_flight: int = 0
+    max_in_flight: int = 0
+    # time.time() окончания последнего запроса — по нему внешние стенды видят, когда бот затих
+    last_request_at: float = 0.0
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.by_method.clear()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.last_request_at = 0.0
+
+
+def _chat(chat_id: str) -> dict:
+    try:
+        numeric = int(chat_id)
+    except (TypeError, ValueError):
+        numeric = -1001
+    return {"id": numeric, "type": "private" if numeric > 0 else "channel"}
+
+
+def _message(message_id: int, chat_id: str, text: str = "ok") -> dict:
+    return {"message_id": message_id, "date": int(time.time()), "chat": _chat(chat_id), "text": text}
+
+
+def create_app(latency: float = 0.0, stats: Optional[FakeApiStats] = None) -> web.Application:
+    stats = stats if stats is not None else FakeApiStats()
+    message_ids = itertools.count(1)
+
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        stats.requests += 1
+        stats.by_method[method] = stats.by_method.get(method, 0) + 1
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        try:
+            form = await request.post()
+            if latency:
+                await asyncio.sleep(latency)
+
+            chat_id = str(form.get("chat_id", "1"))
+            name = method.lower()
+            if name == "getme":
+                result: object = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+            elif name == "getupdates":
+                # Имитируем long polling без апдейтов
+                await asyncio.sleep(min(float(form.get("timeout", 0) or 0), 1.0))
+                result = []
+            elif name in ("copymessage",):
+                result = {"message_id": next(message_ids)}
+            elif name in ("copymessages", "forwardmessages"):
+                raw_ids = str(form.get("message_ids", "[]")).strip("[]")
+                result = [{"message_id": next(message_ids)} for part in raw_ids.split(",") if part.strip()]
+            elif name == "sendmediagroup":
+                result = [_message(next(message_ids), chat_id)]
+            elif name.startswith("send") or name in ("forwardmessage", "editmessagetext"):
+                result = _message(next(message_ids), chat_id)
+            else:
+                result = True
+            return web.json_response({"ok": True, "result": result})
+        finally:
+            stats.in_flight -= 1
+            stats.last_request_at = time.time()
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": stats.requests,
+                "by_method": stats.by_method,
+                "max_in_flight": stats.max_in_flight,
+                "last_request_at": stats.last_request_at,
+            }
+        )
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/bot{token}/{method}", handle)
+    # Счётчики для стендов, запускающих заглушку отдельным процессом
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+@asynccontextmanager
+async def run_fake_api(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency: float = 0.0,
+) -> AsyncIterator[tuple[str, FakeApiStats]]:
+    """Запускает заглушку в текущем event loop; отдаёт (base_url, stats)."""
+
+    stats = FakeApiStats()
+    runner = web.AppRunner(create_app(latency=latency, stats=stats), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = runner.addresses[0][1]
+    try:
+        yield f"http://{host}:{bound_port}", stats
+    finally:
+        await runner.cleanup()
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Artificial per-request latency")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    web.run_app(create_app(latency=args.latency_ms / 1000), host=args.host, port=args.port, access_log=None)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
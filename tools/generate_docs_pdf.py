@@ -1,11 +1,17 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
 import os
-from dataclasses import dataclass
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
 from datetime import date
 from pathlib import Path
-from typing import Iterable, List, Optional
+from typing import Iterable, Iterator, List, Optional
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
@@ -23,55 +29,173 @@ from reportlab.platypus import (  # type: ignore
 )
 
 
-def _try_register_windows_fonts() -> tuple[str, str, str]:
-    """Регистрирует шрифты с поддержкой кириллицы.
+# Семейства с кириллицей в порядке предпочтения: (семейство, regular, bold) — имена файлов .ttf
+FONT_FAMILIES = [
+    ("Arial", "arial.ttf", "arialbd.ttf"),
+    ("Calibri", "calibri.ttf", "calibrib.ttf"),
+    ("DejaVuSans", "DejaVuSans.ttf", "DejaVuSans-Bold.ttf"),
+    ("LiberationSans", "LiberationSans-Regular.ttf", "LiberationSans-Bold.ttf"),
+    ("NotoSans", "NotoSans-Regular.ttf", "NotoSans-Bold.ttf"),
+    ("FreeSans", "FreeSans.ttf", "FreeSansBold.ttf"),
+]
+
+# Моноширинный шрифт для inline-кода и код-блоков
+MONO_FAMILIES = [
+    ("Consolas", "consola.ttf"),
+    ("CourierNew", "cour.ttf"),
+    ("DejaVuSansMono", "DejaVuSansMono.ttf"),
+    ("LiberationMono", "LiberationMono-Regular.ttf"),
+    ("NotoSansMono", "NotoSansMono-Regular.ttf"),
+    ("FreeMono", "FreeMono.ttf"),
+]
+
+# Запросы к fontconfig: семейство с кириллицей (lang=ru), его жирное начертание и моноширинный
+FC_PATTERNS = {
+    "regular": "sans-serif:lang=ru:style=Regular",
+    "bold": "sans-serif:lang=ru:style=Bold",
+    "mono": "monospace:lang=ru:style=Regular",
+}
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "1xbettj-docs"
+FONT_CACHE_FILE = CACHE_DIR / "fonts.json"
+BUILD_MANIFEST_FILE = CACHE_DIR / "builds.json"
 
-    Возвращает (family_regular, family_bold, family_mono).
 
-    На Windows обычно доступны Arial/Arial Bold.
-    """
-
-    fonts_dir = Path(os.environ.get("WINDIR", r"C:\\Windows")) / "Fonts"
-    candidates = [
-        (fonts_dir / "arial.ttf", fonts_dir / "arialbd.ttf", "Arial"),
-        (fonts_dir / "calibri.ttf", fonts_dir / "calibrib.ttf", "Calibri"),
+@dataclass
+class FontSet:
+    """Найденные файлы шрифтов; mono_path может отсутствовать — тогда используется встроенный Courier."""
+
+    family: str
+    regular_path: str
+    bold_path: str
+    mono_family: Optional[str] = None
+    mono_path: Optional[str] = None
+
+    def exists(self) -> bool:
+        paths = [self.regular_path, self.bold_path] + ([self.mono_path] if self.mono_path else [])
+        return all(Path(p).is_file() for p in paths)
+
+
+def _font_dirs() -> List[Path]:
+    dirs = [
+        Path(os.environ.get("WINDIR", r"C:\\Windows")) / "Fonts",
+        Path.home() / ".local" / "share" / "fonts",
+        Path.home() / ".fonts",
+        Path("/usr/local/share/fonts"),
+        Path("/usr/share/fonts"),
+        Path("/Library/Fonts"),
+        Path("/System/Library/Fonts"),
     ]
+    data_dirs = os.environ.get("XDG_DATA_DIRS", "")
+    dirs.extend(Path(d) / "fonts" for d in data_dirs.split(os.pathsep) if d)
+    return [d for d in dirs if d.is_dir()]
 
-    # Моноширинный шрифт для inline-кода
-    mono_candidates = [
-        (fonts_dir / "consola.ttf", "Consolas"),
-        (fonts_dir / "cour.ttf", "CourierNew"),
-    ]
 
-    mono_font_name: str | None = None
-    for mono_path, mono_family in mono_candidates:
-        if mono_path.exists():
-            mono_font_name = f"{mono_family}-Regular"
-            pdfmetrics.registerFont(TTFont(mono_font_name, str(mono_path)))
-            break
+def _scan_font_files() -> dict[str, str]:
+    """Индекс «имя файла в нижнем регистре -> путь» по стандартным каталогам шрифтов (первое вхождение)."""
+
+    wanted = {name.lower() for _, regular, bold in FONT_FAMILIES for name in (regular, bold)}
+    wanted |= {name.lower() for _, name in MONO_FAMILIES}
+
+    found: dict[str, str] = {}
+    for font_dir in _font_dirs():
+        for root, _dirs, files in os.walk(font_dir):
+            for name in files:
+                key = name.lower()
+                if key in wanted and key not in found:
+                    found[key] = str(Path(root) / name)
+    return found
+
 
-    for regular_path, bold_path, family in candidates:
-        if regular_path.exists() and bold_path.exists():
-            pdfmetrics.registerFont(TTFont(f"{family}-Regular", str(regular_path)))
-            pdfmetrics.registerFont(TTFont(f"{family}-Bold", str(bold_path)))
-            # Если моно не нашли — используем встроенный Courier
-            return f"{family}-Regular", f"{family}-Bold", (mono_font_name or "Courier")
+def _fc_match(pattern: str) -> Optional[str]:
+    """Путь к файлу, который fontconfig выбирает для pattern; только .ttf — TTFont не читает .otf/.ttc."""
 
-    # Фолбэк: пробуем DejaVuSans, если вдруг установлен
     try:
-        pdfmetrics.registerFont(TTFont("DejaVuSans", "DejaVuSans.ttf"))
-        pdfmetrics.registerFont(TTFont("DejaVuSans-Bold", "DejaVuSans-Bold.ttf"))
+        result = subprocess.run(
+            ["fc-match", "--format=%{file}", pattern],
+            capture_output=True,
+            text=True,
+            timeout=10,
+            check=False,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    path = result.stdout.strip()
+    if result.returncode == 0 and path.lower().endswith(".ttf") and Path(path).is_file():
+        return path
+    return None
+
+
+def _discover_fonts() -> FontSet:
+    """Ищет шрифты с кириллицей: сначала известные семейства по каталогам шрифтов, затем fontconfig."""
+
+    files = _scan_font_files()
+
+    mono_family: Optional[str] = None
+    mono_path: Optional[str] = None
+    for family, name in MONO_FAMILIES:
+        if name.lower() in files:
+            mono_family, mono_path = family, files[name.lower()]
+            break
+
+    for family, regular, bold in FONT_FAMILIES:
+        if regular.lower() in files and bold.lower() in files:
+            return FontSet(family, files[regular.lower()], files[bold.lower()], mono_family, mono_path)
+
+    if shutil.which("fc-match"):
+        regular_path = _fc_match(FC_PATTERNS["regular"])
+        bold_path = _fc_match(FC_PATTERNS["bold"])
+        if regular_path and bold_path:
+            if mono_path is None:
+                mono_path = _fc_match(FC_PATTERNS["mono"])
+                mono_family = Path(mono_path).stem.replace("-", "") if mono_path else None
+            family = Path(regular_path).stem.replace("-Regular", "").replace("-", "")
+            return FontSet(family, regular_path, bold_path, mono_family, mono_path)
+
+    raise RuntimeError(
+        "Не удалось найти шрифт с поддержкой кириллицы. "
+        "Установите Arial/Calibri (Windows) или DejaVu/Liberation (Linux, пакет fonts-dejavu) и повторите."
+    )
+
+
+def _load_fonts(refresh: bool = False) -> FontSet:
+    """Найденные шрифты из кэша (~/.cache/1xbettj-docs/fonts.json); обход каталогов — только при промахе."""
+
+    if not refresh and FONT_CACHE_FILE.exists():
         try:
-            pdfmetrics.registerFont(TTFont("DejaVuSansMono", "DejaVuSansMono.ttf"))
-            mono = "DejaVuSansMono"
-        except Exception:
-            mono = "Courier"
-        return "DejaVuSans", "DejaVuSans-Bold", mono
-    except Exception as e:  # noqa: BLE001
-        raise RuntimeError(
-            "Не удалось найти шрифт с поддержкой кириллицы. "
-            "Установите Arial/Calibri (Windows) или DejaVuSans (Linux) и повторите."
-        ) from e
+            fonts = FontSet(**json.loads(FONT_CACHE_FILE.read_text(encoding="utf-8")))
+            if fonts.exists():
+                return fonts
+        except (OSError, ValueError, TypeError):
+            pass
+
+    fonts = _discover_fonts()
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        FONT_CACHE_FILE.write_text(json.dumps(asdict(fonts), ensure_ascii=False, indent=2), encoding="utf-8")
+    except OSError:
+        # Кэш — только ускорение; без прав на запись просто ищем шрифты каждый раз
+        pass
+    return fonts
+
+
+def _register_fonts(fonts: FontSet) -> tuple[str, str, str]:
+    """Регистрирует шрифты в reportlab. Возвращает (family_regular, family_bold, family_mono)."""
+
+    regular, bold = f"{fonts.family}-Regular", f"{fonts.family}-Bold"
+    registered = set(pdfmetrics.getRegisteredFontNames())
+    if regular not in registered:
+        pdfmetrics.registerFont(TTFont(regular, fonts.regular_path))
+    if bold not in registered:
+        pdfmetrics.registerFont(TTFont(bold, fonts.bold_path))
+
+    # Если моно не нашли — используем встроенный Courier
+    mono = "Courier"
+    if fonts.mono_path and fonts.mono_family:
+        mono = f"{fonts.mono_family}-Regular"
+        if mono not in registered:
+            pdfmetrics.registerFont(TTFont(mono, fonts.mono_path))
+    return regular, bold, mono
 
 
 @dataclass
@@ -80,12 +204,13 @@ class Block:
     text: str
 
 
-def _parse_markdown_simple(md: str) -> List[Block]:
-    """Минимальный парсер Markdown для нужд документации.
+def _iter_markdown_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    """Потоковый минимальный парсер Markdown для нужд документации.
 
-    Поддерживает:
+    Принимает строки (например, открытый файл) и отдаёт блоки по мере разбора, не держа в памяти
+    ни весь текст, ни список блоков. Поддерживает:
     - Заголовки #, ##, ###
-    - Маркированные списки ("- ")
+    - Маркированные списки ("- "), подряд идущие пункты сливаются в один блок ul
     - Нумерованные списки ("1)" или "1.") как обычный текст
     - Код-блоки ```
     - Горизонтальные линии ---
@@ -93,31 +218,35 @@ def _parse_markdown_simple(md: str) -> List[Block]:
     Это намеренно простой парсер (без полной спецификации Markdown).
     """
 
-    lines = md.replace("\r\n", "\n").split("\n")
-    blocks: List[Block] = []
-
     in_code = False
     code_lines: List[str] = []
+    paragraph_lines: List[str] = []
+    ul_items: List[str] = []
 
-    def flush_paragraph(par_lines: List[str]) -> None:
-        text = "\n".join(par_lines).strip()
-        if text:
-            blocks.append(Block("p", text))
+    def flush_list() -> Iterator[Block]:
+        if ul_items:
+            yield Block("ul", "\n".join(ul_items))
+            ul_items.clear()
 
-    paragraph_lines: List[str] = []
+    def flush_paragraph() -> Iterator[Block]:
+        text = "\n".join(paragraph_lines).strip()
+        paragraph_lines.clear()
+        if text:
+            yield from flush_list()
+            yield Block("p", text)
 
     for raw in lines:
-        line = raw.rstrip("\n")
+        line = raw.rstrip("\r\n")
 
         if line.strip().startswith("```"):
             if not in_code:
-                flush_paragraph(paragraph_lines)
-                paragraph_lines = []
+                yield from flush_paragraph()
                 in_code = True
                 code_lines = []
             else:
                 in_code = False
-                blocks.append(Block("code", "\n".join(code_lines).rstrip()))
+                yield from flush_list()
+                yield Block("code", "\n".join(code_lines).rstrip())
             continue
 
         if in_code:
@@ -125,70 +254,48 @@ def _parse_markdown_simple(md: str) -> List[Block]:
             continue
 
         if line.strip() == "---":
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
-            blocks.append(Block("hr", ""))
+            yield from flush_paragraph()
+            yield from flush_list()
+            yield Block("hr", "")
             continue
 
+        heading = None
         if line.startswith("### "):
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
-            blocks.append(Block("h3", line[4:].strip()))
-            continue
-
-        if line.startswith("## "):
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
-            blocks.append(Block("h2", line[3:].strip()))
-            continue
-
-        if line.startswith("# "):
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
-            blocks.append(Block("h1", line[2:].strip()))
+            heading = Block("h3", line[4:].strip())
+        elif line.startswith("## "):
+            heading = Block("h2", line[3:].strip())
+        elif line.startswith("# "):
+            heading = Block("h1", line[2:].strip())
+        if heading is not None:
+            yield from flush_paragraph()
+            yield from flush_list()
+            yield heading
             continue
 
         if line.strip().startswith("- "):
-            # Копим список как отдельный блок для более аккуратного вывода
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
-
-            items: List[str] = []
-            items.append(line.strip()[2:].strip())
-
-            # соберём последующие пункты списка
-            # (делаем «ручной» lookahead, поэтому обработаем через итератор ниже)
-            blocks.append(Block("li", "\n".join(items)))
+            # Пункты списка копим до первого блока другого типа (пустые строки список не прерывают)
+            yield from flush_paragraph()
+            ul_items.append(line.strip()[2:].strip())
             continue
 
         if line.strip() == "":
-            flush_paragraph(paragraph_lines)
-            paragraph_lines = []
+            yield from flush_paragraph()
             continue
 
         paragraph_lines.append(line)
 
-    flush_paragraph(paragraph_lines)
+    yield from flush_paragraph()
+    yield from flush_list()
 
-    # Сольём последовательные li-блоки в один ul
-    merged: List[Block] = []
-    ul_items: List[str] = []
-    for b in blocks:
-        if b.kind == "li":
-            ul_items.append(b.text)
-            continue
-        if ul_items:
-            merged.append(Block("ul", "\n".join(ul_items)))
-            ul_items = []
-        merged.append(b)
-    if ul_items:
-        merged.append(Block("ul", "\n".join(ul_items)))
 
-    return merged
+def _parse_markdown_simple(md: str) -> List[Block]:
+    """Разбирает Markdown-текст целиком; для больших файлов используйте _iter_markdown_blocks."""
+
+    return list(_iter_markdown_blocks(md.replace("\r\n", "\n").split("\n")))
 
 
-def build_pdf(input_md: Path, output_pdf: Path) -> None:
-    regular_font, bold_font, mono_font = _try_register_windows_fonts()
+def build_pdf(input_md: Path, output_pdf: Path, fonts: Optional[FontSet] = None) -> None:
+    regular_font, bold_font, mono_font = _register_fonts(fonts or _load_fonts())
 
     styles = getSampleStyleSheet()
 
@@ -253,33 +360,32 @@ def build_pdf(input_md: Path, output_pdf: Path) -> None:
         spaceAfter=2,
     )
 
-    md_text = input_md.read_text(encoding="utf-8")
-    blocks = _parse_markdown_simple(md_text)
-
     story = []
 
     # Верхняя «шапка» (аккуратно отделяем от основного текста)
     story.append(Spacer(1, 2 * mm))
 
-    for b in blocks:
-        if b.kind == "h1":
-            story.append(Paragraph(_escape(b.text), h1))
-        elif b.kind == "h2":
-            story.append(Paragraph(_escape(b.text), h2))
-        elif b.kind == "h3":
-            story.append(Paragraph(_escape(b.text), h3))
-        elif b.kind == "p":
-            story.append(Paragraph(_inline_format(b.text, mono_font=mono_font), base))
-        elif b.kind == "code":
-            # Preformatted сохраняет переносы строк
-            story.append(Preformatted(b.text, code_style))
-        elif b.kind == "hr":
-            story.append(_hr_table())
-            story.append(Spacer(1, 3 * mm))
-        elif b.kind == "ul":
-            for item in [x.strip() for x in b.text.split("\n") if x.strip()]:
-                story.append(Paragraph(f"• {_inline_format(item, mono_font=mono_font)}", ul_style))
-            story.append(Spacer(1, 2 * mm))
+    # Markdown читается построчно: в памяти копится только story для reportlab, без исходного текста
+    with input_md.open(encoding="utf-8") as md_file:
+        for b in _iter_markdown_blocks(md_file):
+            if b.kind == "h1":
+                story.append(Paragraph(_escape(b.text), h1))
+            elif b.kind == "h2":
+                story.append(Paragraph(_escape(b.text), h2))
+            elif b.kind == "h3":
+                story.append(Paragraph(_escape(b.text), h3))
+            elif b.kind == "p":
+                story.append(Paragraph(_inline_format(b.text, mono_font=mono_font), base))
+            elif b.kind == "code":
+                # Preformatted сохраняет переносы строк
+                story.append(Preformatted(b.text, code_style))
+            elif b.kind == "hr":
+                story.append(_hr_table())
+                story.append(Spacer(1, 3 * mm))
+            elif b.kind == "ul":
+                for item in [x.strip() for x in b.text.split("\n") if x.strip()]:
+                    story.append(Paragraph(f"• {_inline_format(item, mono_font=mono_font)}", ul_style))
+                story.append(Spacer(1, 2 * mm))
 
     doc = SimpleDocTemplate(
         str(output_pdf),
@@ -378,32 +484,128 @@ def _inline_format(text: str, mono_font: str) -> str:
     return "".join(out).replace("\n", "<br/>")
 
 
+def _content_hash(input_md: Path, fonts: FontSet) -> str:
+    """Хэш всего, от чего зависит PDF: исходный Markdown, шрифты и код этого генератора."""
+
+    digest = hashlib.sha256()
+    digest.update(Path(__file__).read_bytes())
+    for font_path in (fonts.regular_path, fonts.bold_path, fonts.mono_path):
+        if font_path:
+            stat = Path(font_path).stat()
+            digest.update(f"{font_path}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    with input_md.open("rb") as md_file:
+        for chunk in iter(lambda: md_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_manifest() -> dict[str, str]:
+    try:
+        return json.loads(BUILD_MANIFEST_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest: dict[str, str]) -> None:
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        BUILD_MANIFEST_FILE.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    except OSError:
+        pass
+
+
+def _build_job(job: tuple[str, str, dict]) -> str:
+    """Сборка одного документа в отдельном процессе (шрифты регистрируются в каждом процессе заново)."""
+
+    input_md, output_pdf, fonts = job
+    build_pdf(input_md=Path(input_md), output_pdf=Path(output_pdf), fonts=FontSet(**fonts))
+    return output_pdf
+
+
 def main(argv: Optional[Iterable[str]] = None) -> int:
     parser = argparse.ArgumentParser(description="Generate PDF from project documentation Markdown")
     parser.add_argument(
         "--input",
-        default=str(Path("docs") / "Документация_и_инструкция.md"),
-        help="Path to input .md file",
+        action="append",
+        help="Path to input .md file (repeat to build several documents in parallel)",
     )
     parser.add_argument(
         "--output",
-        default=str(Path("docs") / "1xBetTJ_Документация_и_инструкция.pdf"),
-        help="Path to output .pdf file",
+        help="Path to output .pdf file (only with a single --input)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory for PDFs when building several documents (default: next to each input)",
     )
+    parser.add_argument("--jobs", type=int, default=0, help="Parallel build processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if nothing changed")
+    parser.add_argument("--refresh-fonts", action="store_true", help="Ignore the font cache and search again")
 
     args = parser.parse_args(list(argv) if argv is not None else None)
 
-    input_md = Path(args.input)
-    output_pdf = Path(args.output)
+    if not args.input:
+        inputs = [Path("docs") / "Документация_и_инструкция.md"]
+        outputs = [Path(args.output or Path("docs") / "1xBetTJ_Документация_и_инструкция.pdf")]
+    else:
+        inputs = [Path(x) for x in args.input]
+        if args.output and len(inputs) > 1:
+            parser.error("--output can only be used with a single --input; use --output-dir instead")
+        if args.output:
+            outputs = [Path(args.output)]
+        else:
+            outputs = [
+                (Path(args.output_dir) if args.output_dir else md.parent) / f"{md.stem}.pdf" for md in inputs
+            ]
+
+    for input_md in inputs:
+        if not input_md.exists():
+            raise FileNotFoundError(f"Input markdown not found: {input_md}")
 
-    if not input_md.exists():
-        raise FileNotFoundError(f"Input markdown not found: {input_md}")
+    fonts = _load_fonts(refresh=args.refresh_fonts)
+    manifest = _load_manifest()
 
-    output_pdf.parent.mkdir(parents=True, exist_ok=True)
-    build_pdf(input_md=input_md, output_pdf=output_pdf)
+    jobs: list[tuple[str, str, dict]] = []
+    hashes: dict[str, str] = {}
+    for input_md, output_pdf in zip(inputs, outputs):
+        key = str(output_pdf.resolve())
+        content_hash = _content_hash(input_md, fonts)
+        if not args.force and output_pdf.exists() and manifest.get(key) == content_hash:
+            print(f"SKIP: {output_pdf} is up to date")
+            continue
+        output_pdf.parent.mkdir(parents=True, exist_ok=True)
+        hashes[key] = content_hash
+        jobs.append((str(input_md), str(output_pdf), asdict(fonts)))
+
+    failed = 0
+    workers = min(len(jobs), args.jobs or os.cpu_count() or 1)
+    if workers <= 1:
+        results = []
+        for job in jobs:
+            try:
+                results.append((job, _build_job(job), None))
+            except Exception as e:  # noqa: BLE001
+                results.append((job, None, e))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(job, pool.submit(_build_job, job)) for job in jobs]
+            results = []
+            for job, future in futures:
+                try:
+                    results.append((job, future.result(), None))
+                except Exception as e:  # noqa: BLE001
+                    results.append((job, None, e))
+
+    for job, output, error in results:
+        key = str(Path(job[1]).resolve())
+        if error is not None:
+            failed += 1
+            print(f"FAIL: {job[1]}: {error}", file=sys.stderr)
+            continue
+        manifest[key] = hashes[key]
+        print(f"OK: generated {output}")
 
-    print(f"OK: generated {output_pdf}")
-    return 0
+    _save_manifest(manifest)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
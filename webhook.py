@@ -0,0 +1,430 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+import struct
+from pathlib import Path
+from typing import Callable, Hashable, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from config import (
+    ADMIN_IDS,
+    LOG_FILE,
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKERS,
+    create_file_handler,
+    file_handler,
+    is_admin,
+)
+from counters import flush_all_counters
+from db import init_db
+from delivery import create_bot, create_delivery_bot
+from logger_utils import log_error
+from outbound import outbound_scheduler
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Кадр между главным процессом и обработчиком: тип (1 байт) + длина (4 байта) + данные
+_FRAME_HEADER = struct.Struct(">BI")
+# Главный процесс -> обработчик
+_UPDATE = 1  # JSON апдейта как пришёл от Telegram
+_GRANT = 2  # слот на отправку выдан: [id запроса]
+_STOP = 3  # остановка: новых апдейтов не будет, слоты выдаются, пока обработчик не закроет сокет
+# Обработчик -> главный процесс
+_ACQUIRE = 4  # запрос слота: [id запроса, chat_id, приоритет, стоимость]
+_CANCEL = 5  # запрос слота больше не нужен: [id запроса]
+_PAUSE = 6  # получен 429: [retry_after]
+
+DispatcherFactory = Callable[[Bot], Dispatcher]
+WorkersStarter = Callable[[Bot, Bot, bool], list]
+
+
+def _update_owner(update: dict) -> Optional[int]:
+    """id пользователя (или чата), от которого пришёл апдейт."""
+
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = value.get(field)
+            if isinstance(owner, dict) and isinstance(owner.get("id"), int):
+                return owner["id"]
+        return None
+    return None
+
+
+def pick_worker(update: dict, workers: int) -> int:
+    """Номер процесса для апдейта.
+
+    Апдейты одного пользователя всегда попадают в один процесс — там его состояние FSM.
+    Апдейты админов идут в процесс 0: там же идут рассылки, их реестр (пауза/отмена) и планировщик.
+    """
+
+    owner = _update_owner(update)
+    if owner is None or is_admin(owner):
+        return 0
+    return owner % workers
+
+
+def _check_secret(request: web.Request) -> bool:
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET)
+
+
+async def _set_webhook(bot: Bot, dp: Dispatcher) -> None:
+    if not WEBHOOK_URL:
+        logging.warning("WEBHOOK_URL не задан: setWebhook не вызывается, апдейты нужно подавать на %s", WEBHOOK_PATH)
+        return
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logging.info("Вебхук установлен: %s", WEBHOOK_URL)
+
+
+async def _serve(app: web.Application) -> None:
+    """Держит HTTP-сервер до SIGTERM / SIGINT."""
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info("Вебхук слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+# ----------------------------------------------------------------------
+# Один процесс
+# ----------------------------------------------------------------------
+
+
+async def _run_single(create_dispatcher: DispatcherFactory, start_background_workers: WorkersStarter) -> None:
+    bot = create_bot()
+    delivery_bot = create_delivery_bot()
+    dp = create_dispatcher(delivery_bot)
+    start_background_workers(bot, delivery_bot, True)
+
+    # Ответ Telegram сразу, обработка — фоновой задачей
+    app = web.Application()
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=WEBHOOK_SECRET).register(app, WEBHOOK_PATH)
+
+    logging.info("Бот запускается (webhook, 1 процесс). Админы: %s", ADMIN_IDS)
+    try:
+        await _set_webhook(bot, dp)
+        await _serve(app)
+    finally:
+        flush_all_counters()
+        await bot.session.close()
+        await delivery_bot.session.close()
+
+
+# ----------------------------------------------------------------------
+# Несколько процессов
+# ----------------------------------------------------------------------
+
+
+def _write_frame(writer: asyncio.StreamWriter, kind: int, payload: bytes) -> None:
+    writer.write(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Optional[tuple[int, bytes]]:
+    """Следующий кадр или None, если другая сторона закрыла сокет."""
+
+    try:
+        kind, size = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+        return kind, await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class UpdateRouter:
+    """HTTP-приёмник вебхука в главном процессе.
+
+    Проверяет секрет, отвечает Telegram сразу и пересылает тело апдейта процессу-обработчику
+    по Unix-сокету (см. pick_worker). По тому же сокету обработчики получают слоты на отправку (SlotServer). Если обработчик не успевает, его сокет заполняется и ответ
+    Telegram задерживается — Telegram сам сбавляет темп доставки.
+    """
+
+    def __init__(self, writers: list[asyncio.StreamWriter]) -> None:
+        self.writers = writers
+        self.routed = [0] * len(writers)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not _check_secret(request):
+            return web.Response(status=401)
+
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+
+        index = pick_worker(update, len(self.writers))
+        writer = self.writers[index]
+        _write_frame(writer, _UPDATE, body)
+        await writer.drain()
+        self.routed[index] += 1
+        return web.Response()
+
+
+class SlotClient:
+    """Слоты на отправку для планировщика процесса-обработчика: запрашиваются у главного процесса."""
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.closed = False
+        self._next_id = 0
+        self._pending: dict[int, asyncio.Future] = {}
+
+    async def acquire(self, chat_id: Optional[Hashable], priority: int, cost: int) -> None:
+        if self.closed:
+            raise ConnectionError("Главный процесс вебхука недоступен")
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        _write_frame(self.writer, _ACQUIRE, json.dumps([request_id, chat_id, priority, cost]).encode())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот ещё не выдан — главный процесс не должен тратить на него лимит
+            if self._pending.pop(request_id, None) is not None and not self.closed:
+                _write_frame(self.writer, _CANCEL, json.dumps([request_id]).encode())
+            raise
+
+    def pause(self, seconds: float) -> None:
+        if not self.closed:
+            _write_frame(self.writer, _PAUSE, json.dumps([seconds]).encode())
+
+    def granted(self, request_id: int) -> None:
+        future = self._pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def close(self) -> None:
+        self.closed = True
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Главный процесс вебхука недоступен"))
+        self._pending.clear()
+
+
+class SlotServer:
+    """Выдача слотов процессу-обработчику планировщиком главного процесса (outbound_scheduler)."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self._waiting: dict[int, asyncio.Task] = {}
+
+    async def _grant(self, request_id: int, chat_id: Optional[Hashable], priority: int, cost: int) -> None:
+        try:
+            await outbound_scheduler.acquire(chat_id, priority, cost)
+        finally:
+            self._waiting.pop(request_id, None)
+        if not self.writer.is_closing():
+            _write_frame(self.writer, _GRANT, json.dumps([request_id]).encode())
+
+    async def serve(self) -> None:
+        """Обслуживает запросы, пока обработчик не закроет сокет."""
+
+        try:
+            while True:
+                frame = await _read_frame(self.reader)
+                if frame is None:
+                    return
+                kind, payload = frame
+                values = json.loads(payload)
+                if kind == _ACQUIRE:
+                    request_id, chat_id, priority, cost = values
+                    self._waiting[request_id] = asyncio.create_task(self._grant(request_id, chat_id, priority, cost))
+                elif kind == _CANCEL:
+                    task = self._waiting.pop(values[0], None)
+                    if task is not None:
+                        task.cancel()
+                elif kind == _PAUSE:
+                    outbound_scheduler.pause(values[0])
+        finally:
+            for task in self._waiting.values():
+                task.cancel()
+
+
+async def _run_worker(
+    index: int,
+    sock: socket.socket,
+    create_dispatcher: DispatcherFactory,
+    start_background_workers: WorkersStarter,
+) -> None:
+    reader, writer = await asyncio.open_connection(sock=sock)
+    slots = SlotClient(writer)
+    outbound_scheduler.use_remote(slots)
+
+    bot = create_bot()
+    delivery_bot = create_delivery_bot()
+    dp = create_dispatcher(delivery_bot)
+    background = start_background_workers(bot, delivery_bot, index == 0)
+
+    handling: set[asyncio.Task] = set()
+    stopping = asyncio.Event()
+
+    async def read_master() -> None:
+        # Читает сокет до конца: после _STOP ещё приходят слоты для дорабатывающих апдейтов
+        while True:
+            frame = await _read_frame(reader)
+            if frame is None:
+                # Главный процесс закрыл сокет (или завершился) — слотов больше не будет
+                slots.close()
+                stopping.set()
+                return
+            kind, payload = frame
+            if kind == _GRANT:
+                slots.granted(json.loads(payload)[0])
+            elif kind == _STOP:
+                stopping.set()
+            elif kind == _UPDATE and not stopping.is_set():
+                try:
+                    update = json.loads(payload)
+                except ValueError as e:
+                    log_error(user_id=None, context="webhook_worker", message="Некорректный апдейт", exc=e)
+                    continue
+                task = asyncio.create_task(dp.feed_raw_update(bot, update))
+                handling.add(task)
+                task.add_done_callback(handling.discard)
+
+    reading = asyncio.create_task(read_master())
+    try:
+        await stopping.wait()
+    finally:
+        if handling:
+            await asyncio.gather(*handling, return_exceptions=True)
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        flush_all_counters()
+        await bot.session.close()
+        await delivery_bot.session.close()
+        # Закрытие сокета — сигнал главному процессу, что этот обработчик остановился
+        reading.cancel()
+        writer.close()
+
+
+def worker_log_file(index: int) -> str:
+    """Файл лога процесса-обработчика: bot.log -> bot.worker1.log."""
+
+    path = Path(LOG_FILE)
+    return str(path.with_name(f"{path.stem}.worker{index}{path.suffix}"))
+
+
+def _use_worker_log_file(index: int) -> None:
+    # Ротация одного файла из нескольких процессов переименовывает его под остальными — строки теряются,
+    # поэтому каждый обработчик пишет и ротирует свой файл, а LOG_FILE остаётся за главным процессом
+    root = logging.getLogger()
+    root.removeHandler(file_handler)
+    file_handler.close()
+    root.addHandler(create_file_handler(worker_log_file(index)))
+
+
+def _worker_process(
+    index: int,
+    sock: socket.socket,
+    inherited: list[socket.socket],
+    create_dispatcher: DispatcherFactory,
+    start_background_workers: WorkersStarter,
+) -> None:
+    # Унаследованные при fork концы сокетов главного процесса (в том числе свой) не дали бы увидеть их закрытие
+    for other in inherited:
+        other.close()
+    _use_worker_log_file(index)
+    # Ctrl+C получает вся группа процессов; обработчик останавливается по закрытию сокета главным процессом
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, sock, create_dispatcher, start_background_workers))
+
+
+async def _run_master(
+    sockets: list[socket.socket],
+    processes: list[multiprocessing.Process],
+    create_dispatcher: DispatcherFactory,
+) -> None:
+    writers = []
+    serving = []
+    for sock in sockets:
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writers.append(writer)
+        serving.append(asyncio.create_task(SlotServer(reader, writer).serve()))
+    router = UpdateRouter(writers)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, router.handle)
+
+    bot = create_bot()
+    logging.info("Бот запускается (webhook, процессов: %s). Админы: %s", len(processes), ADMIN_IDS)
+    try:
+        await _set_webhook(bot, create_dispatcher(bot))
+        await _serve(app)
+    finally:
+        await bot.session.close()
+        # Обработчики дорабатывают принятые апдейты (им ещё нужны слоты) и закрывают сокет сами
+        for writer in writers:
+            _write_frame(writer, _STOP, b"")
+        await asyncio.gather(*serving, return_exceptions=True)
+        for writer in writers:
+            writer.close()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+        logging.info("Вебхук остановлен, апдейтов по процессам: %s", router.routed)
+
+
+def run_webhook(create_dispatcher: DispatcherFactory, start_background_workers: WorkersStarter) -> None:
+    """Точка входа режима BOT_MODE=webhook.
+
+    WEBHOOK_WORKERS=1 — приём и обработка в одном процессе (SimpleRequestHandler aiogram).
+    Иначе главный процесс принимает HTTP, раздаёт апдейты WEBHOOK_WORKERS обработчикам и выдаёт им
+    слоты на отправку по общему лимиту OUTBOUND_GLOBAL_PER_SECOND; общее состояние (пользователи,
+    рассылки, счётчики) — в БД.
+    """
+
+    init_db()
+    if WEBHOOK_WORKERS <= 1:
+        asyncio.run(_run_single(create_dispatcher, start_background_workers))
+        return
+
+    # fork: обработчики наследуют импортированные модули и роутеры, ничего не сериализуется
+    context = multiprocessing.get_context("fork")
+    master_sockets = []
+    processes = []
+    for index in range(WEBHOOK_WORKERS):
+        master_sock, worker_sock = socket.socketpair()
+        master_sockets.append(master_sock)
+        process = context.Process(
+            target=_worker_process,
+            args=(index, worker_sock, list(master_sockets), create_dispatcher, start_background_workers),
+            name=f"webhook-worker-{index}",
+        )
+        process.start()
+        worker_sock.close()
+        processes.append(process)
+
+    asyncio.run(_run_master(master_sockets, processes, create_dispatcher))